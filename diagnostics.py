@@ -0,0 +1,263 @@
+"""Turn diagnostics shared by main.py and tests/chat-plan.py: bounded previews, per-turn profiles and route costs.
+
+Standard library and pydantic only, so either uv script can import it without
+adding dependencies.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import textwrap
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Literal, Optional
+
+from pydantic import BaseModel
+
+
+class _PreviewBudgetExceeded(Exception):
+    pass
+
+
+def _truncate(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[: limit - 1] + "…"
+
+
+def bounded_preview(value: Any, limit: int = 120, *, max_items: int = 3, max_depth: int = 3) -> str:
+    """Render a compact JSON-like preview of ``value`` in at most ``limit`` chars.
+
+    Serialization is lazy and stops as soon as the budget is spent; containers
+    longer than ``max_items`` are shown with their size and leading entries, so
+    the cost depends on ``limit`` rather than on the size of the value.
+    """
+    parts: List[str] = []
+    remaining = limit + 1
+
+    def emit(text: str) -> None:
+        nonlocal remaining
+        parts.append(text)
+        remaining -= len(text)
+        if remaining <= 0:
+            raise _PreviewBudgetExceeded
+
+    def walk(item: Any, depth: int) -> None:
+        if isinstance(item, BaseModel):
+            item = dict(item)
+        if isinstance(item, dict):
+            size = len(item)
+            if depth >= max_depth:
+                emit(f"{{…{size} keys}}")
+                return
+            emit("{")
+            for position, (key, child) in enumerate(item.items()):
+                if position >= max_items:
+                    emit(f", …+{size - position} keys")
+                    break
+                if position:
+                    emit(", ")
+                emit(json.dumps(str(key)[:limit], ensure_ascii=False) + ": ")
+                walk(child, depth + 1)
+            emit("}")
+        elif isinstance(item, (list, tuple)):
+            size = len(item)
+            if depth >= max_depth:
+                emit(f"[…{size} items]")
+                return
+            emit(f"[{size} items: " if size > max_items else "[")
+            for position in range(min(size, max_items)):
+                if position:
+                    emit(", ")
+                walk(item[position], depth + 1)
+            if size > max_items:
+                emit(", …")
+            emit("]")
+        elif isinstance(item, str):
+            emit(json.dumps(item[:limit], ensure_ascii=False))
+        elif item is None or isinstance(item, (bool, int, float)):
+            emit(json.dumps(item))
+        else:
+            emit(_truncate(str(item), limit))
+
+    try:
+        walk(value, 0)
+    except _PreviewBudgetExceeded:
+        pass
+    return _truncate("".join(parts), limit)
+
+
+def _emit_to_stderr(headline: str, details: str) -> None:
+    print(headline, file=sys.stderr)
+    if details:
+        print(textwrap.indent(details, "  "), file=sys.stderr)
+
+
+class TurnProfiler:
+    """Per-turn CPU (cProfile) or memory (tracemalloc) profiles for an interactive loop.
+
+    ``cpu`` dumps one pstats file per turn (``python -m pstats`` or snakeviz
+    can open it); ``mem`` writes the allocation growth between snapshots taken
+    before and after the turn, grouped by source line. cProfile only sees the
+    event-loop thread, so connector calls run in worker threads show up as
+    time waiting in the loop. ``emit(headline, details)`` shows the summary
+    (STDERR by default).
+    """
+
+    def __init__(
+        self,
+        mode: Literal["cpu", "mem"],
+        directory: str,
+        top: int = 15,
+        *,
+        emit: Optional[Callable[[str, str], None]] = None,
+    ) -> None:
+        self.mode = mode
+        self.directory = directory
+        self.top = top
+        self.turns = 0
+        self._emit = emit or _emit_to_stderr
+        self._prefix = datetime.now().strftime("%Y%m%d-%H%M%S")
+        if mode == "mem" and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def turn(self) -> Iterator[None]:
+        self.turns += 1
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, f"{self._prefix}-turn{self.turns:03d}")
+        started = time.perf_counter()
+        if self.mode == "cpu":
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                profile.dump_stats(base + ".prof")
+                report = io.StringIO()
+                pstats.Stats(profile, stream=report).sort_stats("cumulative").print_stats(self.top)
+                self._report(f"cpu {time.perf_counter() - started:.2f}s -> {base}.prof", report.getvalue().strip())
+            return
+        tracemalloc.reset_peak()
+        before = self._snapshot()
+        try:
+            yield
+        finally:
+            growth = self._snapshot().compare_to(before, "lineno")
+            current, peak = tracemalloc.get_traced_memory()
+            lines = [str(stat) for stat in growth[: self.top]]
+            header = f"traced {current / 2**20:.1f} MiB (turn peak {peak / 2**20:.1f} MiB)"
+            with open(base + ".mem.txt", "w", encoding="utf-8") as f:
+                f.write("\n".join([header, *(str(stat) for stat in growth[:100])]) + "\n")
+            self._report(f"mem {header} -> {base}.mem.txt", "\n".join(lines))
+
+    @staticmethod
+    def _snapshot() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces(
+            (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+            )
+        )
+
+    def _report(self, headline: str, details: str) -> None:
+        self._emit(f"[profile] turn {self.turns}: {headline}", details)
+
+
+# USD / 1M tokens（入力, 出力）。MODEL_PRICING_JSON で上書き・追加できる。
+DEFAULT_MODEL_PRICING: Dict[str, tuple[float, float]] = {
+    "gpt-5": (1.25, 10.0),
+    "gpt-5-mini": (0.25, 2.0),
+    "gpt-5-nano": (0.05, 0.40),
+    "gpt-4.1": (2.0, 8.0),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1-nano": (0.10, 0.40),
+    "gpt-4o": (2.50, 10.0),
+    "gpt-4o-mini": (0.15, 0.60),
+    "o4-mini": (1.10, 4.40),
+}
+
+
+def load_model_pricing(raw: str) -> Dict[str, tuple[float, float]]:
+    """DEFAULT_MODEL_PRICING updated from a MODEL_PRICING_JSON value; raises ValueError if it is malformed."""
+    pricing = dict(DEFAULT_MODEL_PRICING)
+    if not raw.strip():
+        return pricing
+    try:
+        data = json.loads(raw)
+    except json.JSONDecodeError as exc:
+        raise ValueError(f"MODEL_PRICING_JSON is not valid JSON: {exc}") from exc
+    if not isinstance(data, dict):
+        raise ValueError('MODEL_PRICING_JSON must be an object like {"model": [input, output]}.')
+    for model, price in data.items():
+        try:
+            pricing[str(model)] = (float(price[0]), float(price[1]))
+        except (TypeError, ValueError, IndexError, KeyError) as exc:
+            raise ValueError(f"MODEL_PRICING_JSON has an invalid price for {model!r}: {price!r}") from exc
+    return pricing
+
+
+class RouteStats:
+    """Latency, token usage and estimated cost per route (chat / plan)."""
+
+    def __init__(self, pricing: Optional[Dict[str, tuple[float, float]]] = None) -> None:
+        self.pricing = pricing or dict(DEFAULT_MODEL_PRICING)
+        self.records: Dict[str, List[Dict[str, Any]]] = {}
+
+    def record(
+        self, route: str, model: Optional[str], elapsed: float, usage: Any, *, reason: Optional[str] = None
+    ) -> Dict[str, Any]:
+        name = str(model or "default")
+        input_tokens = int(getattr(usage, "input_tokens", 0) or 0)
+        output_tokens = int(getattr(usage, "output_tokens", 0) or 0)
+        record = {
+            "route": route,
+            "reason": reason,
+            "model": name,
+            "elapsed_s": round(elapsed, 3),
+            "requests": int(getattr(usage, "requests", 0) or 0),
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "cost_usd": self.estimate_cost(name, input_tokens, output_tokens),
+        }
+        self.records.setdefault(route, []).append(record)
+        return record
+
+    def estimate_cost(self, model: str, input_tokens: int, output_tokens: int) -> Optional[float]:
+        price = self.pricing.get(model)
+        if price is None:
+            # 日付付きスナップショット名（例: gpt-4.1-mini-2025-04-14）は接頭辞で照合
+            matches = [name for name in self.pricing if model.startswith(name + "-")]
+            if not matches:
+                return None
+            price = self.pricing[max(matches, key=len)]
+        return round((input_tokens * price[0] + output_tokens * price[1]) / 1_000_000, 6)
+
+    @staticmethod
+    def describe(record: Dict[str, Any]) -> str:
+        reason = f" ({record['reason']})" if record.get("reason") else ""
+        cost = f" ${record['cost_usd']:.4f}" if record["cost_usd"] is not None else ""
+        return (
+            f"{record['route']}{reason} model={record['model']} "
+            f"{record['elapsed_s']:.1f}s tokens={record['input_tokens']}+{record['output_tokens']}{cost}"
+        )
+
+    def summary_lines(self) -> List[str]:
+        lines: List[str] = []
+        for route, records in sorted(self.records.items()):
+            latencies = sorted(r["elapsed_s"] for r in records)
+            median = latencies[len(latencies) // 2]
+            costs = [r["cost_usd"] for r in records if r["cost_usd"] is not None]
+            cost_text = f"${sum(costs):.4f}" if costs else "n/a"
+            tokens = sum(r["input_tokens"] + r["output_tokens"] for r in records)
+            lines.append(
+                f"{route}: turns={len(records)} median={median:.1f}s max={latencies[-1]:.1f}s "
+                f"tokens={tokens} cost={cost_text}"
+            )
+        return lines or ["(まだ記録がありません)"]
@@ -7,6 +7,7 @@
 #   "mcp-agent>=0.2.4",
 #   "openai==2.6.1",
 #   "httpx>=0.28.1",
+#   "numpy>=2.3",
 #   "pydantic>=2.12.3",
 #   "google-analytics-data==0.19.0",
 #   "google-api-python-client==2.185.0",
@@ -22,23 +23,185 @@ from __future__ import annotations
 import argparse
 import asyncio
 import base64
+import contextlib
+import contextvars
+import dataclasses
+import functools
+import hashlib
+import heapq
 import importlib
 import json
+import math
 import os
+import re
 import shlex
+import shutil
+import signal
+import socket
+import sqlite3
 import sys
+import tempfile
 import textwrap
+import threading
 import time
+import unicodedata
 import uuid
-from datetime import UTC, datetime, timedelta
+from collections import Counter, deque
+from datetime import UTC, date, datetime, timedelta
+from http import HTTPStatus
 from types import SimpleNamespace
-from typing import Any, Dict, Iterable, List, Optional
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Literal,
+    Optional,
+    Protocol,
+    Sequence,
+    TextIO,
+)
+from urllib.parse import unquote, urlsplit
+
+# ====== 常駐デーモンへの薄いクライアント ======
+# Agents SDK / Google / NumPy の import より前に判定し、--daemon が起動していれば
+# 質問を転送してイベントを中継するだけで終わる（起動コストを払わない）。
+_DAEMON_SOCKET_DEFAULT = "~/.cache/marketing-agent-cli/agent.sock"
+_CHAT_COMMANDS_HELP = "利用可能コマンド: /exit, /quit, /help, /stats, /plan <質問>, /chat <質問>"
+# 回答の中身を左右する設定。シェルの環境変数や .env がデーモンと違えば転送しない
+_DAEMON_CONFIG_PREFIXES = ("GA4_", "GSC_", "WP_", "MCP_", "SERPAPI_", "AHREFS_")
+_DAEMON_CONFIG_NAMES = ("CHAT_MODEL", "PLAN_MODEL")
+
+
+def _config_fingerprint() -> str:
+    """Digest of the environment (``.env`` included) that a daemon's answers depend on."""
+    import dotenv  # 軽量なのでここで読み込んでも起動コストにならない
+
+    # load_dotenv と同じく、既存の環境変数が .env より優先される
+    env = {**{k: v for k, v in dotenv.dotenv_values().items() if v is not None}, **os.environ}
+    resolved = {
+        name: value
+        for name, value in env.items()
+        if name.startswith(_DAEMON_CONFIG_PREFIXES) or name in _DAEMON_CONFIG_NAMES
+    }
+    servers_config = env.get("MCP_SERVERS_CONFIG")
+    if servers_config:
+        with contextlib.suppress(OSError):
+            with open(os.path.expanduser(servers_config), "rb") as handle:
+                resolved["MCP_SERVERS_CONFIG:sha256"] = hashlib.sha256(handle.read()).hexdigest()
+    return hashlib.sha256(json.dumps(resolved, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def _thin_client_args(argv: List[str]) -> Optional[argparse.Namespace]:
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("query", nargs="?", default=None)
+    parser.add_argument("--session-id", type=str, default=f"cli-{uuid.uuid4()}")
+    parser.add_argument("--output", choices=["text", "jsonl"], default="text")
+    parser.add_argument("--refresh", action="store_true")
+    parser.add_argument("--socket", type=str, default=os.getenv("AGENT_SOCKET", _DAEMON_SOCKET_DEFAULT))
+    parser.add_argument("--no-daemon", action="store_true")
+    try:
+        args, extra = parser.parse_known_args(argv)
+    except SystemExit:
+        return None
+    # デーモンの設定（プロパティ・MCP 接続など）と食い違う指定があればローカル実行に回す
+    if extra or args.no_daemon:
+        return None
+    args.socket = os.path.expanduser(args.socket)
+    return args
+
+
+def _ask_daemon(socket_path: str, request: Dict[str, Any]) -> None:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(socket_path)
+        conn.sendall((json.dumps(request, ensure_ascii=False) + "\n").encode("utf-8"))
+        # 書き込み側は閉じない。切断（Ctrl-C）はデーモン側でターンの中断として扱われる
+        out = sys.stdout.buffer
+        while chunk := conn.recv(65536):
+            out.write(chunk)
+            out.flush()
+
+
+def _daemon_config(socket_path: str) -> str:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(socket_path)
+        conn.sendall(b'{"hello": true}\n')
+        with conn.makefile("rb") as reply:
+            return str(json.loads(reply.readline() or b"{}").get("config") or "")
+
+
+def _thin_client_main(argv: List[str]) -> Optional[int]:
+    """Forward to a running ``--daemon``; None means no daemon (or a different config), run locally."""
+    args = _thin_client_args(argv)
+    if args is None or not os.path.exists(args.socket):
+        return None
+    config = _config_fingerprint()
+    try:
+        if _daemon_config(args.socket) != config:
+            print("[daemon] 環境変数/.env の設定がデーモンと異なるため、ローカルで実行します", file=sys.stderr)
+            return None
+    except (ConnectionRefusedError, FileNotFoundError):
+        return None  # 古いソケットファイルだけが残っている
+    except (OSError, ValueError) as exc:
+        print(f"[error] daemon: {exc}", file=sys.stderr)
+        return 1
+    request: Dict[str, Any] = {
+        "session_id": args.session_id,
+        "output": args.output,
+        "refresh": args.refresh,
+        "config": config,
+    }
+    try:
+        _ask_daemon(args.socket, {**request, "show_context": True})
+    except KeyboardInterrupt:
+        return 130
+    except OSError as exc:
+        print(f"[error] daemon: {exc}", file=sys.stderr)
+        return 1
+
+    pending = args.query.strip() if args.query else None
+    prompt = "" if args.output == "jsonl" else "you> "
+    notices = sys.stderr if args.output == "jsonl" else sys.stdout
+    while True:
+        if pending is not None:
+            user_input, pending = pending, None
+        else:
+            try:
+                user_input = input(prompt).strip()
+            except (EOFError, KeyboardInterrupt):
+                print(file=notices)
+                return 0
+        if not user_input:
+            continue
+        if user_input in {"exit", "quit", "/exit", "/quit"}:
+            return 0
+        if user_input == "/help":
+            print(_CHAT_COMMANDS_HELP, file=notices)
+            continue
+        try:
+            _ask_daemon(args.socket, {**request, "query": user_input})
+        except KeyboardInterrupt:
+            print("\n[error] ターンを中断しました（Ctrl-C）。セッションはそのまま続けられます。", file=sys.stderr)
+        except OSError as exc:
+            print(f"[error] daemon: {exc}", file=sys.stderr)
+            return 1
+
+
+if __name__ == "__main__":
+    _thin_client_exit = _thin_client_main(sys.argv[1:])
+    if _thin_client_exit is not None:
+        sys.exit(_thin_client_exit)
 
 import dotenv
 import httpx
-from pydantic import BaseModel, Field
+import numpy as np
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
 
-from agents import AgentOutputSchema, Runner, function_tool
+from agents import AgentOutputSchema, Model, ModelProvider, ModelResponse, RunConfig, Runner, Usage, function_tool
 
 import dotenv
 dotenv.load_dotenv()
@@ -67,6 +230,9 @@ _alias_module("mcp_agent.mcp_server_registry", "mcp_agent.mcp.mcp_server_registr
 _alias_module("mcp_agent.context", "mcp_agent.core.context")
 
 from agents_mcp.agent import Agent
+from agents_mcp.aggregator import create_mcp_aggregator
+from agents_mcp.server_registry import ensure_mcp_server_registry_in_context
+from agents_mcp.tools import mcp_list_tools
 from agents.items import (
     MessageOutputItem,
     ReasoningItem,
@@ -75,9 +241,15 @@ from agents.items import (
     ToolCallOutputItem,
 )
 from agents.memory.sqlite_session import SQLiteSession
+from agents.models.multi_provider import MultiProvider
 from agents.result import RunResultStreaming
+from agents.run_context import RunContextWrapper
 from agents.stream_events import AgentUpdatedStreamEvent, RawResponsesStreamEvent, RunItemStreamEvent, StreamEvent
+from agents.tool import FunctionTool
 from mcp_agent.config import MCPServerSettings, MCPSettings
+from openai.types.responses import ResponseOutputItem, ResponseStreamEvent
+
+from diagnostics import RouteStats, TurnProfiler, bounded_preview, load_model_pricing
 
 
 dotenv.load_dotenv()
@@ -90,13 +262,44 @@ GA4_PROPERTY_ID = os.getenv("GA4_PROPERTY_ID", "")
 GSC_OAUTH_CLIENT_JSON = os.getenv("GSC_OAUTH_CLIENT_JSON", "gsc_oauth_client.json")
 GSC_TOKEN_JSON = os.getenv("GSC_TOKEN_JSON", "gsc_token.json")
 AHREFS_API_KEY = os.getenv("AHREFS_API_KEY", "")
+AHREFS_API_BASE = os.getenv("AHREFS_API_BASE", "https://api.ahrefs.com/v3")
+AHREFS_CACHE_TTL = float(os.getenv("AHREFS_CACHE_TTL", "86400"))
+AHREFS_COUNTRY = os.getenv("AHREFS_COUNTRY", "")
+CHAT_MODEL = os.getenv("CHAT_MODEL", "")
+PLAN_MODEL = os.getenv("PLAN_MODEL", "")
+MODEL_PRICING_JSON = os.getenv("MODEL_PRICING_JSON", "")
+CONNECTOR_CACHE_TTL = float(os.getenv("CONNECTOR_CACHE_TTL", "0"))
+PREFETCH_CACHE_TTL = 900.0  # --prefetch で CONNECTOR_CACHE_TTL が未設定のときの保持秒数
+PREFETCH_WP_POSTS = int(os.getenv("PREFETCH_WP_POSTS", "20"))
+WP_POST_LIST_TTL = float(os.getenv("WP_POST_LIST_TTL", "3600"))
+WP_POST_LIST_MAX = int(os.getenv("WP_POST_LIST_MAX", "5000"))
+BACKEND_LIMITS = os.getenv("BACKEND_LIMITS", "ga4=4,gsc=2,serpapi=2,wordpress=4,ahrefs=4")
+PLAN_CACHE_DB = os.getenv("PLAN_CACHE_DB", os.path.expanduser("~/.cache/marketing-agent-cli/plan_cache.sqlite3"))
+PLAN_CACHE_TTL = float(os.getenv("PLAN_CACHE_TTL", "86400"))
+GSC_MAX_ROWS = int(os.getenv("GSC_MAX_ROWS", "1000000"))
+TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT", "60"))
+TOOL_TIMEOUTS = os.getenv("TOOL_TIMEOUTS", "")
+TURN_TIMEOUT = float(os.getenv("TURN_TIMEOUT", "600"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+SERVE_MAX_TURNS = int(os.getenv("SERVE_MAX_TURNS", "8"))
+SERVE_MAX_QUEUED = int(os.getenv("SERVE_MAX_QUEUED", "16"))
+SERVE_SESSION_TURNS = int(os.getenv("SERVE_SESSION_TURNS", "1"))
+SERVE_TOKEN = os.getenv("SERVE_TOKEN", "")
+MCP_SERVERS_CONFIG = os.getenv("MCP_SERVERS_CONFIG", "")
+MCP_CONNECT_TIMEOUT = float(os.getenv("MCP_CONNECT_TIMEOUT", "30"))
+RESULT_STORE_DIR = os.getenv("RESULT_STORE_DIR", os.path.expanduser("~/.cache/marketing-agent-cli/results"))
+RESULT_INLINE_CHARS = int(os.getenv("RESULT_INLINE_CHARS", "0"))
+RESULT_HANDLE_TTL = float(os.getenv("RESULT_HANDLE_TTL", "604800"))
+RESULT_STORE_MAX_MB = float(os.getenv("RESULT_STORE_MAX_MB", "512"))
 
 # ====== Google クライアント ======
 from google.analytics.data_v1beta import BetaAnalyticsDataClient  # type: ignore
 from google.analytics.data_v1beta.types import (  # type: ignore
+    BatchRunReportsRequest,
     DateRange,
     Dimension,
     Metric,
+    OrderBy,
     RunReportRequest,
 )
 from google_auth_oauthlib.flow import InstalledAppFlow  # type: ignore
@@ -168,7 +371,7 @@ def _default_wp_mcp_http_url(base_url: str) -> str:
     return base_url.rstrip("/") + "/wp-json/marketing/mcp/marketing-ro-server"
 
 
-def build_wordpress_mcp_settings(
+def build_mcp_server_settings(
     *,
     transport: str,
     name: str,
@@ -181,16 +384,14 @@ def build_wordpress_mcp_settings(
     http_username: str,
     http_password: str,
     http_bearer: str,
-) -> tuple[MCPSettings, str]:
+) -> tuple[MCPServerSettings, str]:
     transport_normalized = transport.strip().lower() or "streamable_http"
-    server_name = name.strip() or "wordpress"
+    server_name = name.strip()
 
     if transport_normalized in {"http", "streamable_http"}:
         url = http_url.strip()
         if not url:
-            raise ValueError(
-                "WP MCP HTTP transport requires --wp-mcp-http-url or WP_MCP_HTTP_URL."
-            )
+            raise ValueError(f"MCP server {server_name!r}: HTTP transport requires a URL.")
         headers = _parse_key_value_mapping(http_headers)
         authorization_present = any(k.lower() == "authorization" for k in headers)
         bearer = http_bearer.strip()
@@ -211,11 +412,10 @@ def build_wordpress_mcp_settings(
         )
         descriptor = f"{server_name} via streamable_http: {url}"
     elif transport_normalized == "stdio":
-        executable = stdio_command.strip() or "wp"
-        args_raw = stdio_args.strip()
-        if not args_raw:
-            args_raw = "mcp-adapter serve"
-        args = shlex.split(args_raw)
+        executable = stdio_command.strip()
+        if not executable:
+            raise ValueError(f"MCP server {server_name!r}: stdio transport requires a command.")
+        args = shlex.split(stdio_args.strip())
         env_overrides = _parse_key_value_mapping(stdio_env)
         server_settings = MCPServerSettings(
             name=server_name,
@@ -228,13 +428,271 @@ def build_wordpress_mcp_settings(
         descriptor = f"{server_name} via stdio: {executable} {' '.join(args)}".strip()
     else:
         raise ValueError(
-            "Unsupported WP MCP transport. Use 'streamable_http' (or 'http') or 'stdio'."
+            f"MCP server {server_name!r}: unsupported transport {transport!r}. Use 'streamable_http' (or 'http') or 'stdio'."
         )
 
+    return server_settings, descriptor
+
+
+def build_wordpress_mcp_settings(
+    *,
+    transport: str,
+    name: str,
+    stdio_command: str,
+    stdio_args: str,
+    stdio_env: str,
+    stdio_cwd: str,
+    http_url: str,
+    http_headers: str,
+    http_username: str,
+    http_password: str,
+    http_bearer: str,
+) -> tuple[MCPSettings, str]:
+    server_name = name.strip() or "wordpress"
+    if transport.strip().lower() in {"", "http", "streamable_http"} and not http_url.strip():
+        raise ValueError("WP MCP HTTP transport requires --wp-mcp-http-url or WP_MCP_HTTP_URL.")
+    server_settings, descriptor = build_mcp_server_settings(
+        transport=transport,
+        name=server_name,
+        stdio_command=stdio_command.strip() or "wp",
+        stdio_args=stdio_args.strip() or "mcp-adapter serve",
+        stdio_env=stdio_env,
+        stdio_cwd=stdio_cwd,
+        http_url=http_url,
+        http_headers=http_headers,
+        http_username=http_username,
+        http_password=http_password,
+        http_bearer=http_bearer,
+    )
     settings = MCPSettings(servers={server_name: server_settings})
     return settings, descriptor
 
 
+_MCP_SERVER_NAME = re.compile(r"^[A-Za-z][A-Za-z0-9-]{0,31}$")
+
+
+def _mcp_server_from_spec(name: str, spec: Dict[str, Any]) -> tuple[MCPServerSettings, str]:
+    if not _MCP_SERVER_NAME.match(name):
+        # ツール名は「サーバー名_ツール名」で名前空間化されるため、区切りの "_" は使わせない
+        raise ValueError(f"invalid MCP server name {name!r} (letters, digits and '-', max 32 chars)")
+    unknown = set(spec) - {"transport", "url", "headers", "bearer", "username", "password", "command", "args", "env", "cwd"}
+    if unknown:
+        raise ValueError(f"MCP server {name!r}: unknown keys {sorted(unknown)}")
+
+    def text(key: str) -> str:
+        value = spec.get(key) or ""
+        if isinstance(value, dict):
+            return json.dumps(value)
+        if isinstance(value, list):
+            return shlex.join(str(item) for item in value)
+        return str(value)
+
+    return build_mcp_server_settings(
+        transport=text("transport") or ("streamable_http" if spec.get("url") else "stdio"),
+        name=name,
+        stdio_command=text("command"),
+        stdio_args=text("args"),
+        stdio_env=text("env"),
+        stdio_cwd=text("cwd"),
+        http_url=text("url"),
+        http_headers=text("headers"),
+        http_username=text("username"),
+        http_password=text("password"),
+        http_bearer=text("bearer"),
+    )
+
+
+def load_mcp_servers_config(path: str) -> Dict[str, tuple[MCPServerSettings, str]]:
+    """Additional MCP servers from a JSON file: ``{"servers": {name: spec}}`` or ``{name: spec}``.
+
+    A spec takes ``url`` (with optional ``headers``/``bearer``/``username``/
+    ``password``) for streamable HTTP, or ``command``/``args``/``env``/``cwd``
+    for stdio; ``transport`` is inferred from ``url`` when omitted.
+    """
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    servers = data.get("servers", data) if isinstance(data, dict) else None
+    if not isinstance(servers, dict) or not all(isinstance(spec, dict) for spec in servers.values()):
+        raise ValueError(f"{path}: expected an object mapping server names to settings")
+    return {name: _mcp_server_from_spec(name, spec) for name, spec in servers.items()}
+
+
+def parse_mcp_server_flag(raw: str) -> tuple[str, MCPServerSettings, str]:
+    """``NAME=URL`` (streamable HTTP) or ``NAME=stdio:COMMAND ARGS`` from --mcp-server."""
+    name, sep, target = raw.partition("=")
+    if not sep or not target.strip():
+        raise ValueError(f"--mcp-server expects NAME=URL or NAME=stdio:COMMAND, got {raw!r}")
+    target = target.strip()
+    if target.startswith("stdio:"):
+        argv = shlex.split(target.removeprefix("stdio:"))
+        spec: Dict[str, Any] = {"transport": "stdio", "command": argv[0] if argv else "", "args": argv[1:]}
+    else:
+        spec = {"transport": "streamable_http", "url": target}
+    return (name.strip(), *_mcp_server_from_spec(name.strip(), spec))
+
+
+# ====== コネクタキャッシュ ======
+def _output_digest(output: Any) -> str:
+    if not isinstance(output, str):
+        output = json.dumps(output, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(output.encode("utf-8")).hexdigest()
+
+
+# ConnectorCache.recording() の間に読み書きしたエントリ（キー → 内容のハッシュ）
+_CACHE_SOURCES: contextvars.ContextVar[Optional[Dict[str, str]]] = contextvars.ContextVar(
+    "connector_cache_sources", default=None
+)
+
+
+class ConnectorCache:
+    """Process-wide TTL cache for read-only connector and MCP tool results.
+
+    Off unless CONNECTOR_CACHE_TTL is set or ``--prefetch`` turns it on, so
+    by default every answer is built from freshly fetched data. Each entry
+    keeps a content digest so PlanCache can tell, without refetching,
+    whether the responses a plan was built from are still the cached ones.
+    """
+
+    def __init__(self, ttl: float) -> None:
+        self._ttl = ttl
+        self._entries: Dict[str, tuple[float, Any, str]] = {}
+        self._lock = threading.Lock()
+
+    def configure(self, ttl: float) -> None:
+        self._ttl = ttl
+
+    @property
+    def enabled(self) -> bool:
+        return self._ttl > 0
+
+    @staticmethod
+    def make_key(*parts: Any) -> str:
+        return json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value, digest = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+        self._record(key, digest)
+        return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None, *, derived: bool = False) -> None:
+        """Store ``value``; ``derived`` entries (built from other cached responses) get a per-entry token, not a hash."""
+        ttl = self._ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        digest = f"derived:{uuid.uuid4().hex}" if derived else _output_digest(value)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value, digest)
+        self._record(key, digest)
+
+    def fingerprint(self, key: str) -> Optional[str]:
+        """Content digest of the live entry for ``key``, or None once it has expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[2]
+
+    @contextlib.contextmanager
+    def recording(self) -> Iterator[Dict[str, str]]:
+        """Collect the key and digest of every entry read or written in this context (and its tasks/threads)."""
+        sources: Dict[str, str] = {}
+        token = _CACHE_SOURCES.set(sources)
+        try:
+            yield sources
+        finally:
+            _CACHE_SOURCES.reset(token)
+
+    @staticmethod
+    def _record(key: str, digest: str) -> None:
+        sources = _CACHE_SOURCES.get()
+        if sources is not None:
+            sources[key] = digest
+
+
+CONNECTOR_CACHE = ConnectorCache(CONNECTOR_CACHE_TTL)
+
+
+class BackendLimiter:
+    """Per-backend concurrency limits shared by every run in the process.
+
+    A qualified backend such as ``wordpress:site-a`` gets its own slots and,
+    unless it is configured explicitly, the limit of its family (``wordpress``).
+    """
+
+    def __init__(self, limits: Dict[str, int]) -> None:
+        self._limits = dict(limits)
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def configure(self, limits: Dict[str, int]) -> None:
+        self._limits.update(limits)
+        self._semaphores.clear()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, backend: str) -> AsyncIterator[None]:
+        limit = self._limits.get(backend, self._limits.get(backend.partition(":")[0], 0))
+        if limit <= 0:
+            yield
+            return
+        semaphore = self._semaphores.get(backend)
+        if semaphore is None:
+            semaphore = self._semaphores[backend] = asyncio.Semaphore(limit)
+        async with semaphore:
+            yield
+
+
+def _parse_backend_limits(raw: str) -> Dict[str, int]:
+    try:
+        return {name: int(value) for name, value in _parse_key_value_mapping(raw).items()}
+    except ValueError as exc:
+        raise ValueError(f"Invalid backend limit in {raw!r}: {exc}") from exc
+
+
+BACKEND_LIMITER = BackendLimiter({})
+
+
+async def _run_connector(backend: str, func: Callable[..., Any], *args: Any) -> Any:
+    # 同期コネクタはスレッドで実行し、イベントループ（他サイト・他ツール）を塞がない
+    async with BACKEND_LIMITER.slot(backend):
+        return await asyncio.to_thread(func, *args)
+
+
+# ====== コネクタプール ======
+@functools.lru_cache(maxsize=1)
+def _ga4_client() -> BetaAnalyticsDataClient:
+    return BetaAnalyticsDataClient()
+
+
+_GSC_THREAD_LOCAL = threading.local()
+_GSC_CREDENTIALS_LOCK = threading.Lock()
+_GSC_CREDENTIALS: Optional[Credentials] = None
+
+
+def _gsc_service() -> Any:
+    # googleapiclient のサービスはスレッドセーフではないのでスレッド毎に保持し、資格情報は共有する
+    global _GSC_CREDENTIALS
+    service = getattr(_GSC_THREAD_LOCAL, "service", None)
+    if service is None:
+        with _GSC_CREDENTIALS_LOCK:
+            if _GSC_CREDENTIALS is None:
+                _GSC_CREDENTIALS = _gsc_credentials()
+            creds = _GSC_CREDENTIALS
+        service = build("searchconsole", "v1", credentials=creds, cache_discovery=False)
+        _GSC_THREAD_LOCAL.service = service
+    return service
+
+
+@functools.lru_cache(maxsize=1)
+def _serpapi_client() -> httpx.Client:
+    return httpx.Client(timeout=40.0)
+
+
 def ga4_report_pages(
     property_id: str,
     start_date: str,
@@ -243,7 +701,11 @@ def ga4_report_pages(
 ) -> Dict[str, Any]:
     if not property_id:
         return {"warning": "GA4 property is not configured. Skipping GA4 report."}
-    client = BetaAnalyticsDataClient()
+    cache_key = ConnectorCache.make_key("ga4_report_pages", property_id, start_date, end_date, page_paths or [])
+    cached = CONNECTOR_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+    client = _ga4_client()
     dims = [Dimension(name="date"), Dimension(name="pagePath"), Dimension(name="sessionDefaultChannelGroup")]
     mets = [Metric(name="screenPageViews"), Metric(name="sessions")]
     request = RunReportRequest(
@@ -257,6 +719,12 @@ def ga4_report_pages(
         # pagePath フィルタの拡張は用途に応じて追加する
         pass
     response = client.run_report(request)
+    payload = _ga4_payload(response)
+    CONNECTOR_CACHE.set(cache_key, payload)
+    return payload
+
+
+def _ga4_payload(response: Any) -> Dict[str, Any]:
     return {
         "dimension_headers": [header.name for header in response.dimension_headers],
         "metric_headers": [header.name for header in response.metric_headers],
@@ -264,9 +732,69 @@ def ga4_report_pages(
             [dim.value for dim in row.dimension_values] + [metric.value for metric in row.metric_values]
             for row in response.rows
         ],
+        # limit で切られた場合は rows より大きい
+        "row_count": response.row_count,
     }
 
 
+GA4_BATCH_SIZE = 5  # batchRunReports が1リクエストで受け付けるレポート数の上限
+
+
+class Ga4ReportSpec(BaseModel):
+    name: str = Field(description="結果を引くためのレポート名（例: by_channel）")
+    dimensions: List[str] = Field(description="GA4 ディメンション名（例: pagePath, sessionDefaultChannelGroup, date, landingPage）")
+    metrics: List[str] = Field(description="GA4 指標名（例: sessions, screenPageViews, totalUsers）")
+    order_by_metric: Optional[str] = Field(description="降順に並べる指標名（不要なら null）")
+    limit: int = Field(description="最大行数（1〜25000）")
+
+
+def ga4_batch_reports(
+    property_id: str, start_date: str, end_date: str, specs: Sequence[Ga4ReportSpec]
+) -> Dict[str, Any]:
+    """Run several GA4 reports via batchRunReports, five per RPC.
+
+    Each report is cached on its own, so only uncached specs are sent.
+    """
+    if not property_id:
+        return {"warning": "GA4 property is not configured. Skipping GA4 report."}
+    names = [spec.name for spec in specs]
+    if len(set(names)) != len(names):
+        raise ValueError("report names must be unique")
+    reports: Dict[str, Any] = {}
+    pending: List[tuple[str, str, RunReportRequest]] = []
+    for spec in specs:
+        if not spec.dimensions and not spec.metrics:
+            raise ValueError(f"report {spec.name!r} needs at least one dimension or metric")
+        cache_key = ConnectorCache.make_key(
+            "ga4_report", property_id, start_date, end_date, spec.dimensions, spec.metrics, spec.order_by_metric, spec.limit
+        )
+        cached = CONNECTOR_CACHE.get(cache_key)
+        if cached is not None:
+            reports[spec.name] = cached
+            continue
+        request = RunReportRequest(
+            dimensions=[Dimension(name=name) for name in spec.dimensions],
+            metrics=[Metric(name=name) for name in spec.metrics],
+            date_ranges=[DateRange(start_date=start_date, end_date=end_date)],
+            limit=max(1, min(spec.limit, 25000)),
+        )
+        if spec.order_by_metric:
+            request.order_bys = [OrderBy(metric=OrderBy.MetricOrderBy(metric_name=spec.order_by_metric), desc=True)]
+        pending.append((spec.name, cache_key, request))
+
+    client = _ga4_client()
+    for offset in range(0, len(pending), GA4_BATCH_SIZE):
+        chunk = pending[offset : offset + GA4_BATCH_SIZE]
+        response = client.batch_run_reports(
+            BatchRunReportsRequest(property=f"properties/{property_id}", requests=[request for _, _, request in chunk])
+        )
+        for (name, cache_key, _), report in zip(chunk, response.reports):
+            payload = _ga4_payload(report)
+            CONNECTOR_CACHE.set(cache_key, payload)
+            reports[name] = payload
+    return {"reports": {name: reports[name] for name in names}}
+
+
 GSC_SCOPES = ["https://www.googleapis.com/auth/webmasters.readonly"]
 
 
@@ -290,16 +818,50 @@ def _gsc_credentials() -> Credentials:
 def gsc_query(site_url: str, start_date: str, end_date: str, dimensions: List[str]) -> Dict[str, Any]:
     if not site_url:
         return {"warning": "GSC site URL is not configured. Skipping GSC query."}
-    creds = _gsc_credentials()
-    service = build("searchconsole", "v1", credentials=creds, cache_discovery=False)
+    cache_key = ConnectorCache.make_key("gsc_query", site_url, start_date, end_date, dimensions)
+    cached = CONNECTOR_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+    service = _gsc_service()
     body = {
         "startDate": start_date,
         "endDate": end_date,
         "dimensions": dimensions,
         "rowLimit": 25000,
     }
-    result = service.searchanalytics().query(siteUrl=site_url, body=body).execute()
-    return result or {}
+    result = service.searchanalytics().query(siteUrl=site_url, body=body).execute() or {}
+    CONNECTOR_CACHE.set(cache_key, result)
+    return result
+
+
+def iter_gsc_rows(
+    site_url: str, start_date: str, end_date: str, dimensions: List[str], page_size: int = 25000
+) -> Iterator[List[Dict[str, Any]]]:
+    """Yield Search Analytics rows page by page (startRow pagination) up to GSC_MAX_ROWS."""
+    service = _gsc_service()
+    start_row = 0
+    while start_row < GSC_MAX_ROWS:
+        body = {
+            "startDate": start_date,
+            "endDate": end_date,
+            "dimensions": dimensions,
+            "rowLimit": page_size,
+            "startRow": start_row,
+        }
+        rows = (service.searchanalytics().query(siteUrl=site_url, body=body).execute() or {}).get("rows") or []
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        start_row += len(rows)
+
+
+def gsc_query_all(site_url: str, start_date: str, end_date: str, dimensions: List[str]) -> Dict[str, Any]:
+    """``gsc_query`` without the 25,000-row cap; ``truncated`` is set when GSC_MAX_ROWS cut it off."""
+    if not site_url:
+        return {"warning": "GSC site URL is not configured. Skipping GSC query."}
+    rows = [row for page in iter_gsc_rows(site_url, start_date, end_date, dimensions) for row in page]
+    return {"rows": rows, "truncated": len(rows) >= GSC_MAX_ROWS}
 
 
 def serpapi_search(q: str, num: int = 10, gl: str = "jp", hl: str = "ja") -> Dict[str, Any]:
@@ -313,151 +875,3095 @@ def serpapi_search(q: str, num: int = 10, gl: str = "jp", hl: str = "ja") -> Dic
         "num": num,
         "api_key": SERPAPI_API_KEY,
     }
-    with httpx.Client(timeout=40.0) as client:
-        resp = client.get("https://serpapi.com/search", params=params)
-        resp.raise_for_status()
-        return resp.json()
+    resp = _serpapi_client().get("https://serpapi.com/search", params=params)
+    resp.raise_for_status()
+    return resp.json()
 
 
-def ahrefs_mcp_site_overview(domain: str) -> Dict[str, Any]:
-    if not AHREFS_API_KEY:
-        return {"warning": "AHREFS_API_KEY not set. Skipping Ahrefs MCP call."}
-    return {"domain": domain, "note": "Use Ahrefs MCP server via MCP tool in production."}
+# ====== Ahrefs コネクタ ======
+AHREFS_MAX_TARGETS = 25
+_AHREFS_KEYWORD_COLUMNS = ["keyword", "volume", "best_position", "sum_traffic"]
+_AHREFS_RETRY_STATUSES = {429, 500, 502, 503, 504}
 
 
-# ====== Agents SDK ツール ======
-@function_tool
-def tool_ga4_report(property_id: Optional[str], start_date: str, end_date: str) -> Dict[str, Any]:
-    """GA4: PV/セッション推移レポート（読み取り）"""
-    return ga4_report_pages(property_id or GA4_PROPERTY_ID, start_date, end_date)
+class AhrefsError(RuntimeError):
+    """An Ahrefs API request that failed after retries."""
 
 
-@function_tool
-def tool_gsc_query(site_url: str, start_date: str, end_date: str, dimensions: List[str]) -> Dict[str, Any]:
-    """GSC: クエリ/ページ別 指標取得（読み取り）"""
-    return gsc_query(site_url, start_date, end_date, dimensions)
+class AhrefsTransport(Protocol):
+    """Fetches one Ahrefs API v3 endpoint; replace it via ``AHREFS.configure(transport=...)``."""
 
+    async def get(self, endpoint: str, params: Dict[str, Any]) -> Dict[str, Any]: ...
 
-@function_tool
-def tool_serpapi(q: str, num: int = 10, gl: str = "jp", hl: str = "ja") -> Dict[str, Any]:
-    """SerpAPI: Google SERP の取得（読み取り）"""
-    return serpapi_search(q, num, gl, hl)
+    async def aclose(self) -> None: ...
 
 
-@function_tool
-def tool_ahrefs_site_overview(domain: str) -> Dict[str, Any]:
-    """Ahrefs: サイト概観（読み取り / MCP 経由想定）"""
-    return ahrefs_mcp_site_overview(domain)
+class AhrefsStandInTransport:
+    """Offline stand-in answering the four endpoints AhrefsConnector uses with figures derived from the target.
 
+    The numbers are made up but stable per target, so ``--ahrefs-check`` can
+    exercise the connector without an API key or billed units.
+    """
 
-# ====== エージェント構築 ======
-AGENT_INSTRUCTIONS = """
-あなたは社内マーケ部門のアナリストAIです。次を厳密に守ってください。
-- あなたは「読み取り専用」のツールだけを使います。CMS更新・公開・削除・API書き込み等は一切行いません。
-- WordPress MCPサーバー/GA4/GSC/SerpAPI/Ahrefsから得たデータを横断的に解釈し、「改善案（提案）」までを出力してください。
-- WordPressの情報はMCPアダプターが公開するツールのみを利用し、直接REST APIを呼び出さないでください。
-- 利用可能なツールが制限されている場合は、その範囲で分析し、不足データは「取得できない」旨を明示してください。
-- 出力は指定の構造（JSON）で返します。説明の冗長化は避け、要点と根拠を簡潔に。
-- 推奨KPI例：PV、セッション、CTR、平均掲載順位、流入チャネル別比率。
-- 日本語で回答してください。
-"""
+    def __init__(self) -> None:
+        self.calls: Counter[str] = Counter()
 
+    async def get(self, endpoint: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        self.calls[endpoint] += 1
+        seed = int(hashlib.sha256(str(params.get("target")).encode("utf-8")).hexdigest()[:8], 16)
+        if endpoint == "site-explorer/domain-rating":
+            return {"domain_rating": {"domain_rating": seed % 100, "ahrefs_rank": seed % 1_000_000}}
+        if endpoint == "site-explorer/backlinks-stats":
+            return {"metrics": {"live": seed % 50_000, "live_refdomains": seed % 5_000}}
+        if endpoint == "site-explorer/metrics":
+            traffic, keywords = seed % 200_000, seed % 30_000
+            return {
+                "metrics": {
+                    "org_keywords": keywords,
+                    "org_keywords_1_3": keywords // 10,
+                    "org_traffic": traffic,
+                    "org_cost": traffic * 3,
+                }
+            }
+        if endpoint == "site-explorer/organic-keywords":
+            rows = [
+                {
+                    "keyword": f"keyword {rank}",
+                    "volume": seed % 9_000 // rank,
+                    "best_position": rank,
+                    "sum_traffic": seed % 3_000 // rank,
+                }
+                for rank in range(1, int(params.get("limit") or 0) + 1)
+            ]
+            return {"keywords": rows}
+        raise AhrefsError(f"{endpoint}: not served by the stand-in")
 
-def build_agent(enabled_tools: List[Any], mcp_server_names: List[str]) -> Agent:
-    return Agent(
-        name="Marketing Analysis Agent",
-        instructions=AGENT_INSTRUCTIONS,
-        tools=enabled_tools,
-        mcp_servers=mcp_server_names,
-        output_type=AgentOutputSchema(ImprovementPlan, strict_json_schema=True),
-    )
+    async def aclose(self) -> None:
+        pass
 
 
-# ====== ストリーミング表示ヘルパ ======
-class StreamPrinter:
-    def __init__(self) -> None:
-        self._progress_active = False
-        self._last_tick = time.monotonic()
-        self._tick_interval = 0.25
-        self._tool_call_names: Dict[str, str] = {}
-        self.last_message_text: str = ""
+class AhrefsHttpTransport:
+    """Ahrefs API v3 over a pooled httpx client; 429/5xx are retried, honouring Retry-After.
 
-    async def consume(self, result: RunResultStreaming) -> None:
-        try:
-            async for event in result.stream_events():
-                self._handle_event(event)
-        finally:
-            self._end_progress()
+    ``base_url`` can point at a local stand-in that serves the same paths.
+    Retries stop once waiting would exceed half of the ``tool_ahrefs_overview``
+    deadline, so a throttled request fails with its status instead of the
+    whole tool timing out. The client belongs to the event loop that created
+    it; ``aclose()`` it before that loop ends.
+    """
 
-    def _handle_event(self, event: StreamEvent) -> None:
-        if isinstance(event, AgentUpdatedStreamEvent):
-            self._end_progress()
-            print(f"\n[agent] {event.new_agent.name}")
-        elif isinstance(event, RawResponsesStreamEvent):
-            self._handle_raw_event(event)
-        elif isinstance(event, RunItemStreamEvent):
-            self._handle_run_item_event(event)
+    def __init__(self, api_key: str, base_url: str, *, retries: int = 3, timeout: float = 30.0) -> None:
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.retries = retries
+        self.timeout = timeout
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
 
-    def _handle_raw_event(self, event: RawResponsesStreamEvent) -> None:
-        event_name = event.data.__class__.__name__
-        if event_name in {"ResponseCreatedEvent", "ResponseOutputItemAddedEvent"}:
-            self._start_progress("model")
-        elif event_name == "ResponseTextDeltaEvent":
-            self._tick_progress()
-        elif event_name in {"ResponseOutputItemDoneEvent", "ResponseCompletedEvent"}:
-            self._end_progress()
+    def _client_for_loop(self) -> httpx.AsyncClient:
+        # AsyncClient の接続プールはイベントループに紐づくため、ループ毎に作り直す
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            if self._client is not None and self._loop is not None and self._loop.is_running():
+                # 別スレッドで動いているループの接続は、そのループ上で閉じる
+                asyncio.run_coroutine_threadsafe(self._client.aclose(), self._loop)
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                headers={"Authorization": f"Bearer {self.api_key}", "Accept": "application/json"},
+                limits=httpx.Limits(max_connections=16, max_keepalive_connections=16),
+            )
+            self._loop = loop
+        return self._client
 
-    def _handle_run_item_event(self, event: RunItemStreamEvent) -> None:
-        name = event.name
-        item = event.item
-        if name == "tool_called" and isinstance(item, ToolCallItem):
-            raw = item.raw_item
-            if isinstance(raw, ResponseFunctionToolCall):
-                self._tool_call_names[raw.call_id] = raw.name
-                args_display = _format_json_snippet(raw.arguments)
-                print(f"\n[tool] ↘ {raw.name} args={args_display}")
+    async def aclose(self) -> None:
+        client, self._client, self._loop = self._client, None, None
+        if client is not None:
+            await client.aclose()
+
+    def _retry_budget(self) -> float:
+        deadline = TOOL_DEADLINES.for_tool("tool_ahrefs_overview")
+        return self.retries * self.timeout if deadline is None else deadline / 2
+
+    async def get(self, endpoint: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        client = self._client_for_loop()
+        loop = asyncio.get_running_loop()
+        give_up_at = loop.time() + self._retry_budget()
+        attempt = 0
+        while True:
+            response = await client.get(f"{self.base_url}/{endpoint}", params=params)
+            if response.status_code in _AHREFS_RETRY_STATUSES and attempt < self.retries:
+                try:
+                    delay = min(float(response.headers.get("Retry-After", "")), 30.0)
+                except ValueError:
+                    delay = 0.5 * 2**attempt
+                # 待っても期限内に結果を返せないなら、ここで諦めて状態を返す
+                if loop.time() + delay < give_up_at:
+                    attempt += 1
+                    await asyncio.sleep(delay)
+                    continue
+            if response.status_code >= 400:
+                raise AhrefsError(f"{endpoint}: HTTP {response.status_code} {response.text[:200]}")
+            return response.json()
+
+
+def _ahrefs_target(raw: str) -> tuple[str, str]:
+    """(target, mode): bare domains and site roots cover all subdomains, deeper URLs the path prefix."""
+    text = raw.strip()
+    parts = urlsplit(text if "://" in text else f"https://{text}")
+    host = (parts.hostname or "").removeprefix("www.")
+    if not host:
+        raise ValueError(f"not a domain or URL: {raw!r}")
+    if parts.path.strip("/"):
+        return f"{host}{parts.path}", "prefix"
+    return host, "subdomains"
+
+
+class AhrefsConnector:
+    """Bulk Ahrefs metrics: overview, backlink and organic-keyword figures for many targets at once.
+
+    Every target needs four endpoint calls; all of them run concurrently
+    under the ``ahrefs`` BACKEND_LIMITS slot, and each response is cached per
+    target and UTC day for ``cache_ttl`` seconds because Ahrefs data changes
+    daily and API units are billed. Results are trimmed to a few numbers
+    and top keywords per target.
+    """
+
+    def __init__(self, transport: Optional[AhrefsTransport], cache_ttl: float) -> None:
+        self.transport = transport
+        self.cache_ttl = cache_ttl
+
+    def configure(self, transport: Optional[AhrefsTransport] = None, cache_ttl: Optional[float] = None) -> None:
+        if transport is not None:
+            self.transport = transport
+        if cache_ttl is not None:
+            self.cache_ttl = cache_ttl
+
+    async def aclose(self) -> None:
+        if self.transport is not None:
+            await self.transport.aclose()
+
+    async def _get(self, endpoint: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        cache_key = ConnectorCache.make_key("ahrefs", endpoint, params)
+        cached = CONNECTOR_CACHE.get(cache_key)
+        if cached is not None:
+            return cached
+        async with BACKEND_LIMITER.slot("ahrefs"):
+            payload = await self.transport.get(endpoint, params)
+        CONNECTOR_CACHE.set(cache_key, payload, ttl=self.cache_ttl)
+        return payload
+
+    async def _target(self, target: str, mode: str, day: str, top_keywords: int, country: str) -> Dict[str, Any]:
+        base = {"target": target, "mode": mode, "date": day}
+        local = {**base, **({"country": country} if country else {})}
+        requests = [
+            self._get("site-explorer/domain-rating", {"target": target, "date": day}),
+            self._get("site-explorer/backlinks-stats", base),
+            self._get("site-explorer/metrics", local),
+        ]
+        if top_keywords:
+            requests.append(
+                self._get(
+                    "site-explorer/organic-keywords",
+                    {
+                        **local,
+                        "select": ",".join(_AHREFS_KEYWORD_COLUMNS),
+                        "order_by": "sum_traffic:desc",
+                        "limit": top_keywords,
+                    },
+                )
+            )
+        outcomes = await asyncio.gather(*requests, return_exceptions=True)
+        record: Dict[str, Any] = {"target": target, "mode": mode}
+        errors: List[str] = []
+        for name, outcome in zip(["domain_rating", "backlinks", "metrics", "keywords"], outcomes):
+            if isinstance(outcome, BaseException):
+                errors.append(f"{name}: {type(outcome).__name__}: {outcome}")
+                continue
+            if name == "domain_rating":
+                rating = outcome.get("domain_rating") or {}
+                record.update(domain_rating=rating.get("domain_rating"), ahrefs_rank=rating.get("ahrefs_rank"))
+            elif name == "backlinks":
+                stats = outcome.get("metrics") or {}
+                record.update(backlinks=stats.get("live"), refdomains=stats.get("live_refdomains"))
+            elif name == "metrics":
+                stats = outcome.get("metrics") or {}
+                record.update(
+                    org_keywords=stats.get("org_keywords"),
+                    org_keywords_top3=stats.get("org_keywords_1_3"),
+                    org_traffic=stats.get("org_traffic"),
+                    org_cost=stats.get("org_cost"),
+                )
             else:
-                print("\n[tool] ↘ function call")
-        elif name == "tool_output" and isinstance(item, ToolCallOutputItem):
-            call_id = getattr(item.raw_item, "call_id", None)
-            if call_id is None and isinstance(item.raw_item, dict):
-                call_id = item.raw_item.get("call_id")
-            tool_name = self._tool_call_names.get(call_id, "tool")
-            summary = summarize_tool_output(item.output)
-            print(f"[tool] ↗ {tool_name} -> {summary}")
-        elif name == "reasoning_item_created" and isinstance(item, ReasoningItem):
-            text = _extract_reasoning_summary(item)
-            if text:
-                print(f"\n[reasoning] {text}")
-        elif name == "message_output_created" and isinstance(item, MessageOutputItem):
-            self.last_message_text = _extract_message_text(item)
+                record["top_keywords"] = [
+                    [row.get(column) for column in _AHREFS_KEYWORD_COLUMNS] for row in outcome.get("keywords") or []
+                ]
+        if errors:
+            record["errors"] = errors
+            record["failed"] = len(errors) == len(outcomes)
+        return record
 
-    def _start_progress(self, label: str) -> None:
-        if not self._progress_active:
-            print(f"\n[{label}] streaming...", end="", flush=True)
-            self._progress_active = True
-            self._last_tick = time.monotonic()
+    async def overview(self, targets: Sequence[str], *, top_keywords: int = 5, country: str = "") -> Dict[str, Any]:
+        if self.transport is None:
+            return {"warning": "AHREFS_API_KEY not set. Skipping Ahrefs."}
+        normalized: Dict[tuple[str, str], None] = {}
+        invalid: List[str] = []
+        for raw in targets:
+            try:
+                normalized[_ahrefs_target(raw)] = None
+            except ValueError:
+                invalid.append(raw)
+        if not normalized or len(normalized) > AHREFS_MAX_TARGETS:
+            raise ValueError(f"targets は1〜{AHREFS_MAX_TARGETS}件のドメインまたは URL で指定してください。")
+        day = datetime.now(UTC).date().isoformat()
+        records = await asyncio.gather(
+            *(self._target(target, mode, day, top_keywords, country.lower()) for target, mode in normalized)
+        )
+        return {
+            "date": day,
+            "country": country or "all",
+            "top_keywords_columns": _AHREFS_KEYWORD_COLUMNS,
+            "targets": records,
+            "failed": sum(1 for record in records if record.get("failed")),
+            **({"invalid_targets": invalid} if invalid else {}),
+        }
 
-    def _tick_progress(self) -> None:
-        if not self._progress_active:
-            self._start_progress("model")
-            return
-        now = time.monotonic()
-        if now - self._last_tick >= self._tick_interval:
-            print(".", end="", flush=True)
-            self._last_tick = now
 
-    def _end_progress(self) -> None:
-        if self._progress_active:
-            print()
-            self._progress_active = False
+AHREFS = AhrefsConnector(AhrefsHttpTransport(AHREFS_API_KEY, AHREFS_API_BASE) if AHREFS_API_KEY else None, AHREFS_CACHE_TTL)
 
 
-# ====== ユーティリティ ======
-def _date_span(days: int) -> tuple[str, str]:
-    end = datetime.now(UTC).date()
-    start = end - timedelta(days=days)
-    return (start.isoformat(), end.isoformat())
+async def _closing_connectors(main: Awaitable[Any]) -> Any:
+    """Await ``main``, then close the pooled connector clients tied to this event loop."""
+    try:
+        return await main
+    finally:
+        await AHREFS.aclose()
+
+
+async def ahrefs_check() -> bool:
+    """Run AhrefsConnector against the stand-in transport and print whether its output is well formed."""
+    transport = AhrefsStandInTransport()
+    connector = AhrefsConnector(transport, cache_ttl=60)
+    # 同じサイトの表記揺れ・パス指定・不正な値を混ぜる
+    targets = ["example.com", "https://www.example.com/", "example.org/blog/", "https://"]
+    result = await connector.overview(targets, top_keywords=3)
+    first_calls = sum(transport.calls.values())
+    await connector.overview(targets, top_keywords=3)
+    problems: List[str] = []
+    records = {record["target"]: record for record in result["targets"]}
+    if set(records) != {"example.com", "example.org/blog/"}:
+        problems.append(f"targets were not normalized: {sorted(records)}")
+    for target, record in records.items():
+        if record.get("errors"):
+            problems.append(f"{target}: {record['errors']}")
+        fields = ("domain_rating", "backlinks", "refdomains", "org_traffic")
+        missing = [name for name in fields if record.get(name) is None]
+        if missing:
+            problems.append(f"{target}: missing {', '.join(missing)}")
+        if len(record.get("top_keywords") or []) != 3:
+            problems.append(f"{target}: expected 3 top keywords")
+    if result.get("invalid_targets") != ["https://"]:
+        problems.append(f"invalid targets not reported: {result.get('invalid_targets')}")
+    if first_calls != 4 * len(records):
+        problems.append(f"expected {4 * len(records)} endpoint calls, made {first_calls}")
+    if sum(transport.calls.values()) != first_calls:
+        problems.append("the second overview was not served from the cache")
+    for problem in problems:
+        print(f"[ahrefs] {problem}", file=sys.stderr)
+    status = "failed" if problems else "ok"
+    print(f"[ahrefs] check {status}: {len(records)} targets, {first_calls} calls", file=sys.stderr)
+    return not problems
+
+
+# ====== 分析カーネル（NumPy） ======
+def _factorize(values: Sequence[Any]) -> tuple[np.ndarray, np.ndarray]:
+    """Return (sorted distinct labels, int codes); hashing beats sorting every row."""
+    index: Dict[str, int] = {}
+    codes = np.fromiter((index.setdefault(str(value), len(index)) for value in values), dtype=np.intp, count=len(values))
+    labels = np.array(list(index), dtype=str)
+    order = np.argsort(labels, kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return labels[order], rank[codes] if len(codes) else codes
+
+
+@dataclasses.dataclass
+class MetricFrame:
+    """Column-oriented GA4/GSC rows: integer-coded dimensions and float64 metrics.
+
+    ``labels[dim]`` holds the sorted distinct values of a dimension and
+    ``codes[dim]`` the per-row index into it, so group-bys work on integers.
+    """
+
+    codes: Dict[str, np.ndarray]
+    labels: Dict[str, np.ndarray]
+    metrics: Dict[str, np.ndarray]
+
+    @classmethod
+    def from_columns(cls, dims: Dict[str, Sequence[Any]], metrics: Dict[str, Sequence[Any]]) -> MetricFrame:
+        codes: Dict[str, np.ndarray] = {}
+        labels: Dict[str, np.ndarray] = {}
+        for name, values in dims.items():
+            labels[name], codes[name] = _factorize(values)
+        # GA4 は数値を文字列で返すが、float64 配列へ一括変換できる
+        columns = {name: np.array(values, dtype=np.float64) for name, values in metrics.items()}
+        return cls(codes, labels, columns)
+
+    @classmethod
+    def from_ga4(cls, payload: Dict[str, Any]) -> MetricFrame:
+        dims = payload.get("dimension_headers") or []
+        metrics = payload.get("metric_headers") or []
+        rows = payload.get("rows") or []
+        # zip(*rows) での転置は行数が多いと遅いので列ごとに取り出す
+        columns = [[row[i] for row in rows] for i in range(len(dims) + len(metrics))]
+        return cls.from_columns(dict(zip(dims, columns[: len(dims)])), dict(zip(metrics, columns[len(dims) :])))
+
+    @classmethod
+    def from_gsc(cls, payload: Dict[str, Any], dimensions: Sequence[str]) -> MetricFrame:
+        rows = payload.get("rows") or []
+        keys = [[row["keys"][i] for row in rows] for i in range(len(dimensions))]
+        metrics = {name: [row.get(name, 0.0) for row in rows] for name in ("clicks", "impressions", "ctr", "position")}
+        return cls.from_columns(dict(zip(dimensions, keys)), metrics)
+
+    def __len__(self) -> int:
+        for column in (*self.codes.values(), *self.metrics.values()):
+            return len(column)
+        return 0
+
+    def label(self, dim: str) -> np.ndarray:
+        return self.labels[dim][self.codes[dim]]
+
+    def map_dimension(self, dim: str, func: Callable[[str], str]) -> MetricFrame:
+        # 変換は distinct な値に対してのみ行い、コードを付け替える
+        mapped, remap = _factorize([func(label) for label in self.labels[dim]])
+        return MetricFrame({**self.codes, dim: remap[self.codes[dim]]}, {**self.labels, dim: mapped}, self.metrics)
+
+    def with_metrics(self, **columns: np.ndarray) -> MetricFrame:
+        return MetricFrame(self.codes, self.labels, {**self.metrics, **columns})
+
+    def group_index(self, by: Sequence[str]) -> tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """Return (group id per row, dimension codes per group) for the given dims."""
+        if not by:
+            return np.zeros(len(self), dtype=np.intp), {}
+        shape = [max(1, len(self.labels[dim])) for dim in by]
+        flat = np.ravel_multi_index([self.codes[dim] for dim in by], shape)
+        unique, inverse = np.unique(flat, return_inverse=True)
+        return inverse, dict(zip(by, np.unravel_index(unique, shape)))
+
+    def group_by(self, *by: str, metrics: Optional[Sequence[str]] = None) -> MetricFrame:
+        inverse, group_codes = self.group_index(by)
+        size = len(next(iter(group_codes.values()))) if group_codes else int(len(self) > 0)
+        sums = {
+            name: np.bincount(inverse, weights=self.metrics[name], minlength=size)
+            for name in (metrics or list(self.metrics))
+        }
+        return MetricFrame(group_codes, {dim: self.labels[dim] for dim in by}, sums)
+
+    def share(self, metric: str, within: Sequence[str] = ()) -> np.ndarray:
+        """Each row's fraction of ``metric`` within its ``within`` group (e.g. channel share per page)."""
+        values = self.metrics[metric]
+        inverse, _ = self.group_index(within)
+        totals = np.bincount(inverse, weights=values)[inverse] if len(values) else values
+        return np.divide(values, totals, out=np.zeros_like(values), where=totals != 0)
+
+    def rolling_mean(self, metric: str, window: int, *, order: str, by: Sequence[str] = ()) -> np.ndarray:
+        """Trailing mean over ``window`` rows ordered by ``order`` within each ``by`` group."""
+        values = self.metrics[metric]
+        if not len(values):
+            return values.copy()
+        group, _ = self.group_index(by)
+        perm = np.lexsort((self.codes[order], group))
+        ordered, groups = values[perm], group[perm]
+        cumulative = np.concatenate(([0.0], np.cumsum(ordered)))
+        index = np.arange(len(ordered))
+        starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+        group_start = starts[np.searchsorted(starts, index, side="right") - 1]
+        low = np.maximum(index - window + 1, group_start)
+        means = np.empty_like(ordered)
+        means[perm] = (cumulative[index + 1] - cumulative[low]) / (index + 1 - low)
+        return means
+
+    def percentiles(self, metric: str, q: Sequence[float], by: Sequence[str] = ()) -> MetricFrame:
+        """Per-group percentiles (linear interpolation, as np.percentile) as metrics ``p<q>``."""
+        values = self.metrics[metric]
+        inverse, group_codes = self.group_index(by)
+        counts = np.bincount(inverse) if len(values) else np.zeros(0, dtype=np.intp)
+        fractions = np.asarray(q, dtype=np.float64) / 100.0
+        names = [f"p{value:g}" for value in q]
+        if not len(counts):
+            return MetricFrame(group_codes, {dim: self.labels[dim] for dim in by}, {name: np.zeros(0) for name in names})
+        ordered = values[np.lexsort((values, inverse))]
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        position = starts[:, None] + (counts[:, None] - 1) * fractions[None, :]
+        low = np.floor(position).astype(np.intp)
+        high = np.minimum(low + 1, (starts + counts - 1)[:, None])
+        weight = position - low
+        result = ordered[low] * (1 - weight) + ordered[high] * weight
+        return MetricFrame(
+            group_codes,
+            {dim: self.labels[dim] for dim in by},
+            {name: result[:, i] for i, name in enumerate(names)},
+        )
+
+    def top(self, metric: str, n: int, *, ascending: bool = False) -> np.ndarray:
+        """Row indices of the ``n`` largest (or smallest) values, best first."""
+        score = np.nan_to_num(self.metrics[metric])
+        score = score if ascending else -score
+        if len(score) > n:
+            candidates = np.argpartition(score, n - 1)[:n]
+        else:
+            candidates = np.arange(len(score))
+        return candidates[np.argsort(score[candidates], kind="stable")]
+
+    def dense_series(
+        self, metric: str, by: Sequence[str], *, time_dim: str, periods: Sequence[str]
+    ) -> tuple[MetricFrame, np.ndarray]:
+        """Pivot into a (groups x periods) matrix; periods absent from the data are zero.
+
+        ``periods`` are labels of ``time_dim`` in output order. Returns the
+        group frame (dimension codes per matrix row) and the matrix.
+        """
+        inverse, group_codes = self.group_index(by)
+        groups = len(next(iter(group_codes.values()))) if group_codes else int(len(self) > 0)
+        lookup = {label: i for i, label in enumerate(periods)}
+        column = np.array([lookup.get(str(label), -1) for label in self.labels[time_dim]], dtype=np.intp)
+        columns = column[self.codes[time_dim]] if len(self) else np.zeros(0, dtype=np.intp)
+        keep = columns >= 0
+        flat = inverse[keep] * len(periods) + columns[keep]
+        matrix = np.bincount(flat, weights=self.metrics[metric][keep], minlength=groups * len(periods))
+        frame = MetricFrame(group_codes, {dim: self.labels[dim] for dim in by}, {})
+        return frame, matrix.reshape(groups, len(periods))
+
+    def records(self, indices: Optional[np.ndarray] = None, digits: int = 2) -> List[Dict[str, Any]]:
+        rows = np.arange(len(self)) if indices is None else indices
+        dims = {dim: self.label(dim) for dim in self.codes}
+        return [
+            {
+                **{dim: str(labels[i]) for dim, labels in dims.items()},
+                **{name: _json_number(column[i], digits) for name, column in self.metrics.items()},
+            }
+            for i in rows
+        ]
+
+
+def _json_number(value: float, digits: int) -> Optional[float]:
+    return None if np.isnan(value) else round(float(value), digits)
+
+
+def summarize_ga4_traffic(payload: Dict[str, Any], top_n: int = 10) -> Dict[str, Any]:
+    """Channel shares, daily trend with 7-day mean and page distribution from a GA4 page report."""
+    frame = MetricFrame.from_ga4(payload)
+    if not len(frame):
+        return {"warning": payload.get("warning") or "GA4 の行がありません。"}
+    channel = "sessionDefaultChannelGroup"
+
+    channels = frame.group_by(channel)
+    channels = channels.with_metrics(session_share=channels.share("sessions"))
+    daily = frame.group_by("date")
+    daily = daily.with_metrics(sessions_7d_avg=daily.rolling_mean("sessions", 7, order="date"))
+
+    page_channel = frame.group_by("pagePath", channel)
+    organic = page_channel.share("sessions", within=["pagePath"]) * (
+        page_channel.label(channel) == "Organic Search"
+    )
+    pages = page_channel.with_metrics(organic_share=organic).group_by("pagePath")
+    top_pages = pages.records(pages.top("screenPageViews", top_n), digits=3)
+
+    return {
+        "rows": len(frame),
+        "channels": channels.records(channels.top("sessions", len(channels)), digits=3),
+        "daily": daily.records(digits=1),
+        "page_count": len(pages),
+        "page_pv_percentiles": pages.percentiles("screenPageViews", [50, 90, 99]).records()[0],
+        "top_pages": top_pages,
+    }
+
+
+# ====== URL 正規化と記事結合インデックス ======
+@functools.lru_cache(maxsize=65536)
+def content_key(url: str) -> str:
+    """``normalize_url_key`` prefixed with the lowercased host (``www.`` dropped) for absolute URLs."""
+    host = (urlsplit(url.strip()).hostname or "").removeprefix("www.") if "://" in url else ""
+    return host + normalize_url_key(url)
+
+
+def normalize_url_key(url: str) -> str:
+    """Join key shared by WordPress links, GA4 pagePath and GSC page URLs.
+
+    Drops scheme, host, query string and fragment, percent-decodes the path
+    (NFC), collapses duplicate slashes and removes the trailing slash.
+    """
+    url = url.strip()
+    # パス（GA4 の pagePath）は "//" 始まりでもホストとして解釈させない
+    path = re.split(r"[?#]", url, maxsplit=1)[0] if url.startswith("/") else urlsplit(url).path
+    path = unicodedata.normalize("NFC", unquote(path))
+    path = re.sub(r"/{2,}", "/", path)
+    if not path.startswith("/"):
+        path = "/" + path
+    return path.rstrip("/") or "/"
+
+
+@dataclasses.dataclass
+class ArticleIndex:
+    """Hash index of per-article records joined from WordPress, GA4 and GSC."""
+
+    records: Dict[str, Dict[str, Any]]
+
+    @classmethod
+    def build(
+        cls, posts: List[Dict[str, Any]], ga4_payload: Dict[str, Any], gsc_payload: Dict[str, Any]
+    ) -> ArticleIndex:
+        records: Dict[str, Dict[str, Any]] = {}
+        for post in posts:
+            key = normalize_url_key(str(post.get("link") or ""))
+            records[key] = {
+                "url_key": key,
+                "post_id": post.get("ID"),
+                "title": post.get("title"),
+                "modified": post.get("modified"),
+                "link": post.get("link"),
+            }
+
+        def merge(frame: MetricFrame, dim: str, columns: Dict[str, str]) -> None:
+            grouped = frame.map_dimension(dim, normalize_url_key).group_by(dim, metrics=list(columns))
+            for key, *values in zip(grouped.label(dim), *(grouped.metrics[name] for name in columns)):
+                record = records.setdefault(str(key), {"url_key": str(key), "post_id": None})
+                record.update({name: float(value) for name, value in zip(columns.values(), values)})
+
+        if ga4_payload.get("rows"):
+            merge(MetricFrame.from_ga4(ga4_payload), "pagePath", {"screenPageViews": "pv", "sessions": "sessions"})
+        if gsc_payload.get("rows"):
+            gsc = MetricFrame.from_gsc(gsc_payload, ["page"])
+            gsc = gsc.with_metrics(position_weighted=gsc.metrics["position"] * gsc.metrics["impressions"])
+            merge(gsc, "page", {"clicks": "clicks", "impressions": "impressions", "position_weighted": "position"})
+        for record in records.values():
+            impressions = record.get("impressions", 0.0)
+            if impressions:
+                record["position"] = round(record["position"] / impressions, 2)
+                record["ctr"] = round(record["clicks"] / impressions, 4)
+            else:
+                record.pop("position", None)
+        return cls(records)
+
+    def lookup(self, url: str) -> Optional[Dict[str, Any]]:
+        return self.records.get(normalize_url_key(url))
+
+    def articles(self) -> List[Dict[str, Any]]:
+        return [record for record in self.records.values() if record["post_id"] is not None]
+
+    def orphans(self) -> List[Dict[str, Any]]:
+        # 計測はあるが WordPress 記事と結びつかない URL（カテゴリ一覧・取得範囲外の記事など）
+        return [record for record in self.records.values() if record["post_id"] is None]
+
+
+def _traffic_rank(record: Dict[str, Any]) -> tuple[float, float]:
+    return (record.get("pv", 0.0), record.get("clicks", 0.0))
+
+
+async def _call_mcp_tool(ctx: RunContextWrapper[Any], suffix: str, arguments: Dict[str, Any]) -> Any:
+    """Invoke the (cached) WordPress MCP tool whose name ends with ``suffix``."""
+    tools = getattr(ctx.context, "mcp_tools", None) or {}
+    tool = next((tool for name, tool in tools.items() if name.endswith(suffix)), None)
+    if tool is None:
+        raise LookupError(f"MCP tool '*{suffix}' is not available.")
+    output = await tool.on_invoke_tool(ctx, json.dumps(arguments))
+    if _is_tool_error(output):
+        raise RuntimeError(output)
+    if isinstance(output, str):
+        return json.loads(output)
+    return output
+
+
+async def article_index(
+    ctx: RunContextWrapper[Any], start_date: str, end_date: str
+) -> tuple[ArticleIndex, List[str]]:
+    ga4_property_id = getattr(ctx.context, "ga4_property_id", "") or GA4_PROPERTY_ID
+    gsc_site_url = getattr(ctx.context, "gsc_site_url", "")
+    warnings: List[str] = []
+
+    async def guarded(label: str, job: Awaitable[Any], default: Any) -> Any:
+        try:
+            result = await job
+        except Exception as exc:
+            warnings.append(f"{label}: {type(exc).__name__}: {exc}")
+            return default
+        if isinstance(result, dict) and result.get("warning"):
+            warnings.append(result["warning"])
+        return result
+
+    async def none() -> Dict[str, Any]:
+        return {}
+
+    listing, ga4_payload, gsc_payload = await asyncio.gather(
+        guarded("WordPress", published_posts(ctx), None),
+        guarded(
+            "GA4",
+            _run_connector("ga4", ga4_report_pages, ga4_property_id, start_date, end_date)
+            if ga4_property_id
+            else none(),
+            {},
+        ),
+        guarded(
+            "GSC",
+            _run_connector("gsc", gsc_query, gsc_site_url, start_date, end_date, ["page"]) if gsc_site_url else none(),
+            {},
+        ),
+    )
+    if listing is not None and not listing.complete:
+        warnings.append(
+            f"WordPress: 公開記事のうち {len(listing.posts)} 件だけを結合しました（WP_POST_LIST_MAX またはページ送り非対応）。"
+            "それ以外の記事の URL は top_unmatched_urls に出ます。"
+        )
+    cache_key = ConnectorCache.make_key(
+        "article_index", ga4_property_id, gsc_site_url, start_date, end_date, listing.version if listing else None
+    )
+    index = CONNECTOR_CACHE.get(cache_key)
+    if index is None:
+        index = ArticleIndex.build(listing.posts if listing else [], ga4_payload, gsc_payload)
+        if not warnings:
+            CONNECTOR_CACHE.set(cache_key, index, derived=True)
+    return index, warnings
+
+
+# ====== サイト内コンテンツ索引 ======
+# ASCII 英数字は単語、かな・カナ・漢字の連続は文字 bigram に分割する
+_TOKEN_PATTERN = re.compile(r"[0-9a-z]+|[\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff]+")
+_BM25_K1 = 1.2
+_COMMON_TERM_RATIO = 0.05
+_COMMON_TERM_MIN_DOCS = 200
+
+
+def tokenize(text: str) -> List[str]:
+    tokens: List[str] = []
+    for run in _TOKEN_PATTERN.findall(unicodedata.normalize("NFKC", text).casefold()):
+        if run.isascii() or len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i : i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+_WP_LIST_PAGE_SIZE = 50  # get-posts は 1 回 50 件まで
+_WP_LIST_PAGES_AT_ONCE = 4
+
+
+@dataclasses.dataclass
+class PostListing:
+    """All published posts of one site, as listed through WordPress MCP get-posts."""
+
+    posts: List[Dict[str, Any]]
+    complete: bool
+    version: str = dataclasses.field(default_factory=lambda: uuid.uuid4().hex)
+
+
+async def _list_published_posts(ctx: RunContextWrapper[Any]) -> PostListing:
+    tools = getattr(ctx.context, "mcp_tools", None) or {}
+    tool = next((tool for name, tool in tools.items() if name.endswith("get-posts")), None)
+    if tool is None:
+        raise LookupError("MCP tool '*get-posts' is not available.")
+    # ページ送りの引数名はアダプター次第なので、スキーマにある方を使う
+    properties = tool.params_json_schema.get("properties") or {}
+    paging = "page" if "page" in properties else "offset" if "offset" in properties else None
+
+    async def fetch(page: int) -> List[Dict[str, Any]]:
+        arguments: Dict[str, Any] = {"number": _WP_LIST_PAGE_SIZE, "status": "publish"}
+        if paging == "page":
+            arguments["page"] = page + 1
+        elif paging == "offset":
+            arguments["offset"] = page * _WP_LIST_PAGE_SIZE
+        batch = await _call_mcp_tool(ctx, "get-posts", arguments)
+        return [post for post in batch if isinstance(post, dict)] if isinstance(batch, list) else []
+
+    posts: Dict[Any, Dict[str, Any]] = {}
+    page = 0
+    while True:
+        pages = 1 if paging is None else _WP_LIST_PAGES_AT_ONCE
+        batches = await asyncio.gather(*(fetch(page + offset) for offset in range(pages)))
+        page += pages
+        for batch in batches:
+            for post in batch:
+                posts.setdefault(post.get("ID") or post.get("link"), post)
+        if any(len(batch) < _WP_LIST_PAGE_SIZE for batch in batches):
+            complete = True
+            break
+        if paging is None or len(posts) >= WP_POST_LIST_MAX:
+            complete = False
+            break
+    listing = PostListing(list(posts.values()), complete)
+    content_index_for(ctx.context).add_posts(listing.posts)
+    return listing
+
+
+async def published_posts(ctx: RunContextWrapper[Any]) -> PostListing:
+    """The site's published posts, listed once per run context and relisted after WP_POST_LIST_TTL seconds."""
+    context = ctx.context
+    entry = getattr(context, "post_listing", None)
+    if entry is None or time.monotonic() - entry[0] > WP_POST_LIST_TTL or (
+        entry[1].done() and (entry[1].cancelled() or entry[1].exception() is not None)
+    ):
+        entry = (time.monotonic(), asyncio.ensure_future(_list_published_posts(ctx)))
+        with contextlib.suppress(AttributeError):
+            context.post_listing = entry
+    # 呼び出し元のツールがキャンセルされても、共有している一覧の取得は止めない
+    return await asyncio.shield(entry[1])
+
+
+def _normalize_query(query: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", query).casefold().split())
+
+
+class ContentIndex:
+    """Incremental inverted index over post titles and slugs of one WordPress site.
+
+    Posts are added as they are fetched from WordPress MCP (get-posts /
+    search-posts), so topic lookups never hit the WordPress database.
+    Documents are keyed by ``content_key`` (host and path); each site's run
+    context holds its own index (see ``content_index_for``).
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.documents: Dict[str, Dict[str, Any]] = {}
+        self._terms: Dict[str, Counter[str]] = {}
+        self._postings: Dict[str, Dict[str, int]] = {}
+
+    def add_posts(self, posts: Iterable[Dict[str, Any]]) -> int:
+        """Add or refresh posts; returns how many entries changed."""
+        changed = 0
+        with self._lock:
+            for post in posts:
+                link = str(post.get("link") or "")
+                if not link:
+                    continue
+                key = content_key(link)
+                slug = key.rsplit("/", 1)[-1].replace("-", " ").replace("_", " ")
+                terms = Counter(tokenize(f"{post.get('title') or ''} {slug}"))
+                if self._terms.get(key) == terms:
+                    continue
+                self._remove(key)
+                self.documents[key] = {
+                    "url_key": normalize_url_key(link),
+                    "post_id": post.get("ID"),
+                    "title": post.get("title"),
+                    "modified": post.get("modified"),
+                    "link": link,
+                }
+                self._terms[key] = terms
+                for term, count in terms.items():
+                    self._postings.setdefault(term, {})[key] = count
+                changed += 1
+        return changed
+
+    def search(self, query: str, limit: int = 10, min_coverage: float = 0.5) -> List[tuple[str, float]]:
+        """BM25-style (no length norm; titles are short) ranking of posts for ``query``."""
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        with self._lock:
+            total = len(self.documents)
+            scores: Dict[str, float] = {}
+            matched: Counter[str] = Counter()
+            postings_by_term = sorted(
+                (postings for postings in map(self._postings.get, terms) if postings), key=len
+            )
+            # 出現文書の多い語は、希少な語で絞った候補の加点だけに使う（全件走査を避ける）
+            common_from = len(postings_by_term)
+            for i, postings in enumerate(postings_by_term):
+                if i and len(postings) > max(_COMMON_TERM_MIN_DOCS, _COMMON_TERM_RATIO * total):
+                    common_from = i
+                    break
+            for i, postings in enumerate(postings_by_term):
+                idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+                keys = postings.keys() if i < common_from else [key for key in scores if key in postings]
+                for key in keys:
+                    count = postings[key]
+                    scores[key] = scores.get(key, 0.0) + idf * count * (_BM25_K1 + 1) / (count + _BM25_K1)
+                    matched[key] += 1
+        eligible = ((key, score) for key, score in scores.items() if matched[key] / len(terms) >= min_coverage)
+        return heapq.nlargest(limit, eligible, key=lambda item: item[1])
+
+    def _remove(self, key: str) -> None:
+        for term in self._terms.pop(key, {}):
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(key, None)
+                if not postings:
+                    del self._postings[term]
+
+
+def content_index_for(context: Any) -> ContentIndex:
+    """The content index of the site served by ``context`` (a run context), created on first use."""
+    index = getattr(context, "content_index", None)
+    if index is None:
+        index = ContentIndex()
+        # フリート・デーモン・サーバーでもサイト毎の run_context に置くので、サイト間で混ざらない
+        with contextlib.suppress(AttributeError):
+            context.content_index = index
+    return index
+
+
+def _index_mcp_posts(context: Any, tool_name: str, output: Any) -> None:
+    if not tool_name.endswith(("get-posts", "search-posts")) or not isinstance(output, str):
+        return
+    try:
+        posts = json.loads(output)
+    except json.JSONDecodeError:
+        return
+    if isinstance(posts, list):
+        content_index_for(context).add_posts(post for post in posts if isinstance(post, dict))
+
+
+async def gsc_query_pages(site_url: str, start_date: str, end_date: str) -> Dict[str, List[Dict[str, Any]]]:
+    """Normalized query -> pages with clicks/impressions/position, built once per window."""
+    cache_key = ConnectorCache.make_key("gsc_query_pages", site_url, start_date, end_date)
+    mapping = CONNECTOR_CACHE.get(cache_key)
+    if mapping is None:
+        payload = await _run_connector("gsc", gsc_query, site_url, start_date, end_date, ["query", "page"])
+        mapping = {}
+        for row in payload.get("rows") or []:
+            query, page = row["keys"][:2]
+            mapping.setdefault(_normalize_query(query), []).append(
+                {
+                    "url_key": normalize_url_key(page),
+                    "content_key": content_key(page),
+                    "clicks": row.get("clicks", 0),
+                    "impressions": row.get("impressions", 0),
+                    "position": round(float(row.get("position", 0.0)), 2),
+                }
+            )
+        CONNECTOR_CACHE.set(cache_key, mapping, derived=True)
+    return mapping
+
+
+# ====== カニバリゼーション分析 ======
+CANNIBALIZATION_BUCKETS = 64
+CANNIBALIZATION_MIN_SHARE = 0.1  # 表示回数シェアがこれ未満のページは競合とみなさない
+
+
+def _spill_query_pages(
+    pages: Iterable[List[Dict[str, Any]]], directory: str, buckets: int = CANNIBALIZATION_BUCKETS
+) -> int:
+    """Write query x page rows to hash-bucketed TSV files so one bucket holds whole queries.
+
+    Buckets only live for one report, so the per-process str hash is enough.
+    """
+    handles = [open(os.path.join(directory, f"bucket-{i:03d}.tsv"), "w", encoding="utf-8") for i in range(buckets)]
+    written = 0
+    try:
+        for rows in pages:
+            for row in rows:
+                query = _normalize_query(row["keys"][0])  # 空白は1つにまとまるのでタブ・改行を含まない
+                page = normalize_url_key(row["keys"][1]).replace("\t", " ").replace("\n", " ")
+                handles[hash(query) % buckets].write(
+                    f"{query}\t{page}\t{row.get('clicks', 0)}\t{row.get('impressions', 0)}\t{row.get('position', 0.0)}\n"
+                )
+                written += 1
+    finally:
+        for handle in handles:
+            handle.close()
+    return written
+
+
+def _score_query(query: str, pages: Dict[str, List[float]], min_impressions: float) -> Optional[Dict[str, Any]]:
+    impressions = sum(stats[1] for stats in pages.values())
+    if impressions < min_impressions:
+        return None
+    competing = {key: stats for key, stats in pages.items() if stats[1] / impressions >= CANNIBALIZATION_MIN_SHARE}
+    if len(competing) < 2:
+        return None
+    clicks = sum(stats[0] for stats in pages.values())
+    # 表示回数の分散度（1 - HHI）と、クリックが1ページに集中していない度合いで重み付けする
+    impression_split = 1.0 - sum((stats[1] / impressions) ** 2 for stats in pages.values())
+    click_split = 1.0 - max(stats[0] for stats in pages.values()) / clicks if clicks else 0.0
+    severity = impression_split * math.log1p(impressions) * (1.0 + click_split)
+    ranked = sorted(competing.items(), key=lambda item: item[1][1], reverse=True)
+    return {
+        "query": query,
+        "severity": round(severity, 3),
+        "impressions": int(impressions),
+        "clicks": int(clicks),
+        "impression_split": round(impression_split, 3),
+        "click_split": round(click_split, 3),
+        "pages": [
+            {
+                "url_key": key,
+                "clicks": int(stats[0]),
+                "impressions": int(stats[1]),
+                "position": round(stats[2] / stats[1], 1) if stats[1] else None,
+            }
+            for key, stats in ranked[:4]
+        ],
+        "competing_pages": len(competing),
+    }
+
+
+def _scan_buckets(directory: str, top_n: int, min_impressions: float) -> tuple[List[Dict[str, Any]], int]:
+    """Score one bucket at a time; only the top-n cases stay in memory."""
+    best: List[tuple[float, int, Dict[str, Any]]] = []
+    cases = 0
+    for name in sorted(os.listdir(directory)):
+        queries: Dict[str, Dict[str, List[float]]] = {}
+        with open(os.path.join(directory, name), encoding="utf-8") as handle:
+            for line in handle:
+                query, page, clicks, impressions, position = line.rstrip("\n").split("\t")
+                stats = queries.setdefault(query, {}).setdefault(page, [0.0, 0.0, 0.0])
+                stats[0] += float(clicks)
+                stats[1] += float(impressions)
+                stats[2] += float(position) * float(impressions)
+        for query, pages in queries.items():
+            if len(pages) < 2:
+                continue
+            case = _score_query(query, pages, min_impressions)
+            if case is None:
+                continue
+            cases += 1
+            entry = (case["severity"], cases, case)
+            if len(best) < top_n:
+                heapq.heappush(best, entry)
+            else:
+                heapq.heappushpop(best, entry)
+    return [entry[2] for entry in sorted(best, reverse=True)], cases
+
+
+def cannibalization_report(
+    site_url: str, start_date: str, end_date: str, top_n: int = 20, min_impressions: float = 50
+) -> Dict[str, Any]:
+    """Stream paginated GSC query x page rows through disk buckets and rank cannibalized queries."""
+    if not site_url:
+        return {"warning": "GSC site URL is not configured. Skipping cannibalization report."}
+    cache_key = ConnectorCache.make_key("cannibalization", site_url, start_date, end_date, top_n, min_impressions)
+    cached = CONNECTOR_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+    with tempfile.TemporaryDirectory(prefix="gsc-cannibalization-") as directory:
+        rows = _spill_query_pages(iter_gsc_rows(site_url, start_date, end_date, ["query", "page"]), directory)
+        cases, total = _scan_buckets(directory, top_n, min_impressions)
+    report = {
+        "window": [start_date, end_date],
+        "rows_scanned": rows,
+        "cannibalized_queries": total,
+        "cases": cases,
+        "note": "severity = (1 - 表示回数シェアの HHI) × log(1 + 表示回数) × (1 + クリック分散度)。pages は表示回数シェア 10% 以上の上位4件。",
+    }
+    CONNECTOR_CACHE.set(cache_key, report, derived=True)
+    return report
+
+
+# ====== 期間比較エンジン ======
+# 生の指標列: GA4（pv, sessions）と GSC（clicks, impressions, 表示回数で重み付けした掲載順位）
+_DELTA_COLUMNS = ["pv", "sessions", "clicks", "impressions", "position_weighted"]
+_GA4_COLUMNS = slice(0, 2)
+_GSC_COLUMNS = slice(2, 5)
+
+
+def _comparison_windows(start_date: str, end_date: str) -> Dict[str, tuple[str, str]]:
+    start, end = date.fromisoformat(start_date), date.fromisoformat(end_date)
+    span = end - start
+    previous_end = start - timedelta(days=1)
+
+    def year_before(day: date) -> date:
+        try:
+            return day.replace(year=day.year - 1)
+        except ValueError:  # 2/29
+            return day.replace(year=day.year - 1, day=28)
+
+    return {
+        "current": (start.isoformat(), end.isoformat()),
+        "previous": ((previous_end - span).isoformat(), previous_end.isoformat()),
+        "yoy": (year_before(start).isoformat(), year_before(end).isoformat()),
+    }
+
+
+def _outer_join(parts: List[tuple[np.ndarray, np.ndarray, slice]], width: int) -> tuple[np.ndarray, np.ndarray]:
+    """Place each (unique keys, values, column slice) part on the union of keys."""
+    keys = np.concatenate([part[0] for part in parts]) if parts else np.array([], dtype=str)
+    unique, inverse = np.unique(keys, return_inverse=True)
+    joined = np.zeros((len(unique), width))
+    offset = 0
+    for part_keys, values, columns in parts:
+        joined[inverse[offset : offset + len(part_keys)], columns] = values
+        offset += len(part_keys)
+    return unique, joined
+
+
+def _keyed_matrix(frame: MetricFrame, dim: str, metrics: List[str]) -> tuple[np.ndarray, np.ndarray]:
+    grouped = frame.group_by(dim, metrics=metrics)
+    return grouped.label(dim), np.column_stack([grouped.metrics[name] for name in metrics])
+
+
+def _period_frame(
+    ga4_payload: Dict[str, Any], gsc_payload: Dict[str, Any], dimension: str
+) -> tuple[np.ndarray, np.ndarray]:
+    parts: List[tuple[np.ndarray, np.ndarray, slice]] = []
+    if dimension == "page" and ga4_payload.get("rows"):
+        ga4 = MetricFrame.from_ga4(ga4_payload).map_dimension("pagePath", normalize_url_key)
+        parts.append((*_keyed_matrix(ga4, "pagePath", ["screenPageViews", "sessions"]), _GA4_COLUMNS))
+    if gsc_payload.get("rows"):
+        gsc = MetricFrame.from_gsc(gsc_payload, [dimension])
+        if dimension == "page":
+            gsc = gsc.map_dimension("page", normalize_url_key)
+        gsc = gsc.with_metrics(position_weighted=gsc.metrics["position"] * gsc.metrics["impressions"])
+        parts.append((*_keyed_matrix(gsc, dimension, ["clicks", "impressions", "position_weighted"]), _GSC_COLUMNS))
+    return _outer_join(parts, len(_DELTA_COLUMNS))
+
+
+def _derived_metrics(raw: np.ndarray) -> Dict[str, np.ndarray]:
+    impressions = raw[..., 3]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ctr = np.where(impressions > 0, raw[..., 2] / impressions, np.nan)
+        position = np.where(impressions > 0, raw[..., 4] / impressions, np.nan)
+    return {
+        "pv": raw[..., 0],
+        "sessions": raw[..., 1],
+        "clicks": raw[..., 2],
+        "impressions": impressions,
+        "ctr": ctr,
+        "position": position,
+    }
+
+
+def compute_period_deltas(
+    current: tuple[np.ndarray, np.ndarray],
+    baseline: tuple[np.ndarray, np.ndarray],
+    *,
+    metrics: List[str],
+    rank_metric: str,
+    top_n: int,
+) -> Dict[str, Any]:
+    """Compare two keyed period frames and rank the biggest movers by rank_metric."""
+    keys, joined = _outer_join(
+        [(current[0], current[1], slice(0, 5)), (baseline[0], baseline[1], slice(5, 10))], 10
+    )
+    now = _derived_metrics(joined[:, :5])
+    before = _derived_metrics(joined[:, 5:])
+    delta = {name: now[name] - before[name] for name in metrics}
+
+    totals_now = _derived_metrics(joined[:, :5].sum(axis=0))
+    totals_before = _derived_metrics(joined[:, 5:].sum(axis=0))
+    totals: Dict[str, Any] = {}
+    for name in metrics:
+        digits = 4 if name == "ctr" else 2
+        change = totals_now[name] - totals_before[name]
+        totals[name] = {
+            "current": _json_number(totals_now[name], digits),
+            "baseline": _json_number(totals_before[name], digits),
+            "delta": _json_number(change, digits),
+            "pct": _json_number(change / totals_before[name], 4) if totals_before[name] else None,
+        }
+
+    def rows(indices: np.ndarray) -> List[Dict[str, Any]]:
+        out: List[Dict[str, Any]] = []
+        for i in indices:
+            row: Dict[str, Any] = {"key": str(keys[i])}
+            for name in metrics:
+                if np.isnan(now[name][i]) and np.isnan(before[name][i]):
+                    continue
+                digits = 4 if name == "ctr" else 2
+                row[name] = _json_number(now[name][i], digits)
+                row[f"{name}_prev"] = _json_number(before[name][i], digits)
+                row[f"{name}_delta"] = _json_number(delta[name][i], digits)
+            base = before[rank_metric][i]
+            row[f"{rank_metric}_pct"] = _json_number(delta[rank_metric][i] / base, 4) if base else None
+            out.append(row)
+        return out
+
+    score = np.nan_to_num(delta[rank_metric])
+    gainers = np.flatnonzero(score > 0)
+    decliners = np.flatnonzero(score < 0)
+    if len(gainers) > top_n:
+        gainers = gainers[np.argpartition(-score[gainers], top_n - 1)[:top_n]]
+    if len(decliners) > top_n:
+        decliners = decliners[np.argpartition(score[decliners], top_n - 1)[:top_n]]
+    return {
+        "rows_compared": int(len(keys)),
+        "totals": totals,
+        "top_gainers": rows(gainers[np.argsort(-score[gainers], kind="stable")]),
+        "top_decliners": rows(decliners[np.argsort(score[decliners], kind="stable")]),
+    }
+
+
+async def period_over_period(
+    ga4_property_id: str,
+    gsc_site_url: str,
+    start_date: str,
+    end_date: str,
+    dimension: str,
+    top_n: int,
+) -> Dict[str, Any]:
+    windows = _comparison_windows(start_date, end_date)
+    warnings: List[str] = []
+
+    async def fetch(backend: str, func: Callable[..., Any], *args: Any) -> Dict[str, Any]:
+        try:
+            payload = await _run_connector(backend, func, *args)
+        except Exception as exc:
+            warnings.append(f"{backend} {args[1]}〜{args[2]}: {type(exc).__name__}: {exc}")
+            return {}
+        if payload.get("warning"):
+            warnings.append(payload["warning"])
+        return payload
+
+    jobs: List[Awaitable[Dict[str, Any]]] = []
+    for window_start, window_end in windows.values():
+        if dimension == "page" and ga4_property_id:
+            jobs.append(fetch("ga4", ga4_report_pages, ga4_property_id, window_start, window_end))
+        else:
+            jobs.append(asyncio.sleep(0, {}))
+        if gsc_site_url:
+            jobs.append(fetch("gsc", gsc_query, gsc_site_url, window_start, window_end, [dimension]))
+        else:
+            jobs.append(asyncio.sleep(0, {}))
+    payloads = await asyncio.gather(*jobs)
+    frames = {
+        name: _period_frame(payloads[2 * i], payloads[2 * i + 1], dimension) for i, name in enumerate(windows)
+    }
+
+    metrics = ["clicks", "impressions", "ctr", "position"] if gsc_site_url else []
+    if dimension == "page" and ga4_property_id:
+        metrics = ["pv", "sessions"] + metrics
+    if not metrics:
+        return {"warning": "GA4/GSC が未設定のため期間比較できません。"}
+    rank_metric = "pv" if "pv" in metrics else "clicks"
+    return {
+        "dimension": dimension,
+        "windows": windows,
+        "rank_metric": rank_metric,
+        "note": "position_delta が負なら掲載順位は改善。ctr は 0〜1。",
+        "comparisons": {
+            name: compute_period_deltas(
+                frames["current"], frames[name], metrics=metrics, rank_metric=rank_metric, top_n=top_n
+            )
+            for name in ("previous", "yoy")
+        },
+        "warnings": warnings,
+    }
+
+
+# ====== 異常検知 ======
+ANOMALY_Z_THRESHOLD = 3.5
+ANOMALY_MIN_DAILY_MEAN = 5.0
+_MAD_SCALE = 1.4826  # 正規分布で MAD を標準偏差相当に換算する係数
+
+
+def _window_days(start_date: str, end_date: str) -> List[date]:
+    start, end = date.fromisoformat(start_date), date.fromisoformat(end_date)
+    return [start + timedelta(days=offset) for offset in range((end - start).days + 1)]
+
+
+def detect_anomalies(
+    frame: MetricFrame,
+    metric: str,
+    by: Sequence[str],
+    *,
+    time_dim: str,
+    days: List[date],
+    date_format: str,
+    source: str,
+    threshold: float = ANOMALY_Z_THRESHOLD,
+    min_daily_mean: float = ANOMALY_MIN_DAILY_MEAN,
+) -> List[Dict[str, Any]]:
+    """Flag days whose value departs from the series' robust baseline.
+
+    The baseline is the median of the same weekday when the window covers at
+    least four weeks, otherwise the median of the whole window; the spread is
+    the scaled MAD, floored at sqrt(baseline) so that low-volume series are not
+    dominated by counting noise.
+    """
+    if not len(frame) or not days:
+        return []
+    groups, matrix = frame.dense_series(
+        metric, by, time_dim=time_dim, periods=[day.strftime(date_format) for day in days]
+    )
+    # GSC は数日遅れで確定するため、末尾の未集計日を急減と誤検知しないよう切り落とす
+    observed = np.flatnonzero(matrix.sum(axis=0) > 0)
+    if not len(observed):
+        return []
+    days = days[: observed[-1] + 1]
+    matrix = matrix[:, : observed[-1] + 1]
+    active = matrix.mean(axis=1) >= min_daily_mean
+    matrix = matrix[active]
+    if not len(matrix):
+        return []
+
+    baseline = np.empty_like(matrix)
+    spread = np.empty_like(matrix)
+    weekdays = np.array([day.weekday() for day in days])
+    buckets = [weekdays == weekday for weekday in range(7)] if len(days) >= 28 else [np.ones(len(days), dtype=bool)]
+    for columns in buckets:
+        median = np.median(matrix[:, columns], axis=1, keepdims=True)
+        mad = np.median(np.abs(matrix[:, columns] - median), axis=1, keepdims=True)
+        baseline[:, columns] = median
+        spread[:, columns] = np.maximum(_MAD_SCALE * mad, np.sqrt(np.maximum(median, 1.0)))
+    score = (matrix - baseline) / spread
+
+    rows, cols = np.nonzero(np.abs(score) >= threshold)
+    group_rows = np.flatnonzero(active)[rows]
+    labels = {dim: groups.labels[dim][groups.codes[dim][group_rows]] for dim in by}
+    anomalies: List[Dict[str, Any]] = []
+    for i, (row, col) in enumerate(zip(rows, cols)):
+        value, expected = matrix[row, col], baseline[row, col]
+        anomalies.append(
+            {
+                "source": source,
+                "metric": metric,
+                **{dim: str(labels[dim][i]) for dim in by},
+                "date": days[col].isoformat(),
+                "direction": "spike" if value > expected else "drop",
+                "value": round(float(value), 2),
+                "baseline": round(float(expected), 2),
+                "delta": round(float(value - expected), 2),
+                "pct": round(float((value - expected) / expected), 4) if expected else None,
+                "z": round(float(score[row, col]), 2),
+            }
+        )
+    return anomalies
+
+
+async def traffic_anomalies(
+    ga4_property_id: str,
+    gsc_site_url: str,
+    start_date: str,
+    end_date: str,
+    top_n: int = 20,
+) -> Dict[str, Any]:
+    """Rank GA4 (channel, page) and GSC (query, page) daily anomalies in the window.
+
+    Each series comes from its own date x dimension report (GSC paginated),
+    since rows missing from a row-capped report read as zero and would show
+    up as drops. Inputs that were still capped are listed under ``truncated``.
+    """
+    cache_key = ConnectorCache.make_key("traffic_anomalies", ga4_property_id, gsc_site_url, start_date, end_date)
+    cached = CONNECTOR_CACHE.get(cache_key)
+    if cached is None:
+        # 当日分は集計途中なので検知対象から外す
+        days = [day for day in _window_days(start_date, end_date) if day < datetime.now(UTC).date()]
+        ga4_series = {"sessionDefaultChannelGroup": "by_channel", "pagePath": "by_page"}
+        jobs: List[Awaitable[Any]] = []
+        if ga4_property_id:
+            specs = [
+                Ga4ReportSpec(
+                    name=name, dimensions=["date", dim], metrics=["sessions"], order_by_metric="sessions", limit=25000
+                )
+                for dim, name in ga4_series.items()
+            ]
+            jobs.append(_run_connector("ga4", ga4_batch_reports, ga4_property_id, start_date, end_date, specs))
+        if gsc_site_url:
+            for dimension in ("query", "page"):
+                jobs.append(
+                    _run_connector("gsc", gsc_query_all, gsc_site_url, start_date, end_date, ["date", dimension])
+                )
+        payloads = await asyncio.gather(*jobs, return_exceptions=True)
+        anomalies: List[Dict[str, Any]] = []
+        warnings: List[str] = []
+        truncated: List[str] = []
+        for payload in payloads:
+            if isinstance(payload, BaseException):
+                warnings.append(f"{type(payload).__name__}: {payload}")
+            elif payload.get("warning"):
+                warnings.append(payload["warning"])
+        complete = not warnings
+        payloads = [payload if isinstance(payload, dict) else {} for payload in payloads]
+        if ga4_property_id:
+            reports = payloads.pop(0).get("reports") or {}
+            for dim, name in ga4_series.items():
+                report = reports.get(name) or {}
+                if report.get("row_count", 0) > len(report.get("rows") or []):
+                    truncated.append(f"ga4:{dim}")
+                ga4 = MetricFrame.from_ga4(report)
+                anomalies += detect_anomalies(
+                    ga4, "sessions", [dim], time_dim="date", days=days, date_format="%Y%m%d", source="ga4"
+                )
+        if gsc_site_url:
+            for dimension, payload in zip(("query", "page"), payloads):
+                if payload.get("truncated"):
+                    truncated.append(f"gsc:{dimension}")
+                gsc = MetricFrame.from_gsc(payload, ["date", dimension])
+                anomalies += detect_anomalies(
+                    gsc, "clicks", [dimension], time_dim="date", days=days, date_format="%Y-%m-%d", source="gsc"
+                )
+        if truncated:
+            warnings.append(
+                f"行数上限で切り捨てられた入力があります（{', '.join(truncated)}）。"
+                "少量の系列では欠けた日が 0 と扱われ、急減が過大に出ることがあります。"
+            )
+        anomalies.sort(key=lambda anomaly: abs(anomaly["z"]), reverse=True)
+        cached = {"window": [start_date, end_date], "anomalies": anomalies, "warnings": warnings, "truncated": truncated}
+        if complete:
+            CONNECTOR_CACHE.set(cache_key, cached, derived=True)
+    return {
+        "window": cached["window"],
+        "method": "robust z-score (same-weekday median/MAD when the window is 4+ weeks)",
+        "threshold": ANOMALY_Z_THRESHOLD,
+        "total": len(cached["anomalies"]),
+        "anomalies": cached["anomalies"][:top_n],
+        "truncated": cached["truncated"],
+        "warnings": cached["warnings"],
+    }
+
+
+# ====== 大きなツール結果のディスク退避 ======
+_RESULT_PREVIEW_ROWS = 5
+_RESULT_TOP_VALUES = 5
+_RESULT_CELL_CHARS = 2000
+_RESULT_HANDLE_PATTERN = re.compile(r"^res_[0-9a-f]{16}$")
+
+
+def _flatten_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    # WordPress の {"title": {"rendered": ...}} のような1段の入れ子は "title.rendered" 列にする
+    flat: Dict[str, Any] = {}
+    for key, value in record.items():
+        if isinstance(value, dict):
+            for inner_key, inner_value in value.items():
+                flat[f"{key}.{inner_key}"] = inner_value
+        else:
+            flat[key] = value
+    return flat
+
+
+def _result_table(output: Any, arguments: Dict[str, Any]) -> Optional[tuple[Dict[str, List[Any]], set[str]]]:
+    """(columns, numeric column names) for a GA4 report, a GSC response or a list of records; None otherwise."""
+    if isinstance(output, str):
+        try:
+            output = json.loads(output)
+        except json.JSONDecodeError:
+            return None
+    if isinstance(output, dict) and {"dimension_headers", "metric_headers", "rows"} <= output.keys():
+        dims, mets = output["dimension_headers"], output["metric_headers"]
+        names = dims + mets
+        rows = output["rows"] or []
+        columns = {name: [row[i] for row in rows] for i, name in enumerate(names)}
+        return columns, set(mets)
+    if isinstance(output, dict) and isinstance(output.get("rows"), list) and all(
+        isinstance(row, dict) and "keys" in row for row in output["rows"]
+    ):
+        rows = output["rows"]
+        width = max((len(row["keys"]) for row in rows), default=0)
+        dims = list(arguments.get("dimensions") or [])[:width]
+        dims += [f"key_{i}" for i in range(len(dims), width)]
+        columns = {name: [row["keys"][i] if i < len(row["keys"]) else None for row in rows] for i, name in enumerate(dims)}
+        metrics = [name for name in ("clicks", "impressions", "ctr", "position") if any(name in row for row in rows)]
+        for name in metrics:
+            columns[name] = [row.get(name) for row in rows]
+        return columns, set(metrics)
+    if isinstance(output, list) and output and all(isinstance(record, dict) for record in output):
+        records = [_flatten_record(record) for record in output]
+        names = list(dict.fromkeys(key for record in records for key in record))
+        columns = {name: [record.get(name) for record in records] for name in names}
+        numeric = {
+            name
+            for name, values in columns.items()
+            if any(value is not None for value in values)
+            and all(value is None or (isinstance(value, (int, float)) and not isinstance(value, bool)) for value in values)
+        }
+        return columns, numeric
+    return None
+
+
+def _text_cell(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return value
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+def _clip(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[:limit] + "…"
+
+
+class ResultTable:
+    """A spilled tool result opened read-only: numeric columns and dictionary codes are memory-mapped.
+
+    Text columns are dictionary-encoded with sorted labels, so code order is
+    lexicographic order; the labels themselves live in one UTF-8 blob plus an
+    offsets array and are decoded only when a filter or a returned row needs them.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.rows: int = self.meta["rows"]
+        self.kinds: Dict[str, str] = {column["name"]: column["kind"] for column in self.meta["columns"]}
+        self._files = {column["name"]: column["file"] for column in self.meta["columns"]}
+        self._labels: Dict[str, List[str]] = {}
+
+    def values(self, name: str) -> np.ndarray:
+        """float64 values of a numeric column, or int32 label codes of a text column."""
+        suffix = ".npy" if self.kinds[name] == "number" else ".codes.npy"
+        return np.load(os.path.join(self.path, self._files[name] + suffix), mmap_mode="r")
+
+    def labels(self, name: str) -> List[str]:
+        labels = self._labels.get(name)
+        if labels is None:
+            base = os.path.join(self.path, self._files[name])
+            offsets = np.load(base + ".offsets.npy")
+            blob = np.memmap(base + ".labels", dtype=np.uint8, mode="r") if offsets[-1] else np.empty(0, np.uint8)
+            labels = self._labels[name] = [
+                bytes(blob[start:end]).decode("utf-8") for start, end in zip(offsets[:-1], offsets[1:])
+            ]
+        return labels
+
+    def cell(self, name: str, row: int) -> Any:
+        value = self.values(name)[row]
+        if self.kinds[name] == "number":
+            if np.isnan(value):
+                return None
+            return int(value) if float(value).is_integer() else _json_number(value, 4)
+        return _clip(self.labels(name)[value], _RESULT_CELL_CHARS)
+
+
+class ResultStore:
+    """Large tabular tool results spilled to per-handle column files under ``root``.
+
+    A result whose JSON exceeds ``inline_chars`` is written once (the handle is
+    a digest of tool, arguments and output, so repeats reuse it) and the model
+    gets the handle with a schema, per-column statistics and a few preview rows
+    instead of the rows; ``tool_result_slice`` reads back only what it asks for.
+    Off unless RESULT_INLINE_CHARS is set. Handles untouched for ``ttl``
+    seconds are pruned at startup, and the least recently used ones whenever
+    the directory grows past ``max_bytes``.
+    """
+
+    def __init__(self, root: str, inline_chars: int, ttl: float, max_bytes: int = 0) -> None:
+        self.root = root
+        self.inline_chars = inline_chars
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._open: Dict[str, ResultTable] = {}
+        self._lock = threading.Lock()
+        self._stored_bytes: Optional[int] = None  # prune() で数え、以後は書き込み分を加算
+
+    @property
+    def enabled(self) -> bool:
+        return self.inline_chars > 0
+
+    def configure(
+        self,
+        root: Optional[str] = None,
+        inline_chars: Optional[int] = None,
+        ttl: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+    ) -> None:
+        if root is not None:
+            self.root = root
+            self._stored_bytes = None
+        if inline_chars is not None:
+            self.inline_chars = inline_chars
+        if ttl is not None:
+            self.ttl = ttl
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+
+    def spill(self, tool_name: str, arguments_json: str, output: Any) -> Any:
+        """Return ``output`` unchanged if small or not tabular, else its handle summary."""
+        if not self.enabled or _is_tool_error(output):
+            return output
+        text = output if isinstance(output, str) else json.dumps(output, ensure_ascii=False, default=str)
+        if len(text) <= self.inline_chars:
+            return output
+        try:
+            arguments = json.loads(arguments_json or "{}")
+        except json.JSONDecodeError:
+            arguments = {}
+        if isinstance(output, dict) and isinstance(output.get("reports"), dict):
+            # tool_ga4_batch_report はレポート単位で退避する
+            reports = {
+                name: self.spill(f"{tool_name}:{name}", arguments_json, report)
+                for name, report in output["reports"].items()
+            }
+            return {**output, "reports": reports}
+        table = _result_table(output, arguments if isinstance(arguments, dict) else {})
+        if table is None or not table[0]:
+            return output
+        digest = hashlib.sha256(
+            "\0".join([tool_name, _canonical_tool_arguments(arguments_json), text]).encode("utf-8")
+        ).hexdigest()
+        handle = f"res_{digest[:16]}"
+        self._write(handle, tool_name, arguments, *table)
+        return self.describe(handle)
+
+    def _write(self, handle: str, tool_name: str, arguments: Any, columns: Dict[str, List[Any]], numeric: set[str]) -> None:
+        path = os.path.join(self.root, handle)
+        if os.path.isdir(path):
+            os.utime(path)
+            return
+        os.makedirs(self.root, exist_ok=True)
+        staging = tempfile.mkdtemp(dir=self.root, prefix=".tmp-")
+        meta_columns = []
+        try:
+            for i, (name, values) in enumerate(columns.items()):
+                file = f"c{i}"
+                base = os.path.join(staging, file)
+                if name in numeric:
+                    array = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+                    np.save(base + ".npy", array)
+                    meta_columns.append({"name": name, "kind": "number", "file": file})
+                    continue
+                cells = [_text_cell(value) for value in values]
+                labels = sorted(set(cells))
+                index = {label: code for code, label in enumerate(labels)}
+                np.save(base + ".codes.npy", np.fromiter((index[cell] for cell in cells), dtype=np.int32, count=len(cells)))
+                encoded = [label.encode("utf-8") for label in labels]
+                np.save(base + ".offsets.npy", np.concatenate([[0], np.cumsum([len(b) for b in encoded], dtype=np.int64)]))
+                with open(base + ".labels", "wb") as f:
+                    f.write(b"".join(encoded))
+                meta_columns.append({"name": name, "kind": "text", "file": file})
+            meta = {
+                "handle": handle,
+                "tool": tool_name,
+                "arguments": arguments,
+                "created": datetime.now(UTC).isoformat(timespec="seconds"),
+                "rows": len(next(iter(columns.values()))),
+                "columns": meta_columns,
+            }
+            with open(os.path.join(staging, "meta.json"), "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+            written = _directory_size(staging)
+            os.rename(staging, path)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+            if not os.path.isdir(path):  # 同じ結果を並行して書いた側が先に rename した場合は成功扱い
+                raise
+            return
+        if self.max_bytes > 0:
+            with self._lock:
+                if self._stored_bytes is not None:
+                    self._stored_bytes += written
+                over = self._stored_bytes is None or self._stored_bytes > self.max_bytes
+            if over:
+                with contextlib.suppress(OSError):
+                    self.prune(keep={handle})
+
+    def open(self, handle: str) -> ResultTable:
+        if not _RESULT_HANDLE_PATTERN.match(handle):
+            raise KeyError(handle)
+        with self._lock:
+            table = self._open.get(handle)
+            if table is None:
+                path = os.path.join(self.root, handle)
+                if not os.path.isdir(path):
+                    raise KeyError(handle)
+                if len(self._open) >= 16:
+                    self._open.pop(next(iter(self._open)))
+                table = self._open[handle] = ResultTable(path)
+            return table
+
+    def describe(self, handle: str) -> Dict[str, Any]:
+        table = self.open(handle)
+        schema: List[Dict[str, Any]] = []
+        for name, kind in table.kinds.items():
+            values = table.values(name)
+            if kind == "number":
+                present = values[~np.isnan(values)]
+                stats = (
+                    {
+                        "min": _json_number(present.min(), 4),
+                        "max": _json_number(present.max(), 4),
+                        "mean": _json_number(present.mean(), 4),
+                        "sum": _json_number(present.sum(), 4),
+                    }
+                    if len(present)
+                    else {}
+                )
+                schema.append({"name": name, "type": "number", "nulls": int(len(values) - len(present)), **stats})
+            else:
+                labels = table.labels(name)
+                counts = np.bincount(values, minlength=len(labels))
+                top = np.argsort(-counts, kind="stable")[:_RESULT_TOP_VALUES]
+                schema.append(
+                    {
+                        "name": name,
+                        "type": "text",
+                        "distinct": len(labels),
+                        "top": [[_clip(labels[code], 80), int(counts[code])] for code in top if counts[code]],
+                    }
+                )
+        preview = [
+            {
+                name: _clip(cell, 200) if isinstance(cell := table.cell(name, row), str) else cell
+                for name in table.kinds
+            }
+            for row in range(min(table.rows, _RESULT_PREVIEW_ROWS))
+        ]
+        return {
+            "handle": handle,
+            "tool": table.meta["tool"],
+            "rows": table.rows,
+            "columns": schema,
+            "preview": preview,
+            "note": "結果が大きいためディスクに退避しました。行は tool_result_slice(handle=...) で列・条件・並び順を指定して取得してください。",
+        }
+
+    def slice(
+        self,
+        handle: str,
+        columns: Optional[Sequence[str]],
+        filters: Sequence[tuple[str, str, str]],
+        sort_by: Optional[str],
+        descending: bool,
+        offset: int,
+        limit: int,
+    ) -> Dict[str, Any]:
+        table = self.open(handle)
+        selected = list(columns or table.kinds)
+        unknown = [name for name in [*selected, *(f[0] for f in filters), *([sort_by] if sort_by else [])] if name not in table.kinds]
+        if unknown:
+            raise ValueError(f"unknown columns {unknown}; available: {list(table.kinds)}")
+        mask = np.ones(table.rows, dtype=bool)
+        for name, op, value in filters:
+            mask &= self._filter_mask(table, name, op, value)
+        rows = np.flatnonzero(mask)
+        if sort_by:
+            values = np.asarray(table.values(sort_by))[rows]
+            if table.kinds[sort_by] == "number":
+                # 欠損値は昇順・降順とも末尾に置く
+                values = np.where(np.isnan(values), np.inf, -values if descending else values)
+            elif descending:
+                values = -values.astype(np.int64)
+            rows = rows[np.argsort(values, kind="stable")]
+        page = rows[offset : offset + limit]
+        return {
+            "handle": handle,
+            "matched": int(len(rows)),
+            "offset": offset,
+            "rows": [{name: table.cell(name, int(row)) for name in selected} for row in page],
+        }
+
+    @staticmethod
+    def _filter_mask(table: ResultTable, name: str, op: str, value: str) -> np.ndarray:
+        values = table.values(name)
+        if table.kinds[name] == "number":
+            try:
+                target = float(value)
+            except ValueError:
+                raise ValueError(f"column {name!r} is numeric; {value!r} is not a number") from None
+            compare = {
+                "eq": np.equal, "ne": np.not_equal, "gt": np.greater, "gte": np.greater_equal, "lt": np.less, "lte": np.less_equal,
+            }.get(op)
+            if compare is None:
+                raise ValueError(f"operator {op!r} does not apply to numeric column {name!r}")
+            return compare(values, target)
+        # テキスト列はラベル（重複なし）で判定してからコードへ展開する
+        labels = table.labels(name)
+        if op == "contains":
+            needle = value.casefold()
+            label_mask = [needle in label.casefold() for label in labels]
+        else:
+            predicate = {
+                "eq": lambda label: label == value,
+                "ne": lambda label: label != value,
+                "gt": lambda label: label > value,
+                "gte": lambda label: label >= value,
+                "lt": lambda label: label < value,
+                "lte": lambda label: label <= value,
+            }[op]
+            label_mask = [predicate(label) for label in labels]
+        return np.asarray(label_mask, dtype=bool)[values] if labels else np.zeros(table.rows, dtype=bool)
+
+    def prune(self, keep: Iterable[str] = ()) -> int:
+        """Remove expired handles, then the least recently used ones until the store fits in ``max_bytes``."""
+        if not os.path.isdir(self.root):
+            return 0
+        cutoff = time.time() - self.ttl if self.ttl > 0 else None
+        removed = 0
+        handles: List[tuple[float, int, str, str]] = []
+        for entry in os.scandir(self.root):
+            if not entry.is_dir():
+                continue
+            mtime = entry.stat().st_mtime
+            if cutoff is not None and mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+            else:
+                handles.append((mtime, _directory_size(entry.path), entry.name, entry.path))
+        total = sum(size for _, size, _, _ in handles)
+        if self.max_bytes > 0 and total > self.max_bytes:
+            with self._lock:
+                in_use = set(self._open).union(keep)
+            for _, size, name, path in sorted(handles):
+                if total <= self.max_bytes:
+                    break
+                if name in in_use:  # このプロセスで開いている・書いたばかりのハンドルは残す
+                    continue
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+                removed += 1
+        with self._lock:
+            self._stored_bytes = total
+        return removed
+
+
+def _directory_size(path: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+RESULT_STORE = ResultStore(
+    RESULT_STORE_DIR, RESULT_INLINE_CHARS, RESULT_HANDLE_TTL, max_bytes=int(RESULT_STORE_MAX_MB * 2**20)
+)
+
+
+class ResultFilter(BaseModel):
+    column: str = Field(description="列名")
+    op: Literal["eq", "ne", "contains", "gt", "gte", "lt", "lte"] = Field(description="比較演算子（contains はテキスト列の部分一致）")
+    value: str = Field(description="比較する値（数値列も文字列で指定）")
+
+
+# ====== Agents SDK ツール ======
+@function_tool
+async def tool_ga4_report(
+    ctx: RunContextWrapper[Any], property_id: Optional[str], start_date: str, end_date: str
+) -> Dict[str, Any]:
+    """GA4: PV/セッション推移レポート（読み取り）"""
+    property_id = property_id or getattr(ctx.context, "ga4_property_id", "") or GA4_PROPERTY_ID
+    return await _run_connector("ga4", ga4_report_pages, property_id, start_date, end_date)
+
+
+@function_tool
+async def tool_ga4_batch_report(
+    ctx: RunContextWrapper[Any],
+    property_id: Optional[str],
+    start_date: str,
+    end_date: str,
+    reports: List[Ga4ReportSpec],
+) -> Dict[str, Any]:
+    """GA4: 複数の切り口（ページ別・チャネル別・日別・ランディングページ別など）を1回でまとめて取得（読み取り）。最大10件"""
+    property_id = property_id or getattr(ctx.context, "ga4_property_id", "") or GA4_PROPERTY_ID
+    if not reports or len(reports) > 2 * GA4_BATCH_SIZE:
+        return {"error": f"reports は1〜{2 * GA4_BATCH_SIZE}件で指定してください。"}
+    return await _run_connector("ga4", ga4_batch_reports, property_id, start_date, end_date, reports)
+
+
+@function_tool
+async def tool_gsc_query(
+    ctx: RunContextWrapper[Any], site_url: str, start_date: str, end_date: str, dimensions: List[str]
+) -> Dict[str, Any]:
+    """GSC: クエリ/ページ別 指標取得（読み取り）"""
+    site_url = site_url or getattr(ctx.context, "gsc_site_url", "")
+    return await _run_connector("gsc", gsc_query, site_url, start_date, end_date, dimensions)
+
+
+@function_tool
+async def tool_ga4_summary(
+    ctx: RunContextWrapper[Any], property_id: Optional[str], start_date: str, end_date: str, top_n: int = 10
+) -> Dict[str, Any]:
+    """GA4: チャネル別シェア・日次推移（7日移動平均）・ページ別PV分布と上位ページの要約（読み取り）。生の行が不要な場合はこちらを使う"""
+    property_id = property_id or getattr(ctx.context, "ga4_property_id", "") or GA4_PROPERTY_ID
+    payload = await _run_connector("ga4", ga4_report_pages, property_id, start_date, end_date)
+    if payload.get("warning"):
+        return payload
+    return summarize_ga4_traffic(payload, max(1, min(top_n, 50)))
+
+
+@function_tool
+async def tool_period_deltas(
+    ctx: RunContextWrapper[Any],
+    start_date: str,
+    end_date: str,
+    dimension: Literal["page", "query"] = "page",
+    top_n: int = 10,
+) -> Dict[str, Any]:
+    """期間比較: 対象期間を前期間・前年同期間と比較し、ページ/クエリ別の増減（PV・セッション・クリック・CTR・掲載順位）と上昇/下降トップを返す（読み取り）"""
+    return await period_over_period(
+        getattr(ctx.context, "ga4_property_id", "") or GA4_PROPERTY_ID,
+        getattr(ctx.context, "gsc_site_url", ""),
+        start_date,
+        end_date,
+        dimension,
+        max(1, min(top_n, 50)),
+    )
+
+
+@function_tool
+async def tool_traffic_anomalies(
+    ctx: RunContextWrapper[Any], start_date: str, end_date: str, top_n: int = 20
+) -> Dict[str, Any]:
+    """異常検知: GA4（チャネル別・ページ別セッション）と GSC（クエリ別・ページ別クリック）の日次系列から、急増/急減した日を外れ度の高い順に返す（読み取り）"""
+    return await traffic_anomalies(
+        getattr(ctx.context, "ga4_property_id", "") or GA4_PROPERTY_ID,
+        getattr(ctx.context, "gsc_site_url", ""),
+        start_date,
+        end_date,
+        max(1, min(top_n, 100)),
+    )
+
+
+@function_tool
+async def tool_article_metrics(
+    ctx: RunContextWrapper[Any],
+    start_date: str,
+    end_date: str,
+    urls: Optional[List[str]] = None,
+    limit: int = 20,
+) -> Dict[str, Any]:
+    """記事別指標: WordPress 記事（タイトル・更新日）と GA4（PV・セッション）・GSC（クリック・表示回数・CTR・掲載順位）を URL で結合した記事単位のレコードを返す。urls 指定時はその記事のみ（読み取り）"""
+    index, warnings = await article_index(ctx, start_date, end_date)
+    if urls:
+        articles = [index.lookup(url) or {"url_key": normalize_url_key(url), "missing": True} for url in urls]
+    else:
+        articles = sorted(index.articles(), key=_traffic_rank, reverse=True)[: max(1, min(limit, 50))]
+    orphans = sorted(index.orphans(), key=_traffic_rank, reverse=True)
+    return {
+        "window": [start_date, end_date],
+        "articles": articles,
+        "posts_indexed": len(index.articles()),
+        "posts_without_traffic": sum(1 for record in index.articles() if _traffic_rank(record) == (0.0, 0.0)),
+        "top_unmatched_urls": orphans[:5],
+        "warnings": warnings,
+    }
+
+
+@function_tool
+async def tool_competing_posts(
+    ctx: RunContextWrapper[Any], query: str, start_date: str, end_date: str, limit: int = 10
+) -> Dict[str, Any]:
+    """競合記事: クエリ（トピック）に対して競合・関連する自サイト記事を、ローカル索引（タイトル・スラッグ）と GSC の query×page 実績から返す。WordPress の search-posts より先にこちらを使う（読み取り）"""
+    warnings: List[str] = []
+    content_index = content_index_for(ctx.context)
+    listing: Optional[PostListing] = None
+    # 公開記事の全件一覧（run_context 毎に一度）で索引を埋める。
+    # 以後の get-posts / search-posts の結果も随時追加される
+    try:
+        listing = await published_posts(ctx)
+    except Exception as exc:
+        warnings.append(f"WordPress: {type(exc).__name__}: {exc}")
+    if listing is not None and not listing.complete:
+        warnings.append(
+            f"WordPress: 索引は公開記事のうち {len(listing.posts)} 件までです。見つからない記事は search-posts で確認する。"
+        )
+
+    candidates: Dict[str, Dict[str, Any]] = {}
+    for key, score in content_index.search(query, limit=max(1, min(limit, 50))):
+        candidates[key] = {**content_index.documents[key], "content_score": round(score, 3)}
+
+    gsc_site_url = getattr(ctx.context, "gsc_site_url", "")
+    if gsc_site_url:
+        try:
+            pages = (await gsc_query_pages(gsc_site_url, start_date, end_date)).get(_normalize_query(query), [])
+        except Exception as exc:
+            warnings.append(f"GSC: {type(exc).__name__}: {exc}")
+            pages = []
+        for page in pages:
+            record = candidates.setdefault(
+                page["content_key"],
+                dict(content_index.documents.get(page["content_key"], {"url_key": page["url_key"]})),
+            )
+            record.update(
+                gsc_clicks=page["clicks"], gsc_impressions=page["impressions"], gsc_position=page["position"]
+            )
+
+    ranked = sorted(
+        candidates.values(),
+        key=lambda record: (record.get("gsc_impressions", 0), record.get("content_score", 0.0)),
+        reverse=True,
+    )
+    return {
+        "query": query,
+        "ranking_pages": sum(1 for record in ranked if record.get("gsc_impressions")),
+        "posts": ranked[: max(1, min(limit, 50))],
+        "indexed_posts": len(content_index.documents),
+        "index_coverage": {
+            "published_posts_listed": len(listing.posts) if listing else 0,
+            "complete": bool(listing and listing.complete),
+        },
+        "warnings": warnings,
+    }
+
+
+@function_tool
+async def tool_cannibalization(
+    ctx: RunContextWrapper[Any], start_date: str, end_date: str, top_n: int = 20, min_impressions: int = 50
+) -> Dict[str, Any]:
+    """カニバリゼーション: GSC の query×page 全行から、複数ページが表示回数・クリックを分け合っているクエリを深刻度順に返す（読み取り）"""
+    return await _run_connector(
+        "gsc",
+        cannibalization_report,
+        getattr(ctx.context, "gsc_site_url", ""),
+        start_date,
+        end_date,
+        max(1, min(top_n, 100)),
+        max(0, min_impressions),
+    )
+
+
+@function_tool
+async def tool_result_slice(
+    handle: str,
+    columns: Optional[List[str]] = None,
+    filters: Optional[List[ResultFilter]] = None,
+    sort_by: Optional[str] = None,
+    descending: bool = True,
+    offset: int = 0,
+    limit: int = 50,
+) -> Dict[str, Any]:
+    """退避結果の取得: 大きすぎてハンドル（res_...）で返されたツール結果から、指定列・条件に合う行を並べ替えて offset から最大 limit 行（上限200）返す（読み取り）"""
+    try:
+        return await asyncio.to_thread(
+            RESULT_STORE.slice,
+            handle,
+            columns,
+            [(item.column, item.op, item.value) for item in filters or []],
+            sort_by,
+            descending,
+            max(0, offset),
+            max(1, min(limit, 200)),
+        )
+    except KeyError:
+        return {"error": f"ハンドル {handle} が見つかりません（期限切れの可能性）。元のツールを再実行してください。"}
+    except ValueError as exc:
+        return {"error": str(exc)}
+
+
+@function_tool
+async def tool_serpapi(q: str, num: int = 10, gl: str = "jp", hl: str = "ja") -> Dict[str, Any]:
+    """SerpAPI: Google SERP の取得（読み取り）"""
+    return await _run_connector("serpapi", serpapi_search, q, num, gl, hl)
+
+
+@function_tool
+async def tool_ahrefs_overview(
+    targets: List[str], top_keywords: int = 5, country: Optional[str] = None
+) -> Dict[str, Any]:
+    """Ahrefs: 複数のドメイン/URL（最大25件）について DR・被リンク数・参照ドメイン数・オーガニックキーワード数/流入と上位キーワードを並列取得し、比較用にまとめて返す（読み取り）。country は jp などの国コード（全体なら null）"""
+    try:
+        return await AHREFS.overview(targets, top_keywords=max(0, min(top_keywords, 20)), country=country or AHREFS_COUNTRY)
+    except ValueError as exc:
+        return {"error": str(exc)}
+
+
+# ====== エージェント構築 ======
+AGENT_INSTRUCTIONS = """
+あなたは社内マーケ部門のアナリストAIです。次を厳密に守ってください。
+- あなたは「読み取り専用」のツールだけを使います。CMS更新・公開・削除・API書き込み等は一切行いません。
+- WordPress MCPサーバー/GA4/GSC/SerpAPI/Ahrefsから得たデータを横断的に解釈し、「改善案（提案）」までを出力してください。
+- WordPressの情報はMCPアダプターが公開するツールのみを利用し、直接REST APIを呼び出さないでください。
+- 利用可能なツールが制限されている場合は、その範囲で分析し、不足データは「取得できない」旨を明示してください。
+- 出力は指定の構造（JSON）で返します。説明の冗長化は避け、要点と根拠を簡潔に。
+- 推奨KPI例：PV、セッション、CTR、平均掲載順位、流入チャネル別比率。
+- 前期間比・前年比の比較は tool_period_deltas を使い、2期間の生データを取得して手計算しないでください。
+- 「何が変わったか」を調べるときは、まず tool_traffic_anomalies で急増/急減した日と対象を特定してください。
+- 記事単位の指標は tool_article_metrics で取得し、WordPress・GA4・GSC の URL をプロンプト内で突き合わせないでください。
+- 関連・競合する記事を探すときは tool_competing_posts を使い、WordPress の検索ツールは索引にない記事を探す場合だけ使ってください。
+- キーワードのカニバリゼーション分析は tool_cannibalization を使ってください。
+- GA4 の複数の切り口が必要なときは tool_ga4_report を繰り返さず、tool_ga4_batch_report で1回にまとめてください。
+- WordPress 以外の MCP サーバー（Ahrefs や別サイトなど）のツール名は「サーバー名_」で始まります。自サイトの記事は先頭の WordPress サーバーのツールで調べてください。
+- 競合ドメインの比較では tool_ahrefs_overview に対象のドメイン/URL をまとめて渡し、1件ずつ呼び出さないでください。
+- ツール結果が大きいと行の代わりにハンドル（res_...）と列の統計・先頭行が返ります。必要な行は tool_result_slice で列・条件・上位N件を絞って取得し、元のツールを再実行しないでください。
+- 日本語で回答してください。
+"""
+
+
+def _canonical_tool_arguments(arguments_json: str) -> str:
+    try:
+        return json.dumps(json.loads(arguments_json or "{}"), ensure_ascii=False, sort_keys=True)
+    except json.JSONDecodeError:
+        return arguments_json
+
+
+def _with_connector_cache(tool: FunctionTool, backend: str = "wordpress", index_posts: bool = True) -> FunctionTool:
+    """Serve repeated MCP tool calls (same name and arguments) from CONNECTOR_CACHE."""
+    invoke = tool.on_invoke_tool
+
+    async def on_invoke_tool(ctx: Any, arguments_json: str) -> Any:
+        cache_key = ConnectorCache.make_key("mcp", tool.name, _canonical_tool_arguments(arguments_json))
+        cached = CONNECTOR_CACHE.get(cache_key)
+        if cached is not None:
+            return cached
+        async with BACKEND_LIMITER.slot(backend):
+            output = await invoke(ctx, arguments_json)
+        if index_posts:
+            _index_mcp_posts(getattr(ctx, "context", None), tool.name, output)
+        if not _is_tool_error(output):
+            CONNECTOR_CACHE.set(cache_key, output)
+        return output
+
+    return dataclasses.replace(tool, on_invoke_tool=on_invoke_tool)
+
+
+def _is_tool_error(output: Any) -> bool:
+    # agents_mcp は "Error (...)"、function_tool の既定エラーハンドラは "An error occurred ..." を返す
+    return isinstance(output, str) and output.startswith(("Error (", "An error occurred while running the tool"))
+
+
+class ToolCallCoalescer:
+    """Single-flight and memoization of identical tool calls within one run.
+
+    Concurrent calls with the same tool name and (canonical) arguments share
+    one in-flight invocation; later repeats get the memoized output. Errors
+    are not memoized, and the shared call is cancelled only when every caller
+    has given up on it.
+    """
+
+    def __init__(self) -> None:
+        self._calls: Dict[tuple[str, str], asyncio.Future[Any]] = {}
+        self._waiters: Counter[tuple[str, str]] = Counter()
+        self.coalesced = 0
+
+    async def call(self, name: str, arguments_json: str, invoke: Callable[[], Awaitable[Any]]) -> Any:
+        key = (name, _canonical_tool_arguments(arguments_json))
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = asyncio.ensure_future(invoke())
+        else:
+            self.coalesced += 1
+        self._waiters[key] += 1
+        try:
+            output = await asyncio.shield(call)
+        except asyncio.CancelledError:
+            if self._waiters[key] == 1 and not call.done():
+                call.cancel()
+                self._forget(key, call)
+            raise
+        except Exception:
+            self._forget(key, call)
+            raise
+        finally:
+            self._waiters[key] -= 1
+        if _is_tool_error(output):
+            self._forget(key, call)
+        return output
+
+    def _forget(self, key: tuple[str, str], call: asyncio.Future[Any]) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+
+class ToolDeadlines:
+    """Per-tool time limits: a default plus overrides matched by exact name or name suffix.
+
+    Suffix matching lets ``get-posts`` cover the server-prefixed MCP tool
+    name. A limit of 0 or less disables the deadline for that tool.
+    """
+
+    def __init__(self, default: float, overrides: Optional[Dict[str, float]] = None) -> None:
+        self.default = default
+        self.overrides = dict(overrides or {})
+
+    def configure(self, default: Optional[float] = None, overrides: Optional[Dict[str, float]] = None) -> None:
+        if default is not None:
+            self.default = default
+        if overrides is not None:
+            self.overrides.update(overrides)
+
+    def for_tool(self, name: str) -> Optional[float]:
+        timeout = self.overrides.get(name)
+        if timeout is None:
+            matches = [key for key in self.overrides if name.endswith(key)]
+            timeout = self.overrides[max(matches, key=len)] if matches else self.default
+        return timeout if timeout > 0 else None
+
+
+def _parse_tool_timeouts(raw: str) -> Dict[str, float]:
+    try:
+        return {name: float(value) for name, value in _parse_key_value_mapping(raw).items()}
+    except ValueError as exc:
+        raise ValueError(f"Invalid tool timeout in {raw!r}: {exc}") from exc
+
+
+TOOL_DEADLINES = ToolDeadlines(TOOL_TIMEOUT)
+
+
+def _with_deadline(tool: FunctionTool) -> FunctionTool:
+    timeout = TOOL_DEADLINES.for_tool(tool.name)
+    if timeout is None:
+        return tool
+    invoke = tool.on_invoke_tool
+
+    async def on_invoke_tool(ctx: Any, arguments_json: str) -> Any:
+        try:
+            return await asyncio.wait_for(invoke(ctx, arguments_json), timeout)
+        except TimeoutError:
+            # 同期コネクタのスレッドは止められないが、ターンはこの結果で先へ進める
+            return (
+                f"Error (timeout): {tool.name} が {timeout:g} 秒以内に応答しませんでした。"
+                "このデータなしで分析を続けるか、期間や件数を絞って再試行してください。"
+            )
+
+    return dataclasses.replace(tool, on_invoke_tool=on_invoke_tool)
+
+
+def _with_coalescing(tool: FunctionTool, coalescer: ToolCallCoalescer) -> FunctionTool:
+    invoke = tool.on_invoke_tool
+
+    async def on_invoke_tool(ctx: Any, arguments_json: str) -> Any:
+        return await coalescer.call(tool.name, arguments_json, lambda: invoke(ctx, arguments_json))
+
+    return dataclasses.replace(tool, on_invoke_tool=on_invoke_tool)
+
+
+def _with_result_handle(tool: FunctionTool, store: ResultStore) -> FunctionTool:
+    if tool.name == "tool_result_slice":
+        return tool
+    invoke = tool.on_invoke_tool
+
+    async def on_invoke_tool(ctx: Any, arguments_json: str) -> Any:
+        output = await invoke(ctx, arguments_json)
+        try:
+            return await asyncio.to_thread(store.spill, tool.name, arguments_json, output)
+        except OSError as exc:
+            print(f"[results] spill skipped: {type(exc).__name__}: {exc}", file=sys.stderr)
+            return output
+
+    return dataclasses.replace(tool, on_invoke_tool=on_invoke_tool)
+
+
+class MarketingAgent(Agent):
+    """agents_mcp Agent that loads MCP tools up front and caches their results.
+
+    agents_mcp loads MCP tools from the on_start hook, which the Runner calls
+    after it has already collected the tool list for the first model call.
+    The Runner passes the same RunContextWrapper on every turn of a run, so
+    the per-run ToolCallCoalescer is kept on it.
+
+    Each MCP server gets its own aggregator and all of them connect
+    concurrently, so startup costs the slowest server rather than the sum; a
+    server that fails or exceeds MCP_CONNECT_TIMEOUT is left out with a
+    warning. The first server is the site's WordPress: only its tools feed
+    the content index and the function tools' ``mcp_tools`` lookups.
+    """
+
+    async def load_mcp_tools(self, run_context: RunContextWrapper[Any], force: bool = False) -> None:
+        if not self.mcp_servers or (self._mcp_initialized and not force):
+            return
+        ensure_mcp_server_registry_in_context(run_context)
+        outcomes = await asyncio.gather(
+            *(self._connect_mcp_server(run_context, name) for name in self.mcp_servers), return_exceptions=True
+        )
+        self._mcp_aggregators: List[Any] = []
+        self._mcp_tool_servers: Dict[str, str] = {}
+        self.mcp_server_status: Dict[str, str] = {}
+        tools: List[Any] = []
+        for name, outcome in zip(self.mcp_servers, outcomes):
+            if isinstance(outcome, BaseException):
+                reason = "timeout" if isinstance(outcome, TimeoutError) else f"{type(outcome).__name__}: {outcome}"
+                self.mcp_server_status[name] = f"unavailable ({reason})"
+                print(f"[mcp] {self.name}: {name} を除外しました（{reason}）", file=sys.stderr)
+                continue
+            aggregator, server_tools = outcome
+            self._mcp_aggregators.append(aggregator)
+            self._mcp_tool_servers.update((tool.name, name) for tool in server_tools)
+            self.mcp_server_status[name] = f"{len(server_tools)} tools"
+            tools.extend(server_tools)
+        self._mcp_tools = tools
+        self.tools = self._openai_tools + tools
+        self._mcp_initialized = True
+
+    async def _connect_mcp_server(self, run_context: RunContextWrapper[Any], name: str) -> tuple[Any, List[Any]]:
+        aggregator = create_mcp_aggregator(
+            run_context, name=self.name, servers=[name], server_registry=self.mcp_server_registry
+        )
+        try:
+            async with asyncio.timeout(MCP_CONNECT_TIMEOUT if MCP_CONNECT_TIMEOUT > 0 else None):
+                await aggregator.__aenter__()
+                tools = await mcp_list_tools(aggregator)
+            if not tools:
+                # 接続・一覧取得の失敗はアグリゲーター内でログに落ちるだけなので、空なら失敗とみなす
+                raise RuntimeError("no tools listed")
+        except BaseException:
+            # 失敗した接続の後始末は数秒かかることがあり、起動をその分待たせない
+            closing = getattr(self, "_mcp_closing", None)
+            if closing is None:
+                closing = self._mcp_closing = set()
+            task = asyncio.ensure_future(aggregator.__aexit__(None, None, None))
+            closing.add(task)
+            task.add_done_callback(closing.discard)
+            raise
+        return aggregator, tools
+
+    async def cleanup_resources(self) -> None:
+        aggregators, self._mcp_aggregators = getattr(self, "_mcp_aggregators", []), []
+        for aggregator in aggregators:
+            with contextlib.suppress(Exception):
+                await aggregator.__aexit__(None, None, None)
+        await asyncio.gather(*getattr(self, "_mcp_closing", ()), return_exceptions=True)
+        await super().cleanup_resources()
+        self._mcp_initialized = False
+        self._mcp_tools = []
+
+    async def get_mcp_tools(self, run_context: RunContextWrapper[Any]) -> List[Any]:
+        # mcp_servers はサーバー名の一覧（agents_mcp 形式）で、MCP ツールは self.tools に統合済み。
+        # SDK 標準の MCPServer オブジェクト前提の経路には渡さない。
+        return []
+
+    async def get_all_tools(self, run_context: RunContextWrapper[Any]) -> List[Any]:
+        if self.mcp_servers and not self._mcp_initialized:
+            if CASSETTE.mode == "replay":
+                # 再生時は MCP サーバーへ接続せず、記録時のツール定義を使う
+                self._mcp_tools = CASSETTE.mcp_tools(self.name)
+                self.tools = self._openai_tools + self._mcp_tools
+                self._mcp_initialized = True
+            else:
+                await self.load_mcp_tools(run_context)
+                if CASSETTE.mode == "record":
+                    CASSETTE.record_mcp_tools(self.name, self._mcp_tools)
+        tools = await super().get_all_tools(run_context)
+        mcp_tool_names = {tool.name for tool in self._mcp_tools}
+        # カセット再生時はサーバー対応が無いので、すべて先頭（WordPress）のツールとして扱う
+        primary = self.mcp_servers[0] if self.mcp_servers else ""
+        tool_servers = getattr(self, "_mcp_tool_servers", {})
+        primary_tool_names = {name for name in mcp_tool_names if tool_servers.get(name, primary) == primary}
+        tools = [
+            _with_connector_cache(
+                tool,
+                # フリートではサイト毎に WordPress が別なので、上限もサーバー単位に持つ
+                backend=f"wordpress:{primary}" if tool.name in primary_tool_names else tool_servers[tool.name],
+                index_posts=tool.name in primary_tool_names,
+            )
+            if isinstance(tool, FunctionTool) and tool.name in mcp_tool_names
+            else tool
+            for tool in tools
+        ]
+        coalescer = getattr(run_context, "tool_coalescer", None)
+        if coalescer is None:
+            coalescer = run_context.tool_coalescer = ToolCallCoalescer()
+        tools = [
+            _with_coalescing(_with_deadline(tool), coalescer) if isinstance(tool, FunctionTool) else tool
+            for tool in tools
+        ]
+        if CASSETTE.mode is not None:
+            tools = [_with_cassette(tool, CASSETTE) if isinstance(tool, FunctionTool) else tool for tool in tools]
+        if run_context.context is not None:
+            # 関数ツール（記事結合など）から MCP ツールを直接呼べるようにしておく
+            run_context.context.mcp_tools = {tool.name: tool for tool in tools if tool.name in primary_tool_names}
+        if RESULT_STORE.enabled:
+            # 退避はモデルに渡す結果だけ。関数ツールからの MCP 呼び出しやカセットには元の結果が流れる
+            tools = [_with_result_handle(tool, RESULT_STORE) if isinstance(tool, FunctionTool) else tool for tool in tools]
+        return tools
+
+
+CHAT_AGENT_INSTRUCTIONS = """
+あなたは社内マーケ部門のアナリストAIです。次を厳密に守ってください。
+- あなたは「読み取り専用」のツールだけを使います。CMS更新・公開・削除・API書き込み等は一切行いません。
+- 確認質問・用語の説明・直前の回答の補足など、軽い会話に簡潔なテキストで答えてください。
+- 数値が必要な場合のみツールを呼び出し、期間と出典を明示してください。
+- 改善プランの作成が必要だと判断したら、/plan を付けて依頼するよう案内してください。
+- 日本語で回答してください。
+"""
+
+
+def build_agent(enabled_tools: List[Any], mcp_server_names: List[str]) -> Agent:
+    return MarketingAgent(
+        name="Marketing Analysis Agent",
+        instructions=AGENT_INSTRUCTIONS,
+        tools=enabled_tools,
+        mcp_servers=mcp_server_names,
+        output_type=AgentOutputSchema(ImprovementPlan, strict_json_schema=True),
+    )
+
+
+def build_chat_agent(enabled_tools: List[Any], mcp_server_names: List[str]) -> Agent:
+    # 出力型なし（プレーンテキスト）の軽量会話用エージェント
+    return MarketingAgent(
+        name="Marketing Chat Agent",
+        instructions=CHAT_AGENT_INSTRUCTIONS,
+        tools=enabled_tools,
+        mcp_servers=mcp_server_names,
+    )
+
+
+# ====== 記録と再生（カセット） ======
+class CassetteMiss(LookupError):
+    pass
+
+
+class Cassette:
+    """Record model streams and tool calls to a JSON Lines file, or serve them back.
+
+    ``--record`` appends every model call (stream events with their offsets)
+    and every tool/MCP call (arguments, output, elapsed time) as it happens.
+    ``--replay`` answers model calls in recorded order and tool calls by
+    (tool, arguments), so a session runs offline and deterministically.
+    ``speed`` scales the recorded delays (0 = as fast as possible).
+    """
+
+    VERSION = 1
+
+    def __init__(self) -> None:
+        self.mode: Optional[str] = None
+        self.path = ""
+        self.speed = 0.0
+        self.header: Dict[str, Any] = {}
+        self.served = Counter()
+        self._lock = threading.Lock()
+        self._file: Optional[TextIO] = None
+        self._models: deque[Dict[str, Any]] = deque()
+        self._tools: Dict[tuple[str, str], deque[Dict[str, Any]]] = {}
+        self._mcp_tools: Dict[str, List[Dict[str, Any]]] = {}
+
+    def record(self, path: str, header: Dict[str, Any]) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.mode, self.path, self.header = "record", path, dict(header)
+        self._file = open(path, "w", encoding="utf-8")
+        self._append({"type": "header", "version": self.VERSION, "created": time.time(), **header})
+
+    def replay(self, path: str, *, speed: float = 0.0) -> None:
+        self.mode, self.path, self.speed = "replay", path, max(0.0, speed)
+        with open(path, encoding="utf-8") as handle:
+            for line_no, line in enumerate(handle, 1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError as exc:
+                    raise ValueError(f"{path}:{line_no}: {exc}") from None
+                kind = entry.get("type")
+                if kind == "header":
+                    if entry.get("version") != self.VERSION:
+                        raise ValueError(f"{path}: unsupported cassette version {entry.get('version')!r}")
+                    self.header = entry
+                elif kind == "model":
+                    self._models.append(entry)
+                elif kind == "tool":
+                    self._tools.setdefault((entry["tool"], entry["arguments"]), deque()).append(entry)
+                elif kind == "mcp_tools":
+                    self._mcp_tools[entry["agent"]] = entry["tools"]
+        if not self.header:
+            raise ValueError(f"{path}: not a cassette (missing header)")
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def summary(self) -> str:
+        served = ", ".join(f"{kind}={count}" for kind, count in sorted(self.served.items())) or "none"
+        return f"[{self.mode}] {self.path}: {served}"
+
+    # --- 記録 ---
+    def _append(self, entry: Dict[str, Any]) -> None:
+        line = json.dumps(entry, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line)
+                self._file.flush()
+
+    def record_model(self, entry: Dict[str, Any]) -> None:
+        self.served["model"] += 1
+        self._append({"type": "model", **entry})
+
+    def record_tool(self, name: str, arguments_json: str, output: Any, elapsed: float) -> None:
+        self.served["tool"] += 1
+        self._append(
+            {
+                "type": "tool",
+                "tool": name,
+                "arguments": _canonical_tool_arguments(arguments_json),
+                "output": output,
+                "elapsed": round(elapsed, 4),
+            }
+        )
+
+    def record_mcp_tools(self, agent_name: str, tools: Sequence[FunctionTool]) -> None:
+        self._append(
+            {
+                "type": "mcp_tools",
+                "agent": agent_name,
+                "tools": [
+                    {
+                        "name": tool.name,
+                        "description": tool.description,
+                        "params_json_schema": tool.params_json_schema,
+                        "strict_json_schema": tool.strict_json_schema,
+                    }
+                    for tool in tools
+                ],
+            }
+        )
+
+    # --- 再生 ---
+    async def pace(self, seconds: float) -> None:
+        if self.speed and seconds > 0:
+            await asyncio.sleep(seconds * self.speed)
+
+    def next_model(self, method: str) -> Dict[str, Any]:
+        if not self._models:
+            raise CassetteMiss(f"{self.path}: no more recorded model calls")
+        entry = self._models.popleft()
+        if entry["method"] != method:
+            raise CassetteMiss(f"{self.path}: expected a {entry['method']} model call, got {method}")
+        self.served["model"] += 1
+        return entry
+
+    def next_tool(self, name: str, arguments_json: str) -> Optional[Dict[str, Any]]:
+        recorded = self._tools.get((name, _canonical_tool_arguments(arguments_json)))
+        if not recorded:
+            self.served["tool_miss"] += 1
+            return None
+        self.served["tool"] += 1
+        # 同じ呼び出しが記録より多い場合は最後の結果を返し続ける
+        return recorded.popleft() if len(recorded) > 1 else recorded[0]
+
+    def mcp_tools(self, agent_name: str) -> List[FunctionTool]:
+        async def unavailable(ctx: Any, arguments_json: str) -> Any:
+            raise CassetteMiss("MCP tools are served from the cassette only")
+
+        return [
+            FunctionTool(
+                name=spec["name"],
+                description=spec["description"],
+                params_json_schema=spec["params_json_schema"],
+                on_invoke_tool=unavailable,
+                strict_json_schema=spec.get("strict_json_schema", True),
+            )
+            for spec in self._mcp_tools.get(agent_name, [])
+        ]
+
+
+CASSETTE = Cassette()
+_STREAM_EVENT = TypeAdapter(ResponseStreamEvent)
+_OUTPUT_ITEM = TypeAdapter(ResponseOutputItem)
+
+
+def _with_cassette(tool: FunctionTool, cassette: Cassette) -> FunctionTool:
+    invoke = tool.on_invoke_tool
+
+    async def on_invoke_tool(ctx: Any, arguments_json: str) -> Any:
+        if cassette.mode == "replay":
+            entry = cassette.next_tool(tool.name, arguments_json)
+            if entry is None:
+                return f"Error (replay): {tool.name} のこの引数での呼び出しはカセットに記録されていません。"
+            await cassette.pace(entry["elapsed"])
+            return entry["output"]
+        started = time.monotonic()
+        output = await invoke(ctx, arguments_json)
+        cassette.record_tool(tool.name, arguments_json, output, time.monotonic() - started)
+        return output
+
+    return dataclasses.replace(tool, on_invoke_tool=on_invoke_tool)
+
+
+class CassetteModel(Model):
+    """Model that records the wrapped model's calls, or replays them without one."""
+
+    def __init__(self, inner: Optional[Model], name: str, cassette: Cassette) -> None:
+        self._inner = inner
+        self._name = name
+        self._cassette = cassette
+
+    async def get_response(self, *args: Any, **kwargs: Any) -> ModelResponse:
+        if self._cassette.mode == "replay":
+            entry = self._cassette.next_model("response")
+            await self._cassette.pace(entry["elapsed"])
+            return ModelResponse(
+                output=[_OUTPUT_ITEM.validate_python(item) for item in entry["output"]],
+                usage=Usage(**entry["usage"]),
+                response_id=entry["response_id"],
+            )
+        started = time.monotonic()
+        response = await self._inner.get_response(*args, **kwargs)
+        self._cassette.record_model(
+            {
+                "method": "response",
+                "model": self._name,
+                "elapsed": round(time.monotonic() - started, 4),
+                "output": [item.model_dump(mode="json") for item in response.output],
+                "usage": {
+                    "requests": response.usage.requests,
+                    "input_tokens": response.usage.input_tokens,
+                    "output_tokens": response.usage.output_tokens,
+                    "total_tokens": response.usage.total_tokens,
+                },
+                "response_id": response.response_id,
+            }
+        )
+        return response
+
+    async def stream_response(self, *args: Any, **kwargs: Any) -> AsyncIterator[Any]:
+        if self._cassette.mode == "replay":
+            entry = self._cassette.next_model("stream")
+            previous = 0.0
+            for offset, event in entry["events"]:
+                await self._cassette.pace(offset - previous)
+                previous = offset
+                yield _STREAM_EVENT.validate_python(event)
+            return
+        started = time.monotonic()
+        events: List[tuple[float, Any]] = []
+        complete = False
+        try:
+            async for event in self._inner.stream_response(*args, **kwargs):
+                events.append((round(time.monotonic() - started, 4), event.model_dump(mode="json")))
+                yield event
+            complete = True
+        finally:
+            # 中断されたストリームも途中までを記録し、再生で同じ形を再現できるようにする
+            self._cassette.record_model(
+                {"method": "stream", "model": self._name, "complete": complete, "events": events}
+            )
+
+
+class CassetteModelProvider(ModelProvider):
+    def __init__(self, cassette: Cassette, inner: Optional[ModelProvider] = None) -> None:
+        self._cassette = cassette
+        self._inner = inner or MultiProvider()
+
+    def get_model(self, model_name: Optional[str]) -> Model:
+        # 再生時は実モデル（API クライアント）を作らない
+        inner = None if self._cassette.mode == "replay" else self._inner.get_model(model_name)
+        return CassetteModel(inner, model_name or "default", self._cassette)
+
+
+# ====== モデルルーティング ======
+_PLAN_ROUTE_PATTERN = re.compile(r"(JSON|構造化|スキーマ|ImprovementPlan|計画を出力|プラン出力)", re.IGNORECASE)
+_HEAVY_ROUTE_PATTERN = re.compile(r"(改善|提案|施策|分析|比較|原因|理由|プラン|計画|レポート|洗い出)", re.IGNORECASE)
+_LIGHT_ROUTE_PATTERN = re.compile(
+    r"(ありがとう|了解|わかりました|OK|どういう意味|とは|詳しく|もう少し|補足|具体的に|例えば|なぜ|どうして|[？?]\s*$)",
+    re.IGNORECASE,
+)
+_LIGHT_ROUTE_MAX_CHARS = 60
+
+
+def _route_is_plan(query: str) -> bool:
+    if query.strip().lower() in {"/plan"}:
+        return True
+    return bool(_PLAN_ROUTE_PATTERN.search(query))
+
+
+@dataclasses.dataclass
+class RouteDecision:
+    route: str  # "chat" | "plan"
+    model: Optional[str]
+    reason: str
+    query: str
+
+
+class TurnRouter:
+    """Send light chat/clarification turns to the fast model, plans to the strong one.
+
+    Also records latency, token usage and estimated cost per route so the
+    effect of routing on turn latency can be measured.
+    """
+
+    def __init__(
+        self,
+        plan_agent: Agent,
+        chat_agent: Optional[Agent] = None,
+        *,
+        mode: str = "plan",
+        plan_model: Optional[str] = None,
+        chat_model: Optional[str] = None,
+        pricing: Optional[Dict[str, tuple[float, float]]] = None,
+        run_config: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        self.plan_agent = plan_agent
+        self.chat_agent = chat_agent
+        self.mode = mode if chat_agent is not None else "plan"
+        self.plan_model = plan_model or None
+        self.chat_model = chat_model or None
+        self._run_config = dict(run_config or {})  # 例: 記録/再生用の model_provider
+        self.stats = RouteStats(pricing)
+
+    def route(self, user_input: str) -> RouteDecision:
+        text = user_input.strip()
+        for prefix, route in (("/plan", "plan"), ("/chat", "chat")):
+            if text.lower().startswith(prefix + " ") and (route == "plan" or self.chat_agent is not None):
+                return self._decision(route, "explicit", text[len(prefix) :].strip())
+        if self.mode == "plan" or _route_is_plan(text):
+            return self._decision("plan", "mode" if self.mode == "plan" else "keyword", text)
+        if self.mode == "chat":
+            return self._decision("chat", "mode", text)
+        if (
+            len(text) <= _LIGHT_ROUTE_MAX_CHARS
+            and _LIGHT_ROUTE_PATTERN.search(text)
+            and not _HEAVY_ROUTE_PATTERN.search(text)
+        ):
+            return self._decision("chat", "light", text)
+        return self._decision("plan", "default", text)
+
+    def agent_for(self, decision: RouteDecision) -> Agent:
+        if decision.route == "chat" and self.chat_agent is not None:
+            return self.chat_agent
+        return self.plan_agent
+
+    def run_config_for(self, decision: RouteDecision) -> Optional[RunConfig]:
+        if not decision.model and not self._run_config:
+            return None
+        return RunConfig(model=decision.model, **self._run_config)
+
+    def record(self, decision: RouteDecision, elapsed: float, usage: Any) -> Dict[str, Any]:
+        model = decision.model or getattr(self.agent_for(decision), "model", None)
+        return self.stats.record(decision.route, model, elapsed, usage, reason=decision.reason)
+
+    def summary_lines(self) -> List[str]:
+        return self.stats.summary_lines()
+
+    def _decision(self, route: str, reason: str, query: str) -> RouteDecision:
+        model = self.plan_model if route == "plan" else self.chat_model
+        return RouteDecision(route=route, model=model, reason=reason, query=query)
+
+
+# ====== 改善プランの逐次描画 ======
+class PlanStreamParser:
+    """Incrementally scan ImprovementPlan JSON text deltas.
+
+    ``feed`` returns ``(field, index, value)`` tuples for every part that has
+    just been completed: top-level strings (``summary``) with ``index=None``
+    and each finished element of a top-level array with its position.
+    """
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self._buffer = ""
+        self._pos = 0
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._token_start = 0
+        self._expect_key = False
+        self._key: Optional[str] = None
+        self._element_start = 0
+        self._element_counts: Dict[str, int] = {}
+        self._disabled = False
+
+    def feed(self, delta: str) -> List[tuple[str, Optional[int], Any]]:
+        if self._disabled or not delta:
+            return []
+        self._buffer += delta
+        buffer = self._buffer
+        parts: List[tuple[str, Optional[int], Any]] = []
+        for index in range(self._pos, len(buffer)):
+            char = buffer[index]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    self._on_string(buffer[self._token_start : index + 1], parts)
+                continue
+            if char == '"':
+                self._in_string = True
+                self._token_start = index
+            elif char in "{[":
+                if not self._stack and char != "{":
+                    self._disabled = True
+                    break
+                self._stack.append(char)
+                if len(self._stack) == 1:
+                    self._expect_key = True
+                elif len(self._stack) == 3 and self._stack[1] == "[":
+                    self._element_start = index
+            elif char in "}]":
+                if not self._stack:
+                    self._disabled = True
+                    break
+                self._stack.pop()
+                if len(self._stack) == 2 and self._stack[1] == "[":
+                    self._emit_element(buffer[self._element_start : index + 1], parts)
+            elif char == "," and len(self._stack) == 1:
+                self._expect_key = True
+            elif not self._stack and not char.isspace():
+                # JSON 以外のテキスト（コードフェンス等）は逐次描画の対象外
+                self._disabled = True
+                break
+        self._pos = len(buffer)
+        return parts
+
+    def _on_string(self, raw: str, parts: List[tuple[str, Optional[int], Any]]) -> None:
+        depth = len(self._stack)
+        if depth == 1:
+            value = self._decode(raw)
+            if self._expect_key:
+                self._key = value if isinstance(value, str) else None
+                self._expect_key = False
+            elif self._key is not None and value is not None:
+                parts.append((self._key, None, value))
+        elif depth == 2 and self._stack[1] == "[":
+            self._emit_element(raw, parts)
+
+    def _emit_element(self, raw: str, parts: List[tuple[str, Optional[int], Any]]) -> None:
+        if self._key is None:
+            return
+        value = self._decode(raw)
+        if value is None:
+            return
+        position = self._element_counts.get(self._key, 0)
+        self._element_counts[self._key] = position + 1
+        parts.append((self._key, position, value))
+
+    @staticmethod
+    def _decode(raw: str) -> Any:
+        try:
+            return json.loads(raw)
+        except json.JSONDecodeError:
+            return None
+
+
+class PlanRenderer:
+    """Print ImprovementPlan sections, remembering what was already shown.
+
+    Parts arriving from ``PlanStreamParser`` are printed as soon as they are
+    complete; ``render_plan`` then prints only what the stream did not cover.
+    """
+
+    _SECTION_TITLES = {
+        "summary": "概要",
+        "metrics_snapshot": "指標",
+        "prioritized_actions": "優先施策",
+        "cautions": "注意点",
+        "sources": "参照元",
+    }
+
+    def __init__(self, stream: Optional[TextIO] = None) -> None:
+        self._stream = stream
+        self._wrapper = textwrap.TextWrapper(width=100, subsequent_indent="  ")
+        self._rendered: Dict[str, int] = {}
+
+    def _print(self, *values: Any, **kwargs: Any) -> None:
+        print(*values, file=self._stream, **kwargs)
+
+    @property
+    def has_output(self) -> bool:
+        return bool(self._rendered)
+
+    def render_part(self, field: str, index: Optional[int], value: Any) -> bool:
+        if field not in self._SECTION_TITLES:
+            return False
+        position = 0 if index is None else index
+        if position != self._rendered.get(field, 0):
+            return False
+        try:
+            if field == "summary":
+                if not isinstance(value, str):
+                    return False
+                item: Any = value
+            elif field == "metrics_snapshot":
+                item = PlanMetric.model_validate(value)
+            elif field == "prioritized_actions":
+                item = PlanAction.model_validate(value)
+            elif isinstance(value, str):
+                item = value
+            else:
+                return False
+        except ValidationError:
+            return False
+        self._print_item(field, position, item)
+        return True
+
+    def render_plan(self, plan: ImprovementPlan) -> None:
+        self._render_items("summary", [plan.summary])
+        self._render_items("metrics_snapshot", plan.metrics_snapshot)
+        self._render_items("prioritized_actions", plan.prioritized_actions)
+        self._render_items("cautions", plan.cautions)
+        self._render_items("sources", plan.sources)
+
+    def _render_items(self, field: str, items: List[Any]) -> None:
+        for position in range(self._rendered.get(field, 0), len(items)):
+            self._print_item(field, position, items[position])
+
+    def _print_item(self, field: str, position: int, item: Any) -> None:
+        wrapper = self._wrapper
+        if position == 0:
+            prefix = "\n" if field == "summary" else ""
+            self._print(f"{prefix}[plan] {self._SECTION_TITLES[field]}")
+        if field == "summary":
+            self._print(wrapper.fill(item))
+        elif field == "metrics_snapshot":
+            label = f"{item.label}: {item.value}"
+            self._print("  - " + wrapper.fill(label).lstrip())
+        elif field == "prioritized_actions":
+            self._print(f"  - {item.title} ({item.effort})")
+            self._print("    根拠: " + wrapper.fill(item.rationale).lstrip())
+            self._print("    期待効果: " + wrapper.fill(item.expected_impact).lstrip())
+            if item.dependencies:
+                deps = ", ".join(item.dependencies)
+                self._print("    依存: " + wrapper.fill(deps).lstrip())
+            if item.kpis:
+                kpis = ", ".join(item.kpis)
+                self._print("    KPI: " + wrapper.fill(kpis).lstrip())
+        else:
+            self._print("  - " + wrapper.fill(item).lstrip())
+        self._rendered[field] = position + 1
+
+
+# ====== ストリーミング表示ヘルパ ======
+class StreamPrinter:
+    prompt = "you> "
+
+    def __init__(self, stream: Optional[TextIO] = None) -> None:
+        # None は sys.stdout（print の既定）。デーモン経由ではソケットへ書く
+        self._stream = stream
+        self._progress_active = False
+        self._last_tick = time.monotonic()
+        self._tick_interval = 0.25
+        self._tool_call_names: Dict[str, str] = {}
+        self.last_message_text: str = ""
+        self._plan_parser = PlanStreamParser()
+        self.plan_renderer = PlanRenderer(stream)
+
+    def _print(self, *values: Any, **kwargs: Any) -> None:
+        print(*values, file=self._stream, **kwargs)
+
+    def show_context(self, context_block: str) -> None:
+        self._print("対話モードです。/exit で終了、/help でコマンド一覧を表示します。")
+        self._print("\n--- コンテキスト ---")
+        for line in context_block.splitlines():
+            self._print(line)
+        self._print("--------------------")
+
+    def notice(self, text: str) -> None:
+        self._print(text)
+
+    def start_turn(self, user_input: str) -> None:
+        self._print(f"\n[you] {user_input}")
+
+    def error(self, message: str) -> None:
+        self._end_progress()
+        self._print(f"[error] {message}")
+
+    def route_stats(self, record: Dict[str, Any]) -> None:
+        self._print(f"[route] {RouteStats.describe(record)}")
+
+    def cached_plan(self, plan: ImprovementPlan, age_seconds: float) -> None:
+        self._print(f"\n[plan] cached（{_format_age(age_seconds)}前の結果。--refresh で再生成）")
+        _print_plan(plan, PlanRenderer(self._stream))
+
+    def finish_turn(self, result: RunResultStreaming) -> None:
+        plan = _extract_plan(result)
+        if plan:
+            _print_plan(plan, self.plan_renderer)
+            return
+        fallback = self.last_message_text or str(result.final_output)
+        if fallback:
+            wrapper = textwrap.TextWrapper(width=100, subsequent_indent="  ")
+            self._print("\n[assistant]")
+            for paragraph in fallback.split("\n"):
+                if paragraph.strip():
+                    self._print(wrapper.fill(paragraph.strip()))
+        else:
+            self._print("\n[assistant] 応答は空でした。")
+
+    async def consume(self, result: RunResultStreaming) -> None:
+        self._plan_parser.reset()
+        self.plan_renderer = PlanRenderer(self._stream)
+        try:
+            async for event in result.stream_events():
+                self._handle_event(event)
+        finally:
+            self._end_progress()
+
+    def _handle_event(self, event: StreamEvent) -> None:
+        if isinstance(event, AgentUpdatedStreamEvent):
+            self._end_progress()
+            self._print(f"\n[agent] {event.new_agent.name}")
+        elif isinstance(event, RawResponsesStreamEvent):
+            self._handle_raw_event(event)
+        elif isinstance(event, RunItemStreamEvent):
+            self._handle_run_item_event(event)
+
+    def _handle_raw_event(self, event: RawResponsesStreamEvent) -> None:
+        event_name = event.data.__class__.__name__
+        if event_name in {"ResponseCreatedEvent", "ResponseOutputItemAddedEvent"}:
+            if event_name == "ResponseOutputItemAddedEvent":
+                self._plan_parser.reset()
+            self._start_progress("model")
+        elif event_name == "ResponseTextDeltaEvent":
+            parts = self._plan_parser.feed(getattr(event.data, "delta", ""))
+            for field, index, value in parts:
+                self._end_progress()
+                self.plan_renderer.render_part(field, index, value)
+            if not self.plan_renderer.has_output:
+                self._tick_progress()
+        elif event_name in {"ResponseOutputItemDoneEvent", "ResponseCompletedEvent"}:
+            self._end_progress()
+
+    def _handle_run_item_event(self, event: RunItemStreamEvent) -> None:
+        name = event.name
+        item = event.item
+        if name == "tool_called" and isinstance(item, ToolCallItem):
+            raw = item.raw_item
+            if isinstance(raw, ResponseFunctionToolCall):
+                self._tool_call_names[raw.call_id] = raw.name
+                args_display = _format_json_snippet(raw.arguments)
+                self._print(f"\n[tool] ↘ {raw.name} args={args_display}")
+            else:
+                self._print("\n[tool] ↘ function call")
+        elif name == "tool_output" and isinstance(item, ToolCallOutputItem):
+            call_id = getattr(item.raw_item, "call_id", None)
+            if call_id is None and isinstance(item.raw_item, dict):
+                call_id = item.raw_item.get("call_id")
+            tool_name = self._tool_call_names.get(call_id, "tool")
+            summary = summarize_tool_output(item.output)
+            self._print(f"[tool] ↗ {tool_name} -> {summary}")
+        elif name == "reasoning_item_created" and isinstance(item, ReasoningItem):
+            text = _extract_reasoning_summary(item)
+            if text:
+                self._print(f"\n[reasoning] {text}")
+        elif name == "message_output_created" and isinstance(item, MessageOutputItem):
+            self.last_message_text = _extract_message_text(item)
+
+    def _start_progress(self, label: str) -> None:
+        if not self._progress_active:
+            self._print(f"\n[{label}] streaming...", end="", flush=True)
+            self._progress_active = True
+            self._last_tick = time.monotonic()
+
+    def _tick_progress(self) -> None:
+        if not self._progress_active:
+            self._start_progress("model")
+            return
+        now = time.monotonic()
+        if now - self._last_tick >= self._tick_interval:
+            self._print(".", end="", flush=True)
+            self._last_tick = now
+
+    def _end_progress(self) -> None:
+        if self._progress_active:
+            self._print()
+            self._progress_active = False
+
+
+# ====== JSON Lines 出力 ======
+class JsonlEventWriter:
+    """Write one typed JSON record per stream event (``--output jsonl``).
+
+    Records are buffered in memory and written with a single flush at the end
+    of each turn so that wrappers can consume many concurrent runs cheaply.
+    """
+
+    prompt = ""
+
+    def __init__(
+        self,
+        stream: Optional[TextIO] = None,
+        session_id: str = "",
+        labels: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        self._stream = stream or sys.stdout
+        self._session_id = session_id
+        self._labels = dict(labels or {})
+        self._buffer: List[str] = []
+        self._tool_call_names: Dict[str, str] = {}
+        self._turn = 0
+        self._turn_started = time.monotonic()
+        self._first_event_at: Optional[float] = None
+        self._tool_calls = 0
+        self.last_message_text: str = ""
+
+    def show_context(self, context_block: str) -> None:
+        self._write({"type": "session", "context": context_block.splitlines()})
+        self.flush()
+
+    def notice(self, text: str) -> None:
+        print(text, file=sys.stderr)
+
+    def start_turn(self, user_input: str) -> None:
+        self._turn += 1
+        self._turn_started = time.monotonic()
+        self._first_event_at = None
+        self._tool_calls = 0
+        self.last_message_text = ""
+        self._write({"type": "turn_started", "input": user_input})
+
+    def error(self, message: str) -> None:
+        self._write({"type": "error", "message": message})
+        self._write_timing()
+        self.flush()
+
+    def route_stats(self, record: Dict[str, Any]) -> None:
+        self._write({"type": "route", **record})
+        self.flush()
+
+    def cached_plan(self, plan: ImprovementPlan, age_seconds: float) -> None:
+        self._write({"type": "plan", "plan": plan.model_dump(), "cached": True, "cache_age_s": round(age_seconds)})
+        self._write_timing()
+        self.flush()
+
+    def finish_turn(self, result: RunResultStreaming) -> None:
+        plan = _extract_plan(result)
+        if plan:
+            self._write({"type": "plan", "plan": plan.model_dump(), "cached": False})
+        else:
+            text = self.last_message_text or str(result.final_output or "")
+            self._write({"type": "final_text", "text": text})
+        self._write_timing()
+        self.flush()
+
+    async def consume(self, result: RunResultStreaming) -> None:
+        async for event in result.stream_events():
+            if self._first_event_at is None:
+                self._first_event_at = time.monotonic()
+            self._handle_event(event)
+
+    def flush(self) -> None:
+        if not self._buffer:
+            return
+        self._stream.write("".join(self._buffer))
+        self._stream.flush()
+        self._buffer.clear()
+
+    def _handle_event(self, event: StreamEvent) -> None:
+        if isinstance(event, AgentUpdatedStreamEvent):
+            self._write({"type": "agent_updated", "agent": event.new_agent.name})
+        elif isinstance(event, RunItemStreamEvent):
+            self._handle_run_item_event(event)
+
+    def _handle_run_item_event(self, event: RunItemStreamEvent) -> None:
+        name = event.name
+        item = event.item
+        if name == "tool_called" and isinstance(item, ToolCallItem):
+            self._tool_calls += 1
+            raw = item.raw_item
+            if isinstance(raw, ResponseFunctionToolCall):
+                self._tool_call_names[raw.call_id] = raw.name
+                try:
+                    arguments: Any = json.loads(raw.arguments)
+                except json.JSONDecodeError:
+                    arguments = raw.arguments
+                self._write(
+                    {"type": "tool_call", "call_id": raw.call_id, "tool": raw.name, "arguments": arguments}
+                )
+            else:
+                self._write({"type": "tool_call", "call_id": None, "tool": getattr(raw, "type", "tool")})
+        elif name == "tool_output" and isinstance(item, ToolCallOutputItem):
+            call_id = getattr(item.raw_item, "call_id", None)
+            if call_id is None and isinstance(item.raw_item, dict):
+                call_id = item.raw_item.get("call_id")
+            self._write(
+                {
+                    "type": "tool_output",
+                    "call_id": call_id,
+                    "tool": self._tool_call_names.get(call_id, "tool"),
+                    "output": item.output,
+                }
+            )
+        elif name == "reasoning_item_created" and isinstance(item, ReasoningItem):
+            text = _extract_reasoning_summary(item, limit=None)
+            if text:
+                self._write({"type": "reasoning", "text": text})
+        elif name == "message_output_created" and isinstance(item, MessageOutputItem):
+            self.last_message_text = _extract_message_text(item)
+            self._write({"type": "message", "text": self.last_message_text})
+
+    def _write_timing(self) -> None:
+        now = time.monotonic()
+        first_event_ms = None
+        if self._first_event_at is not None:
+            first_event_ms = round((self._first_event_at - self._turn_started) * 1000)
+        self._write(
+            {
+                "type": "timing",
+                "elapsed_ms": round((now - self._turn_started) * 1000),
+                "first_event_ms": first_event_ms,
+                "tool_calls": self._tool_calls,
+            }
+        )
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        record = {"session_id": self._session_id, **self._labels, "turn": self._turn, "ts": time.time(), **record}
+        self._buffer.append(self._encode(record))
+
+    def _encode(self, record: Dict[str, Any]) -> str:
+        return json.dumps(record, ensure_ascii=False, default=str) + "\n"
+
+
+# ====== ユーティリティ ======
+def _date_span(days: int) -> tuple[str, str]:
+    end = datetime.now(UTC).date()
+    start = end - timedelta(days=days)
+    return (start.isoformat(), end.isoformat())
 
 
 def _compose_context_block(
@@ -468,40 +3974,56 @@ def _compose_context_block(
     gsc_site_url: str,
     enabled_sources: Iterable[str],
     wordpress_mcp_descriptor: str,
+    wordpress_url: Optional[str] = None,
+    extra_mcp_descriptors: Sequence[str] = (),
 ) -> str:
     lines = [
         query_hint,
         f"- 解析期間: {start}〜{end}",
         f"- GA4 property: {ga4_property_id or '(未設定)'}",
         f"- GSC site: {gsc_site_url or '(未設定)'}",
-        f"- WordPress: {WP_BASE_URL or '(未設定)'}",
+        f"- WordPress: {(wordpress_url if wordpress_url is not None else WP_BASE_URL) or '(未設定)'}",
         f"- WordPress MCP: {wordpress_mcp_descriptor}",
+        *(f"- 追加の MCP サーバー: {descriptor}" for descriptor in extra_mcp_descriptors),
         f"- 使用するデータソース: {', '.join(enabled_sources)}",
         "必要に応じてツールを呼び出し、記事動向の要点と改善案を提案してください。",
     ]
     return "\n".join(lines)
 
 
+def _format_age(seconds: float) -> str:
+    if seconds < 60:
+        return f"{int(seconds)}秒"
+    if seconds < 3600:
+        return f"{int(seconds // 60)}分"
+    if seconds < 86400:
+        return f"{int(seconds // 3600)}時間"
+    return f"{int(seconds // 86400)}日"
+
+
 def _truncate(text: str, limit: int = 120) -> str:
     return text if len(text) <= limit else text[: limit - 1] + "…"
 
 
-def _format_json_snippet(raw_json: str) -> str:
+def _format_json_snippet(raw_json: str, limit: int = 160) -> str:
+    # 巨大な引数はパースせず先頭だけを表示する
+    if len(raw_json) > limit * 8:
+        return _truncate(raw_json[: limit + 1], limit)
     try:
         parsed = json.loads(raw_json)
-        snippet = json.dumps(parsed, ensure_ascii=False)
     except Exception:
-        snippet = raw_json
-    return _truncate(snippet, 160)
+        return _truncate(raw_json, limit)
+    return bounded_preview(parsed, limit)
 
 
 def summarize_tool_output(output: Any) -> str:
     if isinstance(output, dict):
-        if "error" in output:
-            return f"error: {output['error']}"
-        if "warning" in output:
-            return f"warning: {output['warning']}"
-        return _truncate(json.dumps(output, ensure_ascii=False))
+        for status in ("error", "warning"):
+            if status in output:
+                detail = output[status]
+                text = _truncate(detail[:121]) if isinstance(detail, str) else bounded_preview(detail)
+                return f"{status}: {text}"
+        return bounded_preview(output)
     if isinstance(output, list):
         sample_titles: List[str] = []
         for entry in output[:2]:
@@ -515,77 +4037,540 @@ def summarize_tool_output(output: Any) -> str:
             joined = "; ".join(_truncate(t, 40) for t in sample_titles)
             return f"{len(output)} items (例: {joined})"
         return f"{len(output)} items"
-    return _truncate(str(output))
+    if isinstance(output, str):
+        return _truncate(output[:121])
+    return bounded_preview(output)
+
+
+def _extract_message_text(item: MessageOutputItem) -> str:
+    parts: List[str] = []
+    for content in item.raw_item.content:
+        text = getattr(content, "text", "")
+        if text:
+            parts.append(text)
+    return "".join(parts).strip()
+
+
+def _extract_reasoning_summary(item: ReasoningItem, limit: Optional[int] = 100) -> str:
+    summaries = getattr(item.raw_item, "summary", None)
+    if not summaries:
+        return ""
+    texts: List[str] = []
+    for summary in summaries:
+        text = getattr(summary, "text", None)
+        if text:
+            texts.append(text)
+    joined = " ".join(texts).strip()
+    return _truncate(joined, limit) if limit else joined
+
+
+def _print_plan(plan: ImprovementPlan, renderer: Optional[PlanRenderer] = None) -> None:
+    # ストリーミング中に描画済みの要素はスキップし、残りだけを出力する
+    (renderer or PlanRenderer()).render_plan(plan)
+
+
+def _extract_plan(result: RunResultStreaming) -> Optional[ImprovementPlan]:
+    try:
+        return result.final_output_as(ImprovementPlan, raise_if_incorrect_type=True)
+    except TypeError:
+        final_output = result.final_output
+        if isinstance(final_output, ImprovementPlan):
+            return final_output
+    return None
+
+
+# ====== 改善プランのキャッシュ ======
+class PlanCache:
+    """SQLite store of final ImprovementPlans keyed by prompt and data fingerprint.
+
+    Each entry keeps the CONNECTOR_CACHE entries the run read or wrote with
+    their content digests; the analysis window is part of the key through
+    the context block. A lookup only hits while every one of those entries
+    is still cached unchanged, so validating a plan never refetches data
+    and plans can only be served while the connector cache is enabled.
+    """
+
+    def __init__(self, db_path: str, ttl_seconds: float, *, refresh: bool = False) -> None:
+        self.ttl_seconds = ttl_seconds
+        self.refresh = refresh
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS plans ("
+            "key TEXT PRIMARY KEY, plan TEXT NOT NULL, sources TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(*, prompt: str, instructions: str, model: str, history: List[Any]) -> str:
+        # 解析期間・プロパティはコンテキストブロック経由で prompt に含まれる
+        normalized = " ".join(unicodedata.normalize("NFKC", prompt).split()).casefold()
+        payload = json.dumps([normalized, instructions, model, history], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def lookup(self, key: str) -> Optional[tuple[ImprovementPlan, Dict[str, str], float]]:
+        if self.refresh:
+            return None
+        row = self._conn.execute("SELECT plan, sources, created FROM plans WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        age = time.time() - row[2]
+        if age > self.ttl_seconds:
+            self.discard(key)
+            return None
+        try:
+            plan = ImprovementPlan.model_validate_json(row[0])
+        except ValidationError:
+            self.discard(key)
+            return None
+        return plan, json.loads(row[1]), age
+
+    def store(self, key: str, plan: ImprovementPlan, sources: Dict[str, str]) -> None:
+        # コネクタキャッシュを経由しないデータだけで作ったプランは検証できないので保存しない
+        if not sources:
+            return
+        self._conn.execute(
+            "INSERT OR REPLACE INTO plans (key, plan, sources, created) VALUES (?, ?, ?, ?)",
+            (key, plan.model_dump_json(), json.dumps(sources, ensure_ascii=False), time.time()),
+        )
+        self._conn.commit()
+
+    def discard(self, key: str) -> None:
+        self._conn.execute("DELETE FROM plans WHERE key = ?", (key,))
+        self._conn.commit()
+
+
+def lookup_cached_plan(cache: PlanCache, key: str) -> Optional[tuple[ImprovementPlan, float]]:
+    """Return (plan, age) when every connector response the plan was built from is still cached unchanged."""
+    if not CONNECTOR_CACHE.enabled:
+        return None
+    entry = cache.lookup(key)
+    if entry is None:
+        return None
+    plan, sources, age = entry
+    if not all(CONNECTOR_CACHE.fingerprint(source) == digest for source, digest in sources.items()):
+        cache.discard(key)
+        return None
+    return plan, age
+
+
+# ====== ベースラインデータの先読み ======
+def _prefetch_arguments(tool: FunctionTool, overrides: Dict[str, Any]) -> Dict[str, Any]:
+    # strict スキーマでは全プロパティが必須になるため、enum は先頭値で埋める
+    arguments: Dict[str, Any] = {}
+    for name, schema in (tool.params_json_schema.get("properties") or {}).items():
+        if name in overrides:
+            arguments[name] = overrides[name]
+        elif isinstance(schema, dict) and schema.get("enum"):
+            arguments[name] = schema["enum"][0]
+    return arguments
+
+
+async def _prefetch_recent_posts(agent: Agent, run_context: SimpleNamespace, number: int) -> None:
+    context = RunContextWrapper(context=run_context)
+    await agent.load_mcp_tools(context)
+    tool = next((t for t in agent._mcp_tools if isinstance(t, FunctionTool) and t.name.endswith("get-posts")), None)
+    if tool is None:
+        return
+    arguments = _prefetch_arguments(tool, {"number": number})
+    backend = f"wordpress:{agent.mcp_servers[0]}"
+    await _with_connector_cache(tool, backend=backend).on_invoke_tool(context, json.dumps(arguments))
+
+
+async def prefetch_baseline(
+    agent: Agent,
+    run_context: SimpleNamespace,
+    *,
+    ga4_property_id: str,
+    gsc_site_url: str,
+    days: int,
+) -> None:
+    """Warm CONNECTOR_CACHE with the data the first turn almost always fetches."""
+    start, end = _date_span(days)
+    jobs: List[Awaitable[Any]] = []
+    if ga4_property_id:
+        jobs.append(_run_connector("ga4", ga4_report_pages, ga4_property_id, start, end))
+    if gsc_site_url:
+        jobs.append(_run_connector("gsc", gsc_query, gsc_site_url, start, end, ["query", "page"]))
+    if ga4_property_id or gsc_site_url:
+        # 異常検知は解析期間に対して先に計算しておく（結果はキャッシュされる）
+        jobs.append(traffic_anomalies(ga4_property_id, gsc_site_url, start, end))
+    if agent.mcp_servers:
+        jobs.append(_prefetch_recent_posts(agent, run_context, PREFETCH_WP_POSTS))
+    results = await asyncio.gather(*jobs, return_exceptions=True)
+    for outcome in results:
+        if isinstance(outcome, BaseException):
+            print(f"[prefetch] skipped: {type(outcome).__name__}: {outcome}", file=sys.stderr)
+
+
+def _enabled_tools(
+    ga4_property_id: str, gsc_site_url: str, *, sources: Optional[Sequence[str]] = None
+) -> tuple[List[Any], List[str]]:
+    # sources を渡すと（カセット再生時）API キーの有無ではなく記録時の接続先に合わせる
+    serpapi = "SerpAPI" in sources if sources is not None else bool(SERPAPI_API_KEY)
+    ahrefs = bool({"Ahrefs", "Ahrefs MCP"} & set(sources)) if sources is not None else bool(AHREFS_API_KEY)
+    enabled_tools: List[Any] = []
+    enabled_sources: List[str] = ["WordPress MCP"]
+
+    if ga4_property_id:
+        enabled_tools.append(tool_ga4_report)
+        enabled_tools.append(tool_ga4_batch_report)
+        enabled_tools.append(tool_ga4_summary)
+        enabled_sources.append("GA4")
+
+    if gsc_site_url:
+        enabled_tools.append(tool_gsc_query)
+        enabled_tools.append(tool_cannibalization)
+        enabled_sources.append("GSC")
+
+    if ga4_property_id or gsc_site_url:
+        enabled_tools.append(tool_period_deltas)
+        enabled_tools.append(tool_traffic_anomalies)
+        enabled_tools.append(tool_article_metrics)
+
+    enabled_tools.append(tool_competing_posts)
+    enabled_tools.append(tool_result_slice)
+
+    if serpapi:
+        enabled_tools.append(tool_serpapi)
+        enabled_sources.append("SerpAPI")
+
+    if ahrefs:
+        enabled_tools.append(tool_ahrefs_overview)
+        enabled_sources.append("Ahrefs")
+
+    return enabled_tools, enabled_sources
+
+
+# ====== フリート（複数サイト一括分析） ======
+class FleetSite(BaseModel):
+    name: str = Field(..., description="サイト識別子（MCP サーバー名にも使う）")
+    wp_base_url: str = ""
+    wp_mcp_transport: str = "streamable_http"
+    wp_mcp_http_url: str = ""
+    wp_mcp_http_username: str = ""
+    wp_mcp_http_password: str = ""
+    wp_mcp_http_bearer: str = ""
+    wp_mcp_http_headers: str = ""
+    wp_mcp_stdio_command: str = "wp"
+    wp_mcp_stdio_args: str = "mcp-adapter serve"
+    wp_mcp_stdio_env: str = ""
+    wp_mcp_stdio_cwd: str = ""
+    ga4_property_id: str = ""
+    gsc_site_url: str = ""
+
+
+class FleetConfig(BaseModel):
+    concurrency: int = Field(4, description="同時に分析するサイト数の上限")
+    backend_limits: Dict[str, int] = Field(default_factory=dict, description="バックエンド毎の同時実行数")
+    sites: List[FleetSite] = Field(default_factory=list)
+
+
+def load_fleet_config(path: str) -> FleetConfig:
+    """Load a fleet file; string values may reference environment variables ($VAR)."""
+    with open(path, encoding="utf-8") as handle:
+        raw = json.load(handle)
+    if isinstance(raw, list):
+        raw = {"sites": raw}
+
+    def expand(value: Any) -> Any:
+        if isinstance(value, str):
+            return os.path.expandvars(value)
+        if isinstance(value, dict):
+            return {key: expand(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [expand(item) for item in value]
+        return value
+
+    config = FleetConfig.model_validate(expand(raw))
+    names = [site.name for site in config.sites]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate fleet site names: {', '.join(duplicates)}")
+    if not config.sites:
+        raise ValueError("Fleet config has no sites.")
+    return config
+
+
+def _site_mcp_settings(site: FleetSite) -> tuple[MCPSettings, str]:
+    http_url = site.wp_mcp_http_url
+    if site.wp_mcp_transport.lower() in {"http", "streamable_http"} and not http_url:
+        http_url = _default_wp_mcp_http_url(site.wp_base_url)
+    return build_wordpress_mcp_settings(
+        transport=site.wp_mcp_transport,
+        name=site.name,
+        stdio_command=site.wp_mcp_stdio_command,
+        stdio_args=site.wp_mcp_stdio_args,
+        stdio_env=site.wp_mcp_stdio_env,
+        stdio_cwd=site.wp_mcp_stdio_cwd,
+        http_url=http_url,
+        http_headers=site.wp_mcp_http_headers,
+        http_username=site.wp_mcp_http_username,
+        http_password=site.wp_mcp_http_password,
+        http_bearer=site.wp_mcp_http_bearer,
+    )
+
+
+async def _drain_events(result: RunResultStreaming) -> None:
+    async for _ in result.stream_events():
+        pass
+
+
+async def analyze_site(
+    site: FleetSite,
+    query: str,
+    *,
+    days: int,
+    max_turns: int,
+    session_db: str,
+    output: str,
+    slots: asyncio.Semaphore,
+    turn_timeout: Optional[float] = None,
+) -> Dict[str, Any]:
+    async with slots:
+        started = time.monotonic()
+        outcome: Dict[str, Any] = {"site": site.name, "ok": False}
+        agent: Optional[Agent] = None
+        writer: Optional[JsonlEventWriter] = None
+        try:
+            settings, descriptor = _site_mcp_settings(site)
+            tools, sources = _enabled_tools(site.ga4_property_id, site.gsc_site_url)
+            agent = build_agent(tools, [site.name])
+            run_context = SimpleNamespace(
+                mcp_config=settings,
+                ga4_property_id=site.ga4_property_id,
+                gsc_site_url=site.gsc_site_url,
+            )
+            start, end = _date_span(days)
+            context_block = _compose_context_block(
+                query_hint="以下の要望に応えてください。",
+                start=start,
+                end=end,
+                ga4_property_id=site.ga4_property_id,
+                gsc_site_url=site.gsc_site_url,
+                enabled_sources=sources,
+                wordpress_mcp_descriptor=descriptor,
+                wordpress_url=site.wp_base_url,
+            )
+            session_id = f"fleet-{site.name}-{uuid.uuid4()}"
+            session = SQLiteSession(session_id=session_id, db_path=session_db)
+            result = Runner.run_streamed(
+                agent,
+                input=f"{query}\n{context_block}",
+                context=run_context,
+                session=session,
+                max_turns=max_turns,
+            )
+            if output == "jsonl":
+                writer = JsonlEventWriter(session_id=session_id, labels={"site": site.name})
+                writer.start_turn(query)
+                consume: Awaitable[None] = writer.consume(result)
+            else:
+                # 複数サイトの出力が混ざらないよう、イベントは読み捨てて完了時にまとめて表示する
+                consume = _drain_events(result)
+            try:
+                await asyncio.wait_for(consume, turn_timeout or None)
+            except TimeoutError:
+                result.cancel()
+                raise TimeoutError(f"run exceeded {turn_timeout:g}s") from None
+            if writer is not None:
+                writer.finish_turn(result)
+            outcome.update(ok=True, plan=_extract_plan(result), text=str(result.final_output or ""))
+        except Exception as exc:
+            outcome["error"] = f"{type(exc).__name__}: {exc}"
+            if writer is not None:
+                writer.error(outcome["error"])
+        finally:
+            if agent is not None:
+                with contextlib.suppress(Exception):
+                    await agent.cleanup_resources()
+        outcome["elapsed_s"] = round(time.monotonic() - started, 1)
+
+    if output != "jsonl":
+        print(f"\n===== [{site.name}] {outcome['elapsed_s']}s =====")
+        if outcome.get("error"):
+            print(f"[error] {outcome['error']}")
+        elif outcome.get("plan"):
+            _print_plan(outcome["plan"])
+        else:
+            print(outcome.get("text") or "[assistant] 応答は空でした。")
+    return outcome
+
+
+async def run_fleet(
+    config: FleetConfig,
+    query: str,
+    *,
+    days: int,
+    max_turns: int,
+    session_db: str,
+    output: str,
+    turn_timeout: Optional[float] = None,
+) -> List[Dict[str, Any]]:
+    """Analyze every site concurrently under global and per-backend limits."""
+    BACKEND_LIMITER.configure(config.backend_limits)
+    slots = asyncio.Semaphore(max(1, config.concurrency))
+    started = time.monotonic()
+    outcomes = await asyncio.gather(
+        *(
+            analyze_site(
+                site,
+                query,
+                days=days,
+                max_turns=max_turns,
+                session_db=session_db,
+                output=output,
+                slots=slots,
+                turn_timeout=turn_timeout,
+            )
+            for site in config.sites
+        )
+    )
+    failed = [outcome["site"] for outcome in outcomes if not outcome["ok"]]
+    slowest = max(outcome["elapsed_s"] for outcome in outcomes)
+    print(
+        f"[fleet] sites={len(outcomes)} ok={len(outcomes) - len(failed)} failed={len(failed)} "
+        f"wall={time.monotonic() - started:.1f}s slowest={slowest}s"
+        + (f" failed_sites={','.join(failed)}" if failed else ""),
+        file=sys.stderr,
+    )
+    return outcomes
+
+
+# ====== 対話ループ ======
+@contextlib.contextmanager
+def _interrupt_cancels(task: asyncio.Future[Any]) -> Iterator[Dict[str, bool]]:
+    """While active, Ctrl-C cancels ``task`` instead of raising KeyboardInterrupt."""
+    loop = asyncio.get_running_loop()
+    state = {"interrupted": False}
+
+    def interrupt() -> None:
+        state["interrupted"] = True
+        task.cancel()
+
+    try:
+        loop.add_signal_handler(signal.SIGINT, interrupt)
+    except (NotImplementedError, RuntimeError):  # Windows やメインスレッド以外
+        yield state
+        return
+    try:
+        yield state
+    finally:
+        # 解除すると既定のハンドラに戻り、プロンプトでの Ctrl-C は従来どおり終了になる
+        loop.remove_signal_handler(signal.SIGINT)
+
+
+async def run_turn(
+    user_input: str,
+    *,
+    router: TurnRouter,
+    session: SQLiteSession,
+    context_block: str,
+    run_context: Optional[SimpleNamespace],
+    printer: StreamPrinter | JsonlEventWriter,
+    max_turns: int,
+    plan_cache: Optional[PlanCache] = None,
+    refresh: bool = False,
+    turn_timeout: Optional[float] = None,
+    before_run: Optional[asyncio.Future[Any]] = None,
+    interruptible: bool = False,
+) -> None:
+    """Route, run and render one user turn; failures are reported via ``printer``.
 
+    Shared by the interactive loop and the daemon. Cancelling the caller
+    cancels the underlying agent run as well.
+    """
+    decision = router.route(user_input)
+    composed_prompt = f"{decision.query}\n{context_block}"
+    printer.start_turn(user_input)
+    # 先読み待ち・プランキャッシュ検証・エージェント実行を一つのタスクにまとめ、
+    # どの段階でも Ctrl-C とターン制限で止められるようにする
+    turn: Dict[str, Any] = {"result": None, "started": time.monotonic()}
 
-def _extract_message_text(item: MessageOutputItem) -> str:
-    parts: List[str] = []
-    for content in item.raw_item.content:
-        text = getattr(content, "text", "")
-        if text:
-            parts.append(text)
-    return "".join(parts).strip()
+    async def execute() -> None:
+        if before_run is not None:
+            # 先読みが走行中なら同じ取得を重複させず完了を待つ
+            await asyncio.gather(before_run, return_exceptions=True)
 
+        turn["started"] = time.monotonic()
+        cache_key: Optional[str] = None
+        if plan_cache is not None and decision.route == "plan":
+            turn_agent = router.agent_for(decision)
+            cache_key = PlanCache.make_key(
+                prompt=composed_prompt,
+                instructions=str(turn_agent.instructions),
+                model=str(decision.model or turn_agent.model or ""),
+                history=await session.get_items(),
+            )
+            try:
+                cached = None if refresh else lookup_cached_plan(plan_cache, cache_key)
+            except (sqlite3.Error, ValueError) as exc:
+                printer.notice(f"[plan] cache lookup skipped: {exc}")
+                cached = None
+            if cached is not None:
+                plan, age = cached
+                await session.add_items(
+                    [
+                        {"role": "user", "content": composed_prompt},
+                        {"role": "assistant", "content": plan.model_dump_json()},
+                    ]
+                )
+                printer.cached_plan(plan, age)
+                printer.route_stats(
+                    router.record(
+                        dataclasses.replace(decision, reason="cached"), time.monotonic() - turn["started"], None
+                    )
+                )
+                return
 
-def _extract_reasoning_summary(item: ReasoningItem) -> str:
-    summaries = getattr(item.raw_item, "summary", None)
-    if not summaries:
-        return ""
-    texts: List[str] = []
-    for summary in summaries:
-        text = getattr(summary, "text", None)
-        if text:
-            texts.append(text)
-    joined = " ".join(texts).strip()
-    return _truncate(joined, 100)
-
-
-def _print_plan(plan: ImprovementPlan) -> None:
-    wrapper = textwrap.TextWrapper(width=100, subsequent_indent="  ")
-    print("\n[plan] 概要")
-    print(wrapper.fill(plan.summary))
-
-    if plan.metrics_snapshot:
-        print("[plan] 指標")
-        for metric in plan.metrics_snapshot:
-            label = f"{metric.label}: {metric.value}"
-            print("  - " + wrapper.fill(label).lstrip())
-
-    if plan.prioritized_actions:
-        print("[plan] 優先施策")
-        for action in plan.prioritized_actions:
-            print(f"  - {action.title} ({action.effort})")
-            print("    根拠: " + wrapper.fill(action.rationale).lstrip())
-            print("    期待効果: " + wrapper.fill(action.expected_impact).lstrip())
-            if action.dependencies:
-                deps = ", ".join(action.dependencies)
-                print("    依存: " + wrapper.fill(deps).lstrip())
-            if action.kpis:
-                kpis = ", ".join(action.kpis)
-                print("    KPI: " + wrapper.fill(kpis).lstrip())
-
-    if plan.cautions:
-        print("[plan] 注意点")
-        for caution in plan.cautions:
-            print("  - " + wrapper.fill(caution).lstrip())
-
-    if plan.sources:
-        print("[plan] 参照元")
-        for src in plan.sources:
-            print("  - " + wrapper.fill(src).lstrip())
+        with CONNECTOR_CACHE.recording() as sources:
+            try:
+                result = Runner.run_streamed(
+                    router.agent_for(decision),
+                    input=composed_prompt,
+                    context=run_context,
+                    session=session,
+                    max_turns=max_turns,
+                    run_config=router.run_config_for(decision),
+                )
+            except Exception as exc:
+                printer.error(f"Failed to start agent run: {exc}")
+                return
+            turn["result"] = result
+            await printer.consume(result)
+        printer.finish_turn(result)
+        printer.route_stats(
+            router.record(decision, time.monotonic() - turn["started"], result.context_wrapper.usage)
+        )
+        if plan_cache is not None and cache_key is not None:
+            plan = _extract_plan(result)
+            if plan is not None:
+                plan_cache.store(cache_key, plan, sources)
 
+    def cancel_run() -> None:
+        if turn["result"] is not None:
+            turn["result"].cancel()
 
-def _extract_plan(result: RunResultStreaming) -> Optional[ImprovementPlan]:
-    try:
-        return result.final_output_as(ImprovementPlan, raise_if_incorrect_type=True)
-    except TypeError:
-        final_output = result.final_output
-        if isinstance(final_output, ImprovementPlan):
-            return final_output
-    return None
+    task = asyncio.ensure_future(execute())
+    guard = _interrupt_cancels(task) if interruptible else contextlib.nullcontext({"interrupted": False})
+    with guard as interrupt:
+        try:
+            await asyncio.wait_for(task, turn_timeout) if turn_timeout else await task
+        except TimeoutError:
+            cancel_run()
+            printer.error(f"ターンが {turn_timeout:g} 秒の制限を超えたため中断しました。")
+        except asyncio.CancelledError:
+            cancel_run()
+            task.cancel()
+            if not interrupt["interrupted"]:
+                raise
+            printer.error("ターンを中断しました（Ctrl-C）。セッションはそのまま続けられます。")
+        except Exception as exc:
+            cancel_run()
+            printer.error(f"Agent run failed: {exc}")
 
 
-# ====== 対話ループ ======
 async def chat_loop(
     agent: Agent,
     session: SQLiteSession,
@@ -593,15 +4578,19 @@ async def chat_loop(
     initial_query: Optional[str],
     max_turns: int,
     run_context: Optional[SimpleNamespace],
+    printer: Optional[StreamPrinter | JsonlEventWriter] = None,
+    prefetch: Optional[Awaitable[None]] = None,
+    router: Optional[TurnRouter] = None,
+    plan_cache: Optional[PlanCache] = None,
+    turn_timeout: Optional[float] = None,
+    profiler: Optional[TurnProfiler] = None,
 ) -> None:
-    printer = StreamPrinter()
+    printer = printer or StreamPrinter()
+    router = router or TurnRouter(agent)
     pending = initial_query.strip() if initial_query else None
+    prefetch_task = asyncio.ensure_future(prefetch) if prefetch is not None else None
 
-    print("対話モードです。/exit で終了、/help でコマンド一覧を表示します。")
-    print("\n--- コンテキスト ---")
-    for line in context_block.splitlines():
-        print(line)
-    print("--------------------")
+    printer.show_context(context_block)
 
     while True:
         if pending is not None:
@@ -609,9 +4598,9 @@ async def chat_loop(
             pending = None
         else:
             try:
-                user_input = await asyncio.to_thread(input, "you> ")
+                user_input = await asyncio.to_thread(input, printer.prompt)
             except EOFError:
-                print()
+                printer.notice("")
                 break
             user_input = user_input.strip()
 
@@ -622,43 +4611,504 @@ async def chat_loop(
             break
 
         if user_input == "/help":
-            print("利用可能コマンド: /exit, /quit, /help")
+            printer.notice(_CHAT_COMMANDS_HELP)
             continue
 
-        composed_prompt = f"{user_input}\n{context_block}"
-        print(f"\n[you] {user_input}")
+        if user_input == "/stats":
+            for line in router.summary_lines():
+                printer.notice(f"[route] {line}")
+            continue
 
-        try:
-            result = Runner.run_streamed(
-                agent,
-                input=composed_prompt,
-                context=run_context,
+        with profiler.turn() if profiler is not None else contextlib.nullcontext():
+            await run_turn(
+                user_input,
+                router=router,
                 session=session,
+                context_block=context_block,
+                run_context=run_context,
+                printer=printer,
                 max_turns=max_turns,
+                plan_cache=plan_cache,
+                turn_timeout=turn_timeout,
+                before_run=prefetch_task,
+                interruptible=True,
             )
-        except Exception as exc:
-            print(f"[error] Failed to start agent run: {exc}")
-            continue
+        prefetch_task = None
 
+
+# ====== 常駐デーモン ======
+class _SocketTextStream:
+    """Text stream adapter so the printers can write into an asyncio StreamWriter."""
+
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self._writer = writer
+
+    def write(self, text: str) -> int:
+        if not self._writer.is_closing():
+            self._writer.write(text.encode("utf-8"))
+        return len(text)
+
+    def flush(self) -> None:
+        pass
+
+
+class SessionPool:
+    """SQLiteSession per session id, shared by every connection of a server.
+
+    ``turn`` bounds how many turns of one session run at once; idle sessions
+    beyond ``max_idle`` are dropped from memory (their history stays in the DB).
+    """
+
+    def __init__(self, db_path: str, *, per_session: int = 1, max_idle: int = 1024) -> None:
+        self.db_path = db_path
+        self.per_session = max(1, per_session)
+        self.max_idle = max_idle
+        self._sessions: Dict[str, tuple[SQLiteSession, asyncio.Semaphore]] = {}
+        self._claims: Counter[str] = Counter()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def busy(self, session_id: str) -> bool:
+        entry = self._sessions.get(session_id)
+        return entry is not None and entry[1].locked()
+
+    @contextlib.asynccontextmanager
+    async def turn(self, session_id: str) -> AsyncIterator[SQLiteSession]:
+        session, slot = self._entry(session_id)
+        self._claims[session_id] += 1
         try:
-            await printer.consume(result)
+            async with slot:
+                yield session
+        finally:
+            self._claims[session_id] -= 1
+            if not self._claims[session_id]:
+                del self._claims[session_id]
+
+    def _entry(self, session_id: str) -> tuple[SQLiteSession, asyncio.Semaphore]:
+        entry = self._sessions.pop(session_id, None)
+        if entry is None:
+            entry = (SQLiteSession(session_id=session_id, db_path=self.db_path), asyncio.Semaphore(self.per_session))
+            self._evict_idle()
+        self._sessions[session_id] = entry  # 末尾 = 最近使ったもの
+        return entry
+
+    def _evict_idle(self) -> None:
+        if len(self._sessions) < self.max_idle or self.db_path == ":memory:":
+            return  # :memory: は DB がセッション毎なので捨てると履歴が消える
+        for session_id in list(self._sessions):
+            if len(self._sessions) < self.max_idle:
+                break
+            if session_id not in self._claims:
+                del self._sessions[session_id]
+
+
+async def _warm_up(router: TurnRouter, run_context: SimpleNamespace) -> None:
+    # MCP の接続・ツール一覧とコネクタのクライアントを先に用意しておく
+    for agent in filter(None, (router.plan_agent, router.chat_agent)):
+        try:
+            await agent.get_all_tools(RunContextWrapper(context=run_context))
         except Exception as exc:
-            print(f"[error] Agent run failed: {exc}")
-            continue
+            print(f"[daemon] MCP warm-up failed for {agent.name}: {exc}", file=sys.stderr)
+    warmers = []
+    if run_context.ga4_property_id:
+        warmers.append(_run_connector("ga4", _ga4_client))
+    if run_context.gsc_site_url:
+        warmers.append(_run_connector("gsc", _gsc_service))
+    for outcome in await asyncio.gather(*warmers, return_exceptions=True):
+        if isinstance(outcome, Exception):
+            print(f"[daemon] connector warm-up failed: {outcome}", file=sys.stderr)
 
-        plan = _extract_plan(result)
-        if plan:
-            _print_plan(plan)
+
+def _claim_socket(socket_path: str) -> None:
+    os.makedirs(os.path.dirname(socket_path) or ".", exist_ok=True)
+    if not os.path.exists(socket_path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(socket_path)
+        except OSError:
+            os.unlink(socket_path)  # 前回のデーモンが残したソケット
+            return
+    raise SystemExit(f"A daemon is already listening on {socket_path}")
+
+
+async def serve_daemon(
+    socket_path: str,
+    *,
+    router: TurnRouter,
+    run_context: SimpleNamespace,
+    context_for_turn: Callable[[], str],
+    session_db: str,
+    max_turns: int,
+    plan_cache: Optional[PlanCache] = None,
+    turn_timeout: Optional[float] = None,
+    prefetch: Optional[Awaitable[None]] = None,
+    config: str = "",
+) -> None:
+    """Serve turns over a Unix socket, keeping the agent, MCP session and caches warm.
+
+    Each connection sends one JSON request line and receives the turn's
+    output (text or JSONL, as requested) until the daemon closes it. A client
+    hanging up mid-turn cancels that turn. ``context_for_turn`` is called per
+    request so the analysis window follows the current date. A ``hello``
+    request is answered with the daemon's ``config`` fingerprint so clients
+    whose environment differs can run locally instead, and turns sent with
+    another fingerprint are refused.
+    """
+    sessions = SessionPool(session_db)
+    prefetch_task = asyncio.ensure_future(prefetch) if prefetch is not None else None
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = json.loads(await reader.readline())
+            session_id = str(request.get("session_id") or f"daemon-{uuid.uuid4()}")
+        except (ValueError, AttributeError, ConnectionError):
+            writer.close()
+            return
+        if request.get("hello"):
+            writer.write((json.dumps({"config": config}) + "\n").encode("utf-8"))
+            with contextlib.suppress(ConnectionError):
+                await writer.drain()
+            writer.close()
+            return
+        stream = _SocketTextStream(writer)
+        if request.get("output") == "jsonl":
+            printer: StreamPrinter | JsonlEventWriter = JsonlEventWriter(stream=stream, session_id=session_id)
         else:
-            fallback = printer.last_message_text or str(result.final_output)
-            if fallback:
-                wrapper = textwrap.TextWrapper(width=100, subsequent_indent="  ")
-                print("\n[assistant]")
-                for paragraph in fallback.split("\n"):
-                    if paragraph.strip():
-                        print(wrapper.fill(paragraph.strip()))
-            else:
-                print("\n[assistant] 応答は空でした。")
+            printer = StreamPrinter(stream=stream)
+        query = str(request.get("query") or "").strip()
+
+        async def serve() -> None:
+            if request.get("config", config) != config:
+                printer.error("クライアントの環境変数/.env がデーモンの設定と異なります。--no-daemon で実行してください。")
+                return
+            context_block = context_for_turn()
+            if request.get("show_context"):
+                printer.show_context(context_block)
+            if not query:
+                return
+            if query == "/stats":
+                for line in router.summary_lines():
+                    printer.notice(f"[route] {line}")
+                return
+            # 同じセッションのターンは履歴の整合のため直列に処理する
+            async with sessions.turn(session_id) as session:
+                await run_turn(
+                    query,
+                    router=router,
+                    session=session,
+                    context_block=context_block,
+                    run_context=run_context,
+                    printer=printer,
+                    max_turns=max_turns,
+                    plan_cache=plan_cache,
+                    refresh=bool(request.get("refresh")),
+                    turn_timeout=turn_timeout,
+                    before_run=prefetch_task,
+                )
+
+        turn = asyncio.ensure_future(serve())
+        hangup = asyncio.ensure_future(reader.read())
+        try:
+            await asyncio.wait({turn, hangup}, return_when=asyncio.FIRST_COMPLETED)
+            if not turn.done():
+                turn.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await turn
+        except Exception as exc:
+            print(f"[daemon] {session_id}: {exc}", file=sys.stderr)
+        finally:
+            hangup.cancel()
+            with contextlib.suppress(ConnectionError):
+                await writer.drain()
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+    _claim_socket(socket_path)
+    await _warm_up(router, run_context)
+    server = await asyncio.start_unix_server(handle, path=socket_path)
+    os.chmod(socket_path, 0o600)
+    print(f"[daemon] listening on {socket_path}", file=sys.stderr)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(socket_path)
+        for agent in filter(None, (router.plan_agent, router.chat_agent)):
+            with contextlib.suppress(Exception):
+                await agent.cleanup_resources()
+
+
+# ====== HTTP/SSE サーバー ======
+class SseEventWriter(JsonlEventWriter):
+    """JsonlEventWriter that sends every record at once as a Server-Sent Event.
+
+    Also emits ``plan_part`` events for plan sections as they complete, the
+    same granularity StreamPrinter renders them at.
+    """
+
+    def __init__(self, stream: TextIO, session_id: str = "") -> None:
+        super().__init__(stream=stream, session_id=session_id)
+        self._plan_parser = PlanStreamParser()
+
+    def notice(self, text: str) -> None:
+        self._write({"type": "notice", "text": text})
+
+    async def consume(self, result: RunResultStreaming) -> None:
+        self._plan_parser.reset()
+        await super().consume(result)
+
+    def _handle_event(self, event: StreamEvent) -> None:
+        if not isinstance(event, RawResponsesStreamEvent):
+            super()._handle_event(event)
+            return
+        event_name = event.data.__class__.__name__
+        if event_name == "ResponseOutputItemAddedEvent":
+            self._plan_parser.reset()
+        elif event_name == "ResponseTextDeltaEvent":
+            for field, index, value in self._plan_parser.feed(getattr(event.data, "delta", "")):
+                self._write({"type": "plan_part", "field": field, "index": index, "value": value})
+
+    def end_stream(self) -> None:
+        self._write({"type": "done"})
+
+    def _encode(self, record: Dict[str, Any]) -> str:
+        data = json.dumps(record, ensure_ascii=False, default=str)
+        return f"event: {record['type']}\ndata: {data}\n\n"
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        super()._write(record)
+        self.flush()
+
+
+class AdmissionControl:
+    """Global cap on concurrently running turns with a bounded wait queue."""
+
+    def __init__(self, max_active: int, max_waiting: int) -> None:
+        self.max_active = max(1, max_active)
+        self.max_waiting = max(0, max_waiting)
+        self.active = 0
+        self.waiting = 0
+        self._slots = asyncio.Semaphore(self.max_active)
+
+    @property
+    def saturated(self) -> bool:
+        return self._slots.locked() and self.waiting >= self.max_waiting
+
+    @contextlib.asynccontextmanager
+    async def admit(self) -> AsyncIterator[None]:
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._slots.release()
+
+
+_TURNS_PATH = re.compile(r"^/sessions/([A-Za-z0-9._:-]{1,128})/turns$")
+_MAX_REQUEST_BODY = 1 << 20
+_SSE_HEARTBEAT_SECONDS = 15.0
+
+
+class _HttpError(Exception):
+    def __init__(self, status: int, message: str, headers: Optional[Dict[str, str]] = None) -> None:
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+def _http_head(status: int, headers: Dict[str, str]) -> bytes:
+    lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}", *(f"{k}: {v}" for k, v in headers.items())]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def _http_json(writer: asyncio.StreamWriter, status: int, payload: Any, headers: Optional[Dict[str, str]] = None) -> None:
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    head = {
+        "Content-Type": "application/json; charset=utf-8",
+        "Content-Length": str(len(body)),
+        "Connection": "close",
+        **(headers or {}),
+    }
+    writer.write(_http_head(status, head) + body)
+
+
+async def _read_http_request(reader: asyncio.StreamReader) -> tuple[str, str, Dict[str, str], bytes]:
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 30)
+    except asyncio.LimitOverrunError:
+        raise _HttpError(431, "request header too large")
+    request_line, *header_lines = head.decode("latin-1").rstrip("\r\n").split("\r\n")
+    try:
+        method, target, _version = request_line.split(" ", 2)
+    except ValueError:
+        raise _HttpError(400, "malformed request line")
+    headers = {}
+    for line in header_lines:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length") or 0)
+    except ValueError:
+        raise _HttpError(400, "invalid Content-Length")
+    if length > _MAX_REQUEST_BODY:
+        raise _HttpError(413, "request body too large")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), urlsplit(target).path, headers, body
+
+
+async def serve_http(
+    host: str,
+    port: int,
+    *,
+    router: TurnRouter,
+    run_context: SimpleNamespace,
+    context_for_turn: Callable[[], str],
+    sessions: SessionPool,
+    admission: AdmissionControl,
+    max_turns: int,
+    plan_cache: Optional[PlanCache] = None,
+    turn_timeout: Optional[float] = None,
+    prefetch: Optional[Awaitable[None]] = None,
+    token: str = "",
+) -> None:
+    """Serve many sessions concurrently over HTTP, streaming turns as SSE.
+
+    ``POST /sessions/{id}/turns`` with ``{"query": ..., "refresh": false}``
+    streams the turn's events; ``GET /healthz`` reports load. A session
+    already running its maximum number of turns gets 429, and a full
+    admission queue gets 503 so one heavy plan cannot starve other users.
+    The context block (and its date window) is rebuilt for every turn.
+    """
+    prefetch_task = asyncio.ensure_future(prefetch) if prefetch is not None else None
+
+    async def stream_turn(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter, session_id: str, request: Dict[str, Any]
+    ) -> None:
+        query = str(request.get("query") or "").strip()
+        if not query:
+            raise _HttpError(400, "query is required")
+        stream = _SocketTextStream(writer)
+        printer = SseEventWriter(stream, session_id=session_id)
+
+        async def serve() -> None:
+            # 判定から枠の確保までは await を挟まない（同時に来た要求が両方通らないように）
+            if sessions.busy(session_id):
+                raise _HttpError(429, "this session already has a turn running", {"Retry-After": "5"})
+            if admission.saturated:
+                raise _HttpError(503, "server is at capacity", {"Retry-After": "10"})
+            async with sessions.turn(session_id) as session:
+                writer.write(
+                    _http_head(
+                        200,
+                        {
+                            "Content-Type": "text/event-stream; charset=utf-8",
+                            "Cache-Control": "no-cache",
+                            "Connection": "close",
+                            "X-Accel-Buffering": "no",
+                        },
+                    )
+                )
+                if admission.active >= admission.max_active:
+                    printer.notice(f"[queue] {admission.waiting + 1} 件待ち")
+                async with admission.admit():
+                    await run_turn(
+                        query,
+                        router=router,
+                        session=session,
+                        context_block=context_for_turn(),
+                        run_context=run_context,
+                        printer=printer,
+                        max_turns=max_turns,
+                        plan_cache=plan_cache,
+                        refresh=bool(request.get("refresh")),
+                        turn_timeout=turn_timeout,
+                        before_run=prefetch_task,
+                    )
+            printer.end_stream()
+
+        async def heartbeat() -> None:
+            # 長いツール呼び出し中にプロキシがアイドル切断しないようコメント行を送る
+            while True:
+                await asyncio.sleep(_SSE_HEARTBEAT_SECONDS)
+                stream.write(": ping\n\n")
+
+        turn = asyncio.ensure_future(serve())
+        hangup = asyncio.ensure_future(reader.read())
+        pinger = asyncio.ensure_future(heartbeat())
+        try:
+            await asyncio.wait({turn, hangup}, return_when=asyncio.FIRST_COMPLETED)
+            if not turn.done():
+                turn.cancel()  # クライアントが切断した
+            with contextlib.suppress(asyncio.CancelledError):
+                await turn
+        finally:
+            hangup.cancel()
+            pinger.cancel()
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            method, path, headers, body = await _read_http_request(reader)
+            if token and headers.get("authorization") != f"Bearer {token}":
+                raise _HttpError(401, "missing or invalid bearer token", {"WWW-Authenticate": "Bearer"})
+            if path == "/healthz":
+                if method != "GET":
+                    raise _HttpError(405, "use GET", {"Allow": "GET"})
+                _http_json(
+                    writer,
+                    200,
+                    {
+                        "active_turns": admission.active,
+                        "queued_turns": admission.waiting,
+                        "max_turns": admission.max_active,
+                        "sessions": len(sessions),
+                        "routes": router.summary_lines(),
+                    },
+                )
+                return
+            match = _TURNS_PATH.match(path)
+            if match is None:
+                raise _HttpError(404, "not found")
+            if method != "POST":
+                raise _HttpError(405, "use POST", {"Allow": "POST"})
+            try:
+                request = json.loads(body or b"{}")
+            except ValueError:
+                raise _HttpError(400, "body must be JSON")
+            if not isinstance(request, dict):
+                raise _HttpError(400, "body must be a JSON object")
+            await stream_turn(reader, writer, match.group(1), request)
+        except _HttpError as exc:
+            _http_json(writer, exc.status, {"error": str(exc)}, exc.headers)
+        except (asyncio.IncompleteReadError, TimeoutError, ConnectionError):
+            pass
+        except Exception as exc:
+            print(f"[serve] {exc}", file=sys.stderr)
+        finally:
+            with contextlib.suppress(ConnectionError):
+                await writer.drain()
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+    await _warm_up(router, run_context)
+    server = await asyncio.start_server(handle, host=host, port=port, limit=64 * 1024)
+    print(f"[serve] listening on http://{host}:{port}", file=sys.stderr)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        for agent in filter(None, (router.plan_agent, router.chat_agent)):
+            with contextlib.suppress(Exception):
+                await agent.cleanup_resources()
 
 
 # ====== CLI エントリポイント ======
@@ -691,6 +5141,133 @@ def main() -> None:
         default=10,
         help="1プロンプトあたりの最大ターン数（デフォルト: 10）",
     )
+    parser.add_argument(
+        "--route",
+        choices=["auto", "plan", "chat"],
+        default=os.getenv("ROUTE_MODE", "plan"),
+        help="ターンの振り分け。auto は軽い確認・会話を chat モデルへ、改善プラン生成を plan モデルへ送る（既定: plan）。",
+    )
+    parser.add_argument(
+        "--chat-model",
+        type=str,
+        default=CHAT_MODEL,
+        help="chat ルートで使うモデル（例: gpt-4.1-mini）。未指定ならエージェント既定。",
+    )
+    parser.add_argument(
+        "--plan-model",
+        type=str,
+        default=PLAN_MODEL,
+        help="plan ルート（ImprovementPlan 生成）で使うモデル。未指定ならエージェント既定。",
+    )
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        default=os.getenv("PREFETCH_BASELINE", "").lower() in {"1", "true", "yes"},
+        help="起動直後にGA4/GSC/WordPressのベースラインデータをバックグラウンドで先読みしてキャッシュする。",
+    )
+    parser.add_argument(
+        "--tool-timeout",
+        type=float,
+        default=TOOL_TIMEOUT,
+        help="ツール1回あたりの制限秒数。超えるとタイムアウト結果をモデルに返す（0 で無制限、個別指定は TOOL_TIMEOUTS）。",
+    )
+    parser.add_argument(
+        "--turn-timeout",
+        type=float,
+        default=TURN_TIMEOUT,
+        help="1ターン（エージェント実行）の制限秒数。超えるとそのターンだけ中断する（0 で無制限）。",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=["cpu", "mem"],
+        default=None,
+        help="ターン毎のプロファイルを取る。cpu: cProfile（.prof）、mem: tracemalloc の割り当て増分（.mem.txt）。対話モードのみ。",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        type=str,
+        default=PROFILE_DIR,
+        help="--profile の出力先ディレクトリ（既定 ./profiles）。",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="改善プランのキャッシュを使わずに再生成する（結果はキャッシュを更新）。",
+    )
+    parser.add_argument(
+        "--output",
+        choices=["text", "jsonl"],
+        default="text",
+        help="出力形式。jsonl はイベントごとに1行のJSONレコードを STDOUT に出力（ターン毎にフラッシュ）。",
+    )
+    cassette = parser.add_mutually_exclusive_group()
+    cassette.add_argument(
+        "--record",
+        type=str,
+        default="",
+        metavar="CASSETTE",
+        help="モデルのストリームとツール/MCP 呼び出し（結果・所要時間）をカセットファイル（JSONL）に記録する。",
+    )
+    cassette.add_argument(
+        "--replay",
+        type=str,
+        default="",
+        metavar="CASSETTE",
+        help="記録したカセットを再生する。モデル・GA4・GSC・MCP へ接続せず、認証情報も不要。",
+    )
+    parser.add_argument(
+        "--replay-speed",
+        type=float,
+        default=0.0,
+        help="再生時の待ち時間の倍率（0 で待たない、1 で記録時と同じ間隔）。",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="常駐モード。エージェント・MCP接続・キャッシュを温めたまま --socket で待ち受け、通常の CLI 起動はそこへ転送される。",
+    )
+    parser.add_argument(
+        "--socket",
+        type=str,
+        default=os.getenv("AGENT_SOCKET", _DAEMON_SOCKET_DEFAULT),
+        help=f"デーモンの Unix ソケット（既定: {_DAEMON_SOCKET_DEFAULT}）。",
+    )
+    parser.add_argument(
+        "--no-daemon",
+        action="store_true",
+        help="デーモンが起動していても使わずにこのプロセスで実行する。",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="HTTP サーバーモード。複数セッションを同時に受け付け、ターンのイベントを SSE で配信する。",
+    )
+    parser.add_argument("--host", type=str, default=os.getenv("SERVE_HOST", "127.0.0.1"), help="--serve の待ち受けアドレス。")
+    parser.add_argument("--port", type=int, default=int(os.getenv("SERVE_PORT", "8787")), help="--serve の待ち受けポート。")
+    parser.add_argument(
+        "--max-concurrent-turns",
+        type=int,
+        default=SERVE_MAX_TURNS,
+        help="--serve で同時に実行するターン数の上限。超えた分は待ち行列（SERVE_MAX_QUEUED 件まで、以降は 503）。",
+    )
+    parser.add_argument(
+        "--session-turns",
+        type=int,
+        default=SERVE_SESSION_TURNS,
+        help="--serve で1セッションが同時に実行できるターン数（超えると 429）。",
+    )
+    parser.add_argument(
+        "--fleet",
+        type=str,
+        default=os.getenv("FLEET_CONFIG", ""),
+        help="複数サイトの設定ファイル（JSON）。指定時は query を全サイトへ並列に投げて結果をまとめて出力する。",
+    )
+    parser.add_argument(
+        "--fleet-concurrency",
+        type=int,
+        default=0,
+        help="フリート実行で同時に分析するサイト数（設定ファイルの concurrency を上書き）。",
+    )
     parser.add_argument(
         "--wp-mcp-transport",
         type=str,
@@ -751,6 +5328,24 @@ def main() -> None:
         default=os.getenv("WP_MCP_HTTP_BEARER", ""),
         help="Bearer トークン（指定時は Authorization: Bearer を自動設定）。",
     )
+    parser.add_argument(
+        "--mcp-config",
+        type=str,
+        default=MCP_SERVERS_CONFIG,
+        help='WordPress と同時に接続する MCP サーバーの設定ファイル（JSON: {"servers": {"ahrefs": {"url": ...}}}）。',
+    )
+    parser.add_argument(
+        "--mcp-server",
+        action="append",
+        default=[],
+        metavar="NAME=URL",
+        help="追加の MCP サーバー（NAME=URL または NAME=stdio:COMMAND ARGS）。複数指定可。",
+    )
+    parser.add_argument(
+        "--ahrefs-check",
+        action="store_true",
+        help="Ahrefs コネクタをオフラインのスタンドインで動かし、正規化・整形・キャッシュを確認して終了する（API キー不要）。",
+    )
     parser.add_argument(
         "--wp-mcp-name",
         type=str,
@@ -759,10 +5354,53 @@ def main() -> None:
     )
     args = parser.parse_args()
 
-    if not OPENAI_API_KEY:
+    if args.ahrefs_check:
+        raise SystemExit(0 if asyncio.run(ahrefs_check()) else 1)
+    if not OPENAI_API_KEY and not args.replay:
         raise SystemExit("OPENAI_API_KEY is not set.")
+    if (args.record or args.replay) and (args.fleet or args.serve or args.daemon):
+        # 並行実行ではモデル呼び出しの順序が決まらず、再生と対応づけられない
+        raise SystemExit("--record/--replay work with a single interactive session only.")
+    if args.profile and (args.fleet or args.serve or args.daemon):
+        # cProfile はスレッドに1つしか有効にできず、並行するターンを分けて計測できない
+        raise SystemExit("--profile works with a single interactive session only.")
+
+    if args.prefetch and "CONNECTOR_CACHE_TTL" not in os.environ:
+        # 先読みした結果をターンで使えるよう、先読みするときだけ既定でキャッシュを有効にする
+        CONNECTOR_CACHE.configure(PREFETCH_CACHE_TTL)
+    try:
+        BACKEND_LIMITER.configure(_parse_backend_limits(BACKEND_LIMITS))
+        TOOL_DEADLINES.configure(args.tool_timeout, _parse_tool_timeouts(TOOL_TIMEOUTS))
+    except ValueError as exc:
+        raise SystemExit(str(exc))
+    with contextlib.suppress(OSError):
+        RESULT_STORE.prune()
 
-    start, end = _date_span(args.days)
+    if args.fleet:
+        if not args.query:
+            raise SystemExit("--fleet requires a query argument.")
+        try:
+            fleet = load_fleet_config(args.fleet)
+        except (OSError, ValueError) as exc:
+            raise SystemExit(f"Fleet configuration error: {exc}")
+        if args.fleet_concurrency:
+            fleet.concurrency = args.fleet_concurrency
+        outcomes = asyncio.run(
+            _closing_connectors(
+                run_fleet(
+                    fleet,
+                    args.query.strip(),
+                    days=args.days,
+                    max_turns=args.max_turns,
+                    session_db=args.session_db,
+                    output=args.output,
+                    turn_timeout=args.turn_timeout,
+                )
+            )
+        )
+        if not all(outcome["ok"] for outcome in outcomes):
+            raise SystemExit(1)
+        return
 
     # HTTPモードで URL 未指定の場合、WP_BASE_URL から既定パスを自動補完
     if args.wp_mcp_transport.lower() in {"http", "streamable_http"} and not args.wp_mcp_http_url:
@@ -775,7 +5413,7 @@ def main() -> None:
         args.wp_mcp_http_password = WP_APP_PASSWORD
 
     try:
-        wordpress_mcp_settings, wordpress_descriptor = build_wordpress_mcp_settings(
+        mcp_settings, wordpress_descriptor = build_wordpress_mcp_settings(
             transport=args.wp_mcp_transport,
             name=args.wp_mcp_name,
             stdio_command=args.wp_mcp_stdio_command,
@@ -791,60 +5429,195 @@ def main() -> None:
     except ValueError as exc:
         raise SystemExit(f"WordPress MCP configuration error: {exc}")
 
+    extra_mcp_servers: Dict[str, tuple[MCPServerSettings, str]] = {}
+    try:
+        if args.mcp_config:
+            extra_mcp_servers.update(load_mcp_servers_config(args.mcp_config))
+        for raw in args.mcp_server:
+            name, server_settings, descriptor = parse_mcp_server_flag(raw)
+            extra_mcp_servers[name] = (server_settings, descriptor)
+    except (OSError, ValueError) as exc:
+        raise SystemExit(f"MCP server configuration error: {exc}")
     mcp_server_names = [args.wp_mcp_name.strip() or "wordpress"]
+    if mcp_server_names[0] in extra_mcp_servers:
+        raise SystemExit(f"MCP server configuration error: {mcp_server_names[0]!r} is already the WordPress MCP server.")
+    # WordPress を先頭に、追加サーバーを同じ MCPSettings へ並べる（ツール名は「サーバー名_」で区別される）
+    mcp_settings.servers.update({name: server_settings for name, (server_settings, _) in extra_mcp_servers.items()})
+    mcp_server_names.extend(extra_mcp_servers)
 
-    # ツール構成
-    enabled_tools: List[Any] = []
-    enabled_sources: List[str] = ["WordPress MCP"]
-
-    if args.ga4_property_id:
-        enabled_tools.append(tool_ga4_report)
-        enabled_sources.append("GA4")
-
-    if args.gsc_site_url:
-        enabled_tools.append(tool_gsc_query)
-        enabled_sources.append("GSC")
-
-    if SERPAPI_API_KEY:
-        enabled_tools.append(tool_serpapi)
-        enabled_sources.append("SerpAPI")
+    recorded_sources: Optional[List[str]] = None
+    if args.replay:
+        try:
+            CASSETTE.replay(args.replay, speed=args.replay_speed)
+        except (OSError, ValueError) as exc:
+            raise SystemExit(f"Cassette error: {exc}")
+        args.ga4_property_id = args.ga4_property_id or CASSETTE.header.get("ga4_property_id", "")
+        args.gsc_site_url = args.gsc_site_url or CASSETTE.header.get("gsc_site_url", "")
+        recorded_sources = CASSETTE.header.get("sources")
 
-    if AHREFS_API_KEY:
-        enabled_tools.append(tool_ahrefs_site_overview)
-        enabled_sources.append("Ahrefs MCP")
+    # ツール構成
+    enabled_tools, enabled_sources = _enabled_tools(args.ga4_property_id, args.gsc_site_url, sources=recorded_sources)
 
-    if not enabled_tools:
+    if enabled_sources == ["WordPress MCP"]:
         print("INFO: Optional connectors are not configured. WordPress MCP のみ利用します。", file=sys.stderr)
 
     agent = build_agent(enabled_tools, mcp_server_names)
+    try:
+        pricing = load_model_pricing(MODEL_PRICING_JSON)
+    except ValueError as exc:
+        raise SystemExit(str(exc))
+    router = TurnRouter(
+        agent,
+        build_chat_agent(enabled_tools, mcp_server_names) if args.route != "plan" else None,
+        mode=args.route,
+        plan_model=args.plan_model.strip(),
+        chat_model=args.chat_model.strip(),
+        pricing=pricing,
+        run_config=(
+            {"model_provider": CassetteModelProvider(CASSETTE), "tracing_disabled": bool(args.replay)}
+            if args.record or args.replay
+            else None
+        ),
+    )
+    if args.record:
+        try:
+            CASSETTE.record(
+                args.record,
+                {
+                    "ga4_property_id": args.ga4_property_id.strip(),
+                    "gsc_site_url": args.gsc_site_url.strip(),
+                    "sources": enabled_sources,
+                },
+            )
+        except OSError as exc:
+            raise SystemExit(f"Cassette error: {exc}")
     session = SQLiteSession(session_id=args.session_id, db_path=args.session_db)
-    run_context = SimpleNamespace(mcp_config=wordpress_mcp_settings)
+    run_context = SimpleNamespace(
+        mcp_config=mcp_settings,
+        ga4_property_id=args.ga4_property_id.strip(),
+        gsc_site_url=args.gsc_site_url.strip(),
+    )
 
-    context_block = _compose_context_block(
+    compose_context = functools.partial(
+        _compose_context_block,
         query_hint="以下の要望に応えてください。",
-        start=start,
-        end=end,
         ga4_property_id=args.ga4_property_id.strip(),
         gsc_site_url=args.gsc_site_url.strip(),
         enabled_sources=enabled_sources,
         wordpress_mcp_descriptor=wordpress_descriptor,
+        extra_mcp_descriptors=[descriptor for _, descriptor in extra_mcp_servers.values()],
     )
 
+    def current_context_block() -> str:
+        # 日をまたいで動き続けるデーモン/サーバーでも解析期間が今日基準になるよう、呼ぶたびに組み立てる
+        start, end = _date_span(args.days)
+        return compose_context(start=start, end=end)
+
+    context_block = current_context_block()
+
     initial_query = args.query.strip() if args.query else None
+    if args.output == "jsonl":
+        printer: StreamPrinter | JsonlEventWriter = JsonlEventWriter(session_id=args.session_id)
+    else:
+        printer = StreamPrinter()
+
+    plan_cache: Optional[PlanCache] = None
+    # 記録/再生ではキャッシュ命中でモデル呼び出しが飛ばされると再生と対応しなくなる
+    # 検証はコネクタキャッシュ上の取得結果と照合するので、キャッシュが無効なら使わない
+    if PLAN_CACHE_TTL > 0 and CONNECTOR_CACHE.enabled and CASSETTE.mode is None:
+        try:
+            plan_cache = PlanCache(PLAN_CACHE_DB, PLAN_CACHE_TTL, refresh=args.refresh)
+        except (OSError, sqlite3.Error) as exc:
+            print(f"[plan] cache disabled: {exc}", file=sys.stderr)
+
+    prefetch: Optional[Awaitable[None]] = None
+    if args.prefetch and CASSETTE.mode is None:
+        prefetch = prefetch_baseline(
+            agent,
+            run_context,
+            ga4_property_id=args.ga4_property_id.strip(),
+            gsc_site_url=args.gsc_site_url.strip(),
+            days=args.days,
+        )
+
+    if args.serve:
+        session_db = args.session_db
+        if session_db == ":memory:":
+            # 複数ユーザーの履歴を再起動後も残すため、サーバーでは既定で共有 DB に保存する
+            session_db = os.path.expanduser("~/.cache/marketing-agent-cli/sessions.sqlite3")
+            os.makedirs(os.path.dirname(session_db), exist_ok=True)
+        try:
+            asyncio.run(
+                _closing_connectors(
+                    serve_http(
+                        args.host,
+                        args.port,
+                        router=router,
+                        run_context=run_context,
+                        context_for_turn=current_context_block,
+                        sessions=SessionPool(session_db, per_session=args.session_turns),
+                        admission=AdmissionControl(args.max_concurrent_turns, SERVE_MAX_QUEUED),
+                        max_turns=args.max_turns,
+                        plan_cache=plan_cache,
+                        turn_timeout=args.turn_timeout,
+                        prefetch=prefetch,
+                        token=SERVE_TOKEN,
+                    )
+                )
+            )
+        except KeyboardInterrupt:
+            print("\n終了します。", file=sys.stderr)
+        return
+
+    if args.daemon:
+        if args.query:
+            raise SystemExit("--daemon does not take a query; run the CLI again to send one.")
+        try:
+            asyncio.run(
+                _closing_connectors(
+                    serve_daemon(
+                        os.path.expanduser(args.socket),
+                        router=router,
+                        run_context=run_context,
+                        context_for_turn=current_context_block,
+                        session_db=args.session_db,
+                        max_turns=args.max_turns,
+                        plan_cache=plan_cache,
+                        turn_timeout=args.turn_timeout,
+                        prefetch=prefetch,
+                        config=_config_fingerprint(),
+                    )
+                )
+            )
+        except KeyboardInterrupt:
+            print("\n終了します。", file=sys.stderr)
+        return
 
     try:
         asyncio.run(
-            chat_loop(
-                agent=agent,
-                session=session,
-                context_block=context_block,
-                initial_query=initial_query,
-                max_turns=args.max_turns,
-                run_context=run_context,
+            _closing_connectors(
+                chat_loop(
+                    agent=agent,
+                    session=session,
+                    context_block=context_block,
+                    initial_query=initial_query,
+                    max_turns=args.max_turns,
+                    run_context=run_context,
+                    printer=printer,
+                    prefetch=prefetch,
+                    router=router,
+                    plan_cache=plan_cache,
+                    turn_timeout=args.turn_timeout,
+                    profiler=TurnProfiler(args.profile, args.profile_dir) if args.profile else None,
+                )
             )
         )
     except KeyboardInterrupt:
         print("\n終了します。")
+    finally:
+        if CASSETTE.mode is not None:
+            CASSETTE.close()
+            print(CASSETTE.summary(), file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -21,10 +21,13 @@ from __future__ import annotations
 
 import argparse
 import asyncio
+import contextlib
 import json
+import math
 import os
 import re
 import sys
+import time
 from datetime import UTC, datetime, timedelta
 from typing import Any, Dict, List, Optional
 
@@ -41,12 +44,17 @@ from agents import (
     function_tool,
     AgentOutputSchema,
     ItemHelpers,
+    RunConfig,
     SQLiteSession,
 )
 
 # Responses API テキストデルタ（任意で可視化）
 from openai.types.responses import ResponseTextDeltaEvent
 
+# プレビューとプロファイラは main.py と共有する（リポジトリ直下の diagnostics.py）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from diagnostics import RouteStats, TurnProfiler, bounded_preview, load_model_pricing  # noqa: E402
+
 dotenv.load_dotenv()
 
 # ====== 環境変数 ======
@@ -96,23 +104,163 @@ class ImprovementPlan(BaseModel):
     sources: List[str] = Field(default_factory=list, description="参照データの出典（URLや説明）")
 
 # ====== コネクタ：WordPress（読み取りのみ） ======
-def wp_list_posts(per_page: int = 20, days: int = 30) -> List[Dict[str, Any]]:
+WP_POST_INDEX = os.getenv("WP_POST_INDEX", os.path.expanduser("~/.cache/marketing-agent-cli/wp_posts.json"))
+WP_PAGE_CONCURRENCY = int(os.getenv("WP_PAGE_CONCURRENCY", "6"))
+WP_PAGE_SIZE = 100  # REST API の per_page 上限
+WP_INDEX_MAX_AGE = float(os.getenv("WP_INDEX_MAX_AGE", "60"))  # この秒数以内の再同期は省略
+WP_POST_FIELDS = "id,link,date,date_gmt,modified,modified_gmt,slug,title"
+WP_INDEX_RECONCILE = float(os.getenv("WP_INDEX_RECONCILE", "3600"))  # id 一覧との突き合わせ間隔（秒）
+
+class WpPostIndex:
+    """ローカルの投稿索引。初回は全ページを並列取得し、以降は変更分だけを取り込む。
+
+    1ページ目は If-None-Match / If-Modified-Since 付きで取りに行き、304 なら通信はそれだけ。
+    変化があれば modified_after で更新分のみ取得し、総数が減っていれば（削除）全件を取り直す。
+    削除と新規公開が同時にあると総数では気づけないので、WP_INDEX_RECONCILE 秒毎に
+    id だけの全件一覧と突き合わせて、消えた投稿を落とし取りこぼした投稿を取り込む。
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.posts: Dict[int, Dict[str, Any]] = {}
+        self.validators: Dict[str, str] = {}
+        self.reconciled_at = 0.0  # 壁時計（再起動をまたいで保存する）
+        self._lock = asyncio.Lock()
+        self._client: Optional[httpx.AsyncClient] = None
+        self._synced_at = -math.inf
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("base_url") == WP_BASE_URL:
+                self.posts = {int(p["id"]): p for p in data.get("posts", [])}
+                self.validators = data.get("validators", {})
+                self.reconciled_at = float(data.get("reconciled_at") or 0.0)
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            auth = (WP_APP_USER, WP_APP_PASSWORD) if (WP_APP_USER and WP_APP_PASSWORD) else None
+            limits = httpx.Limits(max_connections=WP_PAGE_CONCURRENCY, max_keepalive_connections=WP_PAGE_CONCURRENCY)
+            self._client = httpx.AsyncClient(auth=auth, timeout=30.0, limits=limits)
+        return self._client
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _get_page(self, params: Dict[str, Any], page: int, headers: Optional[Dict[str, str]] = None) -> httpx.Response:
+        url = f"{WP_BASE_URL.rstrip('/')}/wp-json/wp/v2/posts"
+        r = await self._http().get(url, params={**params, "page": page}, headers=headers)
+        if r.status_code != 304:
+            r.raise_for_status()
+        return r
+
+    async def _fetch_all(self, params: Dict[str, Any], first: httpx.Response) -> List[Dict[str, Any]]:
+        posts = list(first.json())
+        total_pages = int(first.headers.get("X-WP-TotalPages") or 1)
+        if total_pages > 1:
+            sem = asyncio.Semaphore(WP_PAGE_CONCURRENCY)
+            async def fetch(page: int) -> List[Dict[str, Any]]:
+                async with sem:
+                    return (await self._get_page(params, page)).json()
+            for chunk in await asyncio.gather(*(fetch(page) for page in range(2, total_pages + 1))):
+                posts.extend(chunk)
+        return posts
+
+    async def sync(self) -> Dict[str, int]:
+        async with self._lock:
+            if time.monotonic() - self._synced_at < WP_INDEX_MAX_AGE:
+                return {"fetched": 0, "total": len(self.posts)}
+            base = {"per_page": WP_PAGE_SIZE, "orderby": "modified", "order": "desc", "_fields": WP_POST_FIELDS}
+            headers = {}
+            if self.posts and self.validators.get("etag"):
+                headers["If-None-Match"] = self.validators["etag"]
+            if self.posts and self.validators.get("last_modified"):
+                headers["If-Modified-Since"] = self.validators["last_modified"]
+            first = await self._get_page(base, 1, headers)
+            fetched: List[Dict[str, Any]] = []
+            removed = 0
+            if first.status_code != 304:
+                site_total = int(first.headers.get("X-WP-Total") or 0)
+                # modified_after はサイトのローカル時刻（post_modified）と比較されるので modified を使う
+                newest = max((p.get("modified") or "" for p in self.posts.values()), default="")
+                if not self.posts or site_total < len(self.posts) or not newest:
+                    fetched = await self._fetch_all(base, first)
+                    self.posts = {int(p["id"]): p for p in fetched}
+                    self.reconciled_at = time.time()
+                else:
+                    # after は境界を含まないので1秒戻して取り、重複は id で上書きする
+                    since = datetime.fromisoformat(newest) - timedelta(seconds=1)
+                    delta = {**base, "modified_after": since.strftime("%Y-%m-%dT%H:%M:%S")}
+                    delta_first = await self._get_page(delta, 1)
+                    fetched = await self._fetch_all(delta, delta_first)
+                    self.posts.update({int(p["id"]): p for p in fetched})
+                self.validators = {
+                    k: v for k, v in {"etag": first.headers.get("ETag"), "last_modified": first.headers.get("Last-Modified")}.items() if v
+                }
+            # 1ページ目に出ない古い投稿の削除は 304 でも起きうるので、304 のときも突き合わせる
+            reconcile = time.time() - self.reconciled_at >= WP_INDEX_RECONCILE
+            if reconcile:
+                removed, added = await self._reconcile()
+                fetched += added
+            if first.status_code != 304 or reconcile:
+                self._save()
+            self._synced_at = time.monotonic()
+            return {"fetched": len(fetched), "removed": removed, "total": len(self.posts)}
+
+    async def _reconcile(self) -> tuple[int, List[Dict[str, Any]]]:
+        """id だけの全件一覧と突き合わせる。戻り値は（落とした件数, 取り込んだ投稿）。"""
+        ids = {"per_page": WP_PAGE_SIZE, "_fields": "id"}
+        live = {int(p["id"]) for p in await self._fetch_all(ids, await self._get_page(ids, 1))}
+        gone = self.posts.keys() - live
+        for post_id in gone:
+            del self.posts[post_id]
+        missing = sorted(live - self.posts.keys())
+        added: List[Dict[str, Any]] = []
+        for offset in range(0, len(missing), WP_PAGE_SIZE):
+            include = ",".join(str(post_id) for post_id in missing[offset : offset + WP_PAGE_SIZE])
+            params = {"per_page": WP_PAGE_SIZE, "include": include, "_fields": WP_POST_FIELDS}
+            added += (await self._get_page(params, 1)).json()
+        self.posts.update({int(p["id"]): p for p in added})
+        self.reconciled_at = time.time()
+        return len(gone), added
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "base_url": WP_BASE_URL,
+                    "validators": self.validators,
+                    "reconciled_at": self.reconciled_at,
+                    "posts": list(self.posts.values()),
+                },
+                f,
+                ensure_ascii=False,
+            )
+        os.replace(tmp, self.path)
+
+    def recent(self, limit: int, days: int) -> List[Dict[str, Any]]:
+        posts = sorted(self.posts.values(), key=lambda p: p.get("modified_gmt") or "", reverse=True)
+        if days > 0:
+            after = (datetime.now(UTC) - timedelta(days=days)).strftime("%Y-%m-%dT%H:%M:%S")
+            posts = [p for p in posts if (p.get("date_gmt") or "") >= after]
+        return posts[:limit] if limit > 0 else posts
+
+_WP_INDEX: Optional[WpPostIndex] = None
+
+async def wp_list_posts(per_page: int = 20, days: int = 30) -> List[Dict[str, Any]]:
+    """最近 days 日に公開された記事を更新順に最大 per_page 件（days=0 で全期間、per_page=0 で全件）。"""
+    global _WP_INDEX
     if not WP_BASE_URL:
         return []
-    after = (datetime.now(UTC) - timedelta(days=days)).isoformat().replace("+00:00", "Z")
-    url = f"{WP_BASE_URL.rstrip('/')}/wp-json/wp/v2/posts"
-    params = {
-        "per_page": per_page,
-        "orderby": "modified",
-        "order": "desc",
-        "after": after,
-        "_fields": "id,link,date,modified,slug,title",
-    }
-    auth = (WP_APP_USER, WP_APP_PASSWORD) if (WP_APP_USER and WP_APP_PASSWORD) else None
-    with httpx.Client(timeout=30.0) as client:
-        r = client.get(url, params=params, auth=auth)
-        r.raise_for_status()
-        return r.json()
+    if _WP_INDEX is None:
+        _WP_INDEX = WpPostIndex(WP_POST_INDEX)
+    await _WP_INDEX.sync()
+    return _WP_INDEX.recent(per_page, days)
 
 # ====== コネクタ：GA4（runReport, v1） ======
 def ga4_report_pages(
@@ -192,9 +340,9 @@ def ahrefs_mcp_site_overview(domain: str) -> Dict[str, Any]:
 from agents import function_tool
 
 @function_tool
-def tool_wp_list_posts(per_page: int = 20, days: int = 30) -> List[Dict[str, Any]]:
-    """WordPress: 最新/更新記事の一覧（読み取り）"""
-    return wp_list_posts(per_page=per_page, days=days)
+async def tool_wp_list_posts(per_page: int = 20, days: int = 30) -> List[Dict[str, Any]]:
+    """WordPress: 最新/更新記事の一覧（読み取り）。ローカル索引から返すので全件（per_page=0, days=0）も安価"""
+    return await wp_list_posts(per_page=per_page, days=days)
 
 @function_tool
 def tool_ga4_report(property_id: Optional[str], start_date: str, end_date: str) -> Dict[str, Any]:
@@ -248,18 +396,29 @@ def build_plan_agent(tools: List[Any]) -> Agent:
 # ====== CLI/REPL ======
 console = Console(stderr=True)
 
+class JsonlBuffer:
+    """--output jsonl 用：1イベント1行のJSONをためて、ターン毎にまとめて書き出す"""
+
+    def __init__(self, session_id: str = "") -> None:
+        self.session_id = session_id
+        self.turn = 0
+        self._lines: List[str] = []
+
+    def write(self, record_type: str, **fields: Any) -> None:
+        record = {"session_id": self.session_id, "turn": self.turn, "ts": time.time(), "type": record_type, **fields}
+        self._lines.append(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+    def flush(self) -> None:
+        if self._lines:
+            sys.stdout.write("".join(self._lines))
+            sys.stdout.flush()
+            self._lines.clear()
+
 def _date_span(days: int) -> tuple[str, str]:
     end = datetime.now(UTC).date()
     start = end - timedelta(days=days)
     return (start.isoformat(), end.isoformat())
 
-def _preview(obj: Any, max_len: int = 800) -> str:
-    try:
-        s = json.dumps(obj, ensure_ascii=False)
-    except Exception:
-        s = str(obj)
-    return s if len(s) <= max_len else (s[:max_len] + "…")
-
 def _extract_tool_name_and_args(raw_item: Any) -> tuple[str, str]:
     name = getattr(raw_item, "name", None)
     args = getattr(raw_item, "arguments", None)
@@ -269,12 +428,14 @@ def _extract_tool_name_and_args(raw_item: Any) -> tuple[str, str]:
     if name is None:
         name = raw_item.__class__.__name__
     if isinstance(args, (dict, list)):
-        args_preview = _preview(args, 500)
-    elif isinstance(args, str):
+        args_preview = bounded_preview(args, 500, max_items=5)
+    elif isinstance(args, str) and len(args) <= 500 * 8:
         try:
-            args_preview = _preview(json.loads(args), 500)
+            args_preview = bounded_preview(json.loads(args), 500, max_items=5)
         except Exception:
             args_preview = args[:500] + ("…" if len(args) > 500 else "")
+    elif isinstance(args, str):
+        args_preview = args[:500] + "…"
     else:
         args_preview = "-"
     return name, args_preview
@@ -294,6 +455,11 @@ def _route_is_plan(query: str) -> bool:
     # 日本語キーワードで意図検出
     return bool(re.search(r"(JSON|構造化|スキーマ|ImprovementPlan|計画を出力|プラン出力)", query, re.IGNORECASE))
 
+def _print_profile(headline: str, details: str) -> None:
+    console.print(headline, markup=False, highlight=False, soft_wrap=True, style="dim")
+    if details:
+        console.print(details, markup=False, highlight=False, soft_wrap=True, style="dim")
+
 async def run_one_turn(
     chat_agent: Agent,
     plan_agent: Agent,
@@ -303,10 +469,13 @@ async def run_one_turn(
     days: int,
     ga4_property_id: str,
     gsc_site_url: str,
-    model: Optional[str],
+    chat_model: Optional[str],
+    plan_model: Optional[str],
     max_turns: int,
     show_text_deltas: bool,
     current_mode: str,   # "chat" | "plan"
+    jsonl: Optional[JsonlBuffer] = None,
+    route_stats: Optional[RouteStats] = None,
 ) -> Dict[str, Any] | str:
     start, end = _date_span(days)
     enabled_sources = _enabled_sources(
@@ -329,7 +498,9 @@ async def run_one_turn(
     agent = plan_agent if use_plan else chat_agent
 
     # ストリーミング実行（進捗を逐次表示）:contentReference[oaicite:6]{index=6}
-    run_config = {"model": model} if model else None
+    # モード別モデル：chat は軽量・高速モデル、plan（ImprovementPlan 生成）は高性能モデル
+    model = (plan_model if use_plan else chat_model) or None
+    run_config = RunConfig(model=model) if model else None
     result = Runner.run_streamed(
         agent,
         input=user_context,
@@ -338,6 +509,21 @@ async def run_one_turn(
         run_config=run_config,
     )
 
+    started = time.monotonic()
+    try:
+        if jsonl is not None:
+            return await _consume_jsonl(result, jsonl, use_plan=use_plan, user_query=user_query)
+        return await _consume_console(result, use_plan=use_plan, show_text_deltas=show_text_deltas)
+    finally:
+        if route_stats is not None:
+            record = route_stats.record("plan" if use_plan else "chat", model, time.monotonic() - started, result.context_wrapper.usage)
+            if jsonl is not None:
+                jsonl.write("route", **record)
+                jsonl.flush()
+            else:
+                console.print(f"[dim]⏱ route {route_stats.describe(record)}[/]")
+
+async def _consume_console(result: Any, *, use_plan: bool, show_text_deltas: bool) -> Dict[str, Any] | str:
     console.rule(f"[bold cyan]Run started ({'PLAN' if use_plan else 'CHAT'})")
     printed_text_delta = False
 
@@ -362,7 +548,7 @@ async def run_one_turn(
                 name, args_preview = _extract_tool_name_and_args(item.raw_item)
                 console.print(f"[yellow]🔧 tool.call[/] [bold]{name}[/] args={args_preview}")
             elif item.type == "tool_call_output_item":
-                out_preview = _preview(item.output, 800)
+                out_preview = bounded_preview(item.output, 800, max_items=5)
                 console.print(f"[green]✅ tool.result[/] {out_preview}")
             elif item.type == "message_output_item":
                 # 途中の思考メッセージをログとして表示（本番は控えめ推奨）
@@ -393,6 +579,62 @@ async def run_one_turn(
             print(text)
             return text
 
+async def _consume_jsonl(result: Any, jsonl: JsonlBuffer, *, use_plan: bool, user_query: str) -> Dict[str, Any] | str:
+    # 端末整形なし：イベントを型付きレコードに変換してバッファへ
+    jsonl.turn += 1
+    started = time.monotonic()
+    first_event_ms: Optional[int] = None
+    tool_names: Dict[str, str] = {}
+    jsonl.write("turn_started", mode="plan" if use_plan else "chat", input=user_query)
+    try:
+        async for event in result.stream_events():
+            if first_event_ms is None:
+                first_event_ms = round((time.monotonic() - started) * 1000)
+            if event.type == "agent_updated_stream_event":
+                jsonl.write("agent_updated", agent=event.new_agent.name)
+            elif event.type == "run_item_stream_event":
+                item = event.item
+                if item.type == "tool_call_item":
+                    raw = item.raw_item
+                    call_id = getattr(raw, "call_id", None)
+                    name, _ = _extract_tool_name_and_args(raw)
+                    tool_names[call_id] = name
+                    args = getattr(raw, "arguments", None)
+                    try:
+                        args = json.loads(args) if isinstance(args, str) else args
+                    except Exception:
+                        pass
+                    jsonl.write("tool_call", call_id=call_id, tool=name, arguments=args)
+                elif item.type == "tool_call_output_item":
+                    raw = item.raw_item
+                    call_id = raw.get("call_id") if isinstance(raw, dict) else getattr(raw, "call_id", None)
+                    jsonl.write("tool_output", call_id=call_id, tool=tool_names.get(call_id, "tool"), output=item.output)
+                elif item.type == "reasoning_item":
+                    texts = [getattr(s, "text", "") for s in (getattr(item.raw_item, "summary", None) or [])]
+                    if any(texts):
+                        jsonl.write("reasoning", text=" ".join(t for t in texts if t))
+                elif item.type == "message_output_item":
+                    jsonl.write("message", text=ItemHelpers.text_message_output(item))
+    except Exception as exc:
+        jsonl.write("error", message=str(exc))
+        jsonl.write("timing", elapsed_ms=round((time.monotonic() - started) * 1000), first_event_ms=first_event_ms)
+        jsonl.flush()
+        return ""
+
+    if use_plan:
+        try:
+            payload: Dict[str, Any] | str = result.final_output_as(ImprovementPlan, raise_if_incorrect_type=True).model_dump()
+            jsonl.write("plan", plan=payload)
+        except TypeError as exc:
+            payload = {"text": str(result.final_output), "error": f"Structured output unavailable: {exc}"}
+            jsonl.write("error", message=payload["error"], text=payload["text"])
+    else:
+        payload = str(result.final_output or "")
+        jsonl.write("final_text", text=payload)
+    jsonl.write("timing", elapsed_ms=round((time.monotonic() - started) * 1000), first_event_ms=first_event_ms)
+    jsonl.flush()
+    return payload
+
 def build_enabled_tools(ga4_property_id: str, gsc_site_url: str) -> List[Any]:
     tools: List[Any] = [tool_wp_list_posts]
     if ga4_property_id:
@@ -413,43 +655,58 @@ async def repl_loop(
     days: int,
     ga4_property_id: str,
     gsc_site_url: str,
-    model: Optional[str],
+    chat_model: Optional[str],
+    plan_model: Optional[str],
     max_turns: int,
     show_text_deltas: bool,
+    jsonl: Optional[JsonlBuffer] = None,
+    profiler: Optional[TurnProfiler] = None,
+    route_stats: Optional[RouteStats] = None,
 ):
-    console.print("[bold]対話を開始します。終了は /exit、モード切替は /mode chat|plan、単発構造化は /plan[/]")
+    console.print("[bold]対話を開始します。終了は /exit、モード切替は /mode chat|plan、単発構造化は /plan、ルート別統計は /stats[/]")
     mode = "chat"  # 既定は柔軟会話
-    while True:
-        try:
-            user_query = Prompt.ask(f"[bold magenta]You ({mode})[/]")
-        except (EOFError, KeyboardInterrupt):
-            break
-        if not user_query:
-            continue
-
-        # モードコマンド
-        low = user_query.strip().lower()
-        if low in {"/exit", "exit", "quit"}:
-            break
-        if low.startswith("/mode"):
-            target = low.split(" ", 1)[1] if " " in low else ""
-            if target in {"chat", "plan"}:
-                mode = target
-                console.print(f"[bold green]Mode changed → {mode.upper()}[/]")
-            else:
-                console.print("[yellow]Usage: /mode chat | /mode plan[/]")
-            continue
-
-        payload = await run_one_turn(
-            chat_agent, plan_agent, session, user_query,
-            days=days, ga4_property_id=ga4_property_id, gsc_site_url=gsc_site_url,
-            model=model, max_turns=max_turns, show_text_deltas=show_text_deltas,
-            current_mode=mode,
-        )
-
-        # 返却：PLAN時は JSON を STDOUT、CHAT時はすでにテキストをSTDOUTへ出力済み
-        if mode == "plan" or _route_is_plan(user_query):
-            print(json.dumps(payload, ensure_ascii=False, indent=2))
+    route_stats = route_stats or RouteStats()
+    try:
+        while True:
+            try:
+                user_query = Prompt.ask(f"[bold magenta]You ({mode})[/]", console=console if jsonl is not None else None)
+            except (EOFError, KeyboardInterrupt):
+                break
+            if not user_query:
+                continue
+
+            # モードコマンド
+            low = user_query.strip().lower()
+            if low in {"/exit", "exit", "quit"}:
+                break
+            if low == "/stats":
+                for line in route_stats.summary_lines():
+                    console.print(f"[dim]⏱ {line}[/]")
+                continue
+            if low.startswith("/mode"):
+                target = low.split(" ", 1)[1] if " " in low else ""
+                if target in {"chat", "plan"}:
+                    mode = target
+                    console.print(f"[bold green]Mode changed → {mode.upper()}[/]")
+                else:
+                    console.print("[yellow]Usage: /mode chat | /mode plan[/]")
+                continue
+
+            with profiler.turn() if profiler is not None else contextlib.nullcontext():
+                payload = await run_one_turn(
+                    chat_agent, plan_agent, session, user_query,
+                    days=days, ga4_property_id=ga4_property_id, gsc_site_url=gsc_site_url,
+                    chat_model=chat_model, plan_model=plan_model, max_turns=max_turns, show_text_deltas=show_text_deltas,
+                    current_mode=mode, jsonl=jsonl, route_stats=route_stats,
+                )
+
+            # 返却：PLAN時は JSON を STDOUT、CHAT時はすでにテキストをSTDOUTへ出力済み（jsonl は出力済み）
+            if jsonl is None and (mode == "plan" or _route_is_plan(user_query)):
+                print(json.dumps(payload, ensure_ascii=False, indent=2))
+    finally:
+        # プールした接続を閉じてから終了する（ループ終了後に閉じると警告が出る）
+        if _WP_INDEX is not None:
+            await _WP_INDEX.aclose()
 
 def main():
     parser = argparse.ArgumentParser(description="Marketing Analysis Agent (interactive, READ-ONLY, dual-mode)")
@@ -458,13 +715,22 @@ def main():
     parser.add_argument("--ga4-property-id", type=str, default=GA4_PROPERTY_ID_ENV)
     parser.add_argument("--gsc-site-url", type=str, default=os.getenv("GSC_SITE_URL", ""))
     parser.add_argument("--days", type=int, default=30)
-    parser.add_argument("--model", type=str, default=None, help="Responsesモデル（例：o4-mini 等）")
+    parser.add_argument("--model", type=str, default=None, help="Responsesモデル（例：o4-mini 等）。--chat-model/--plan-model 未指定時の既定")
+    parser.add_argument("--chat-model", type=str, default=os.getenv("CHAT_MODEL") or None, help="Chatターン用の軽量・高速モデル（例：gpt-4.1-mini）")
+    parser.add_argument("--plan-model", type=str, default=os.getenv("PLAN_MODEL") or None, help="Plan（ImprovementPlan 生成）用の高性能モデル")
     parser.add_argument("--max-turns", type=int, default=12)
     parser.add_argument("--show-text-deltas", action="store_true", help="テキストデルタを逐次表示（Chatモード）")
+    parser.add_argument("--output", choices=["text", "jsonl"], default="text", help="jsonl: イベント毎のJSONレコードをSTDOUTへ（ターン毎にフラッシュ）")
+    parser.add_argument("--profile", choices=["cpu", "mem"], default=None, help="ターン毎のプロファイル（cpu: cProfile の .prof、mem: tracemalloc の割り当て増分）")
+    parser.add_argument("--profile-dir", type=str, default=os.getenv("PROFILE_DIR", "profiles"), help="--profile の出力先ディレクトリ")
     args = parser.parse_args()
 
     if not OPENAI_API_KEY:
         raise SystemExit("OPENAI_API_KEY is not set.")
+    try:
+        pricing = load_model_pricing(os.getenv("MODEL_PRICING_JSON", ""))
+    except ValueError as exc:
+        raise SystemExit(str(exc))
 
     # ツール有効化
     tools = build_enabled_tools(args.ga4_property_id.strip(), args.gsc_site_url.strip())
@@ -486,9 +752,13 @@ def main():
             days=args.days,
             ga4_property_id=args.ga4_property_id.strip(),
             gsc_site_url=args.gsc_site_url.strip(),
-            model=args.model,
+            chat_model=args.chat_model or args.model,
+            plan_model=args.plan_model or args.model,
             max_turns=args.max_turns,
             show_text_deltas=args.show_text_deltas,
+            jsonl=JsonlBuffer(args.session_id) if args.output == "jsonl" else None,
+            profiler=TurnProfiler(args.profile, args.profile_dir, emit=_print_profile) if args.profile else None,
+            route_stats=RouteStats(pricing),
         )
     )
 
@@ -1,69 +1,534 @@
-import os, sys, requests
-from requests.auth import HTTPBasicAuth
+#!/usr/bin/env -S uv run --script
+# /// script
+# requires-python = ">=3.12"
+# dependencies = [
+#   "httpx>=0.28.1",
+#   "python-dotenv>=1.0",
+# ]
+# [tool.uv]
+# exclude-newer = "2025-10-30T00:00:00Z"
+# ///
+"""WordPress MCP endpoint: connectivity check and async load generator.
+
+    uv run tests/test_wp_auth.py                 # 認証・initialize・tools/list の疎通確認
+    uv run tests/test_wp_auth.py load --sessions 8 --rate 20 --duration 60
+    uv run tests/test_wp_auth.py load --stub     # ローカルのスタブサーバーに対して実行
+    uv run tests/test_wp_auth.py stub --port 8765
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import time
+import uuid
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
 import dotenv
+import httpx
 
 dotenv.load_dotenv()
 
+# ====== 設定 ======
 BASE = os.getenv("WP_BASE_URL", "https://hitocareer.com").rstrip("/")
 USER = os.getenv("WP_APP_USER")
-PWD  = os.getenv("WP_APP_PASSWORD")
-
-if not USER or not PWD:
-    print("WP_APP_USER / WP_APP_PASSWORD を設定してください")
-    sys.exit(1)
-
-auth = HTTPBasicAuth(USER, PWD)
-
-def get(url, params=None):
-    r = requests.get(url, params=params, auth=auth, timeout=20)
-    print(f"GET {r.url} [{r.status_code}]")
-    if r.status_code != 200:
-        print(r.text[:500])
-    return r
-
-def jsonrpc(url, payload, session_id=None):
-    headers = {"Content-Type": "application/json"}
-    if session_id:
-        headers["Mcp-Session-Id"] = session_id
-    r = requests.post(url, json=payload, auth=auth, timeout=20, headers=headers)
-    print(f"POST {url} [{r.status_code}] sid={session_id}")
-    if r.status_code != 200:
-        print(r.text[:500])
-    return r
-
-print("--- 1. ユーザー認証確認 ---")
-get(f"{BASE}/wp-json/wp/v2/users/me")
-
-print("\n--- 2. カスタム MCP サーバーへの接続確認 ---")
-# 重要: プラグインで定義されたサーバーID 'marketing-ro-server' を指定
-# Namespace 'marketing' + route 'mcp' + server_id
-mcp_url = "https://hitocareer.com/wp-json/mcp/mcp-adapter-default-server"
-
-# Initialize
-init_payload = {
-    "jsonrpc": "2.0",
-    "id": 1,
-    "method": "initialize",
-    "params": {
-        "protocolVersion": "2024-11-05",
-        "capabilities": {},
-        "clientInfo": {"name": "test-client", "version": "1.0"}
-    }
+PWD = os.getenv("WP_APP_PASSWORD")
+MCP_URL = os.getenv("WP_MCP_HTTP_URL") or f"{BASE}/wp-json/mcp/mcp-adapter-default-server"
+
+DEFAULT_MIX = "get-posts=6,search-posts=3,get-categories=1"
+DEFAULT_ARGUMENTS: Dict[str, Dict[str, Any]] = {
+    "get-posts": {"number": 10, "status": "publish"},
+    "search-posts": {"s": "SEO"},
+    "get-categories": {},
 }
-init = jsonrpc(mcp_url, init_payload)
-
-if init.status_code == 200:
-    sid = init.headers.get("Mcp-Session-Id")
-    print(f"Session ID 取得成功: {sid}")
-    
-    print("\n--- 3. ツール一覧の取得 (tools/list) ---")
-    list_payload = {
-        "jsonrpc": "2.0",
-        "id": 2,
-        "method": "tools/list",
-        "params": {}
+PROTOCOL_VERSION = "2024-11-05"
+
+
+# ====== MCP クライアント（streamable HTTP） ======
+class McpError(Exception):
+    """A failed MCP request; ``kind`` is the label errors are counted under."""
+
+    def __init__(self, kind: str, message: str) -> None:
+        super().__init__(message)
+        self.kind = kind
+
+
+class McpSession:
+    """One MCP session over streamable HTTP on a shared httpx.AsyncClient."""
+
+    def __init__(self, client: httpx.AsyncClient, url: str) -> None:
+        self._client = client
+        self._url = url
+        self._ids = itertools.count(1)
+        self.session_id: Optional[str] = None
+
+    async def open(self) -> Dict[str, Any]:
+        result = await self.request(
+            "initialize",
+            {
+                "protocolVersion": PROTOCOL_VERSION,
+                "capabilities": {},
+                "clientInfo": {"name": "wp-mcp-load", "version": "1.0"},
+            },
+        )
+        await self._post({"jsonrpc": "2.0", "method": "notifications/initialized"})
+        return result
+
+    async def close(self) -> None:
+        if self.session_id:
+            try:
+                await self._client.delete(self._url, headers={"Mcp-Session-Id": self.session_id})
+            except httpx.HTTPError:
+                pass
+
+    async def list_tools(self) -> List[Dict[str, Any]]:
+        return (await self.request("tools/list", {})).get("tools", [])
+
+    async def call_tool(self, name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
+        result = await self.request("tools/call", {"name": name, "arguments": arguments})
+        if result.get("isError"):
+            raise McpError("tool error", _content_text(result)[:200])
+        return result
+
+    async def request(self, method: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        request_id = next(self._ids)
+        response = await self._post({"jsonrpc": "2.0", "id": request_id, "method": method, "params": params})
+        if method == "initialize":
+            self.session_id = response.headers.get("Mcp-Session-Id") or self.session_id
+        message = _decode_message(response, request_id)
+        if "error" in message:
+            error = message["error"] or {}
+            raise McpError(f"rpc {error.get('code')}", str(error.get("message", ""))[:200])
+        return message.get("result") or {}
+
+    async def _post(self, payload: Dict[str, Any]) -> httpx.Response:
+        headers = {"Accept": "application/json, text/event-stream"}
+        if self.session_id:
+            headers["Mcp-Session-Id"] = self.session_id
+        try:
+            response = await self._client.post(self._url, json=payload, headers=headers)
+        except httpx.TimeoutException as exc:
+            raise McpError("timeout", str(exc)) from None
+        except httpx.HTTPError as exc:
+            raise McpError(type(exc).__name__, str(exc)) from None
+        if response.status_code >= 400:
+            raise McpError(f"http {response.status_code}", response.text[:200])
+        return response
+
+
+def _decode_message(response: httpx.Response, request_id: int) -> Dict[str, Any]:
+    # サーバーは application/json か text/event-stream（SSE）のどちらかで返す
+    if response.headers.get("content-type", "").startswith("text/event-stream"):
+        for line in response.text.splitlines():
+            if not line.startswith("data:"):
+                continue
+            message = json.loads(line[5:].strip())
+            if message.get("id") == request_id:
+                return message
+        raise McpError("no response", f"SSE stream ended without a reply to request {request_id}")
+    try:
+        return response.json()
+    except ValueError:
+        raise McpError("bad json", response.text[:200]) from None
+
+
+def _content_text(result: Dict[str, Any]) -> str:
+    return "".join(part.get("text", "") for part in result.get("content") or [] if isinstance(part, dict))
+
+
+# ====== 疎通確認 ======
+async def check(url: str, auth: httpx.Auth) -> int:
+    async with httpx.AsyncClient(auth=auth, timeout=20) as client:
+        print("--- 1. ユーザー認証確認 ---")
+        r = await client.get(f"{BASE}/wp-json/wp/v2/users/me")
+        print(f"GET {r.url} [{r.status_code}]")
+        if r.status_code != 200:
+            print(r.text[:500])
+
+        print(f"\n--- 2. MCP サーバーへの接続確認 ({url}) ---")
+        session = McpSession(client, url)
+        try:
+            info = await session.open()
+        except McpError as exc:
+            print(f"Initialize 失敗（{exc.kind}）: {exc}")
+            print("プラグインが有効化されているか、URLが正しいか確認してください。")
+            return 1
+        print(f"Session ID 取得成功: {session.session_id}  server={info.get('serverInfo')}")
+
+        print("\n--- 3. ツール一覧の取得 (tools/list) ---")
+        try:
+            for tool in await session.list_tools():
+                print(f"- {tool.get('name')}: {(tool.get('description') or '').splitlines()[0][:80]}")
+        except McpError as exc:
+            print(f"tools/list 失敗（{exc.kind}）: {exc}")
+            return 1
+        finally:
+            await session.close()
+    return 0
+
+
+# ====== 負荷生成 ======
+@dataclass
+class AbilityStats:
+    latencies: List[float] = field(default_factory=list)
+    errors: Counter = field(default_factory=Counter)
+
+    @property
+    def calls(self) -> int:
+        return len(self.latencies) + sum(self.errors.values())
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return math.nan
+    return values[min(len(values) - 1, max(0, math.ceil(q / 100 * len(values)) - 1))]
+
+
+def parse_mix(text: str) -> List[Tuple[str, float]]:
+    mix: List[Tuple[str, float]] = []
+    for chunk in text.split(","):
+        name, _, weight = chunk.strip().partition("=")
+        if name:
+            mix.append((name.strip(), float(weight or 1)))
+    if not mix or any(weight <= 0 for _, weight in mix):
+        raise ValueError(f"invalid --mix: {text!r}")
+    return mix
+
+
+def resolve_tools(mix: List[Tuple[str, float]], tools: List[Dict[str, Any]]) -> Dict[str, str]:
+    # アダプターはツール名に接頭辞を付けるので、完全一致か末尾一致で引く
+    names = [tool.get("name", "") for tool in tools]
+    resolved: Dict[str, str] = {}
+    for ability, _ in mix:
+        match = next((n for n in names if n == ability), None) or next((n for n in names if n.endswith(ability)), None)
+        if match is None:
+            raise SystemExit(f"ability {ability!r} is not exposed by the server (tools: {', '.join(names)})")
+        resolved[ability] = match
+    return resolved
+
+
+async def run_load(
+    url: str,
+    auth: Optional[httpx.Auth],
+    *,
+    sessions: int,
+    rate: float,
+    duration: float,
+    mix: List[Tuple[str, float]],
+    arguments: Dict[str, Dict[str, Any]],
+    timeout: float,
+    max_in_flight: int,
+    seed: int,
+) -> Dict[str, Any]:
+    """Drive ``tools/call`` at a fixed arrival rate across N MCP sessions.
+
+    Arrivals are open-loop: latency is measured from the scheduled start, so
+    a saturated server shows up as queueing delay instead of a lower rate.
+    """
+    limits = httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight)
+    stats: Dict[str, AbilityStats] = {ability: AbilityStats() for ability, _ in mix}
+    init_stats = AbilityStats()
+    dropped = 0
+    rng = random.Random(seed)
+
+    async with httpx.AsyncClient(auth=auth, timeout=timeout, limits=limits) as client:
+
+        async def open_session() -> Optional[McpSession]:
+            session = McpSession(client, url)
+            started = time.perf_counter()
+            try:
+                await session.open()
+            except McpError as exc:
+                init_stats.errors[exc.kind] += 1
+                return None
+            init_stats.latencies.append(time.perf_counter() - started)
+            return session
+
+        opened = [s for s in await asyncio.gather(*(open_session() for _ in range(sessions))) if s is not None]
+        if not opened:
+            raise SystemExit(f"no MCP session could be opened: {dict(init_stats.errors)}")
+        tool_names = resolve_tools(mix, await opened[0].list_tools())
+        abilities = [ability for ability, _ in mix]
+        weights = [weight for _, weight in mix]
+        round_robin = itertools.cycle(opened)
+        in_flight: set[asyncio.Task[None]] = set()
+
+        async def call(session: McpSession, ability: str, scheduled: float) -> None:
+            try:
+                await session.call_tool(tool_names[ability], arguments.get(ability, {}))
+            except McpError as exc:
+                stats[ability].errors[exc.kind] += 1
+            else:
+                stats[ability].latencies.append(time.perf_counter() - scheduled)
+
+        started = time.perf_counter()
+        interval = 1.0 / rate
+        for tick in itertools.count():
+            scheduled = started + tick * interval
+            if scheduled - started >= duration:
+                break
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if len(in_flight) >= max_in_flight:
+                dropped += 1  # クライアント側の上限。サーバーが追いついていない
+                continue
+            ability = rng.choices(abilities, weights)[0]
+            task = asyncio.create_task(call(next(round_robin), ability, scheduled))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+        if in_flight:
+            await asyncio.wait(in_flight, timeout=timeout)
+        elapsed = time.perf_counter() - started
+        await asyncio.gather(*(session.close() for session in opened))
+
+    return {
+        "url": url,
+        "sessions": len(opened),
+        "target_rate": rate,
+        "elapsed_s": round(elapsed, 3),
+        "dropped": dropped,
+        "abilities": {"initialize": _summarize(init_stats, elapsed), **{a: _summarize(s, elapsed) for a, s in stats.items()}},
+        "total": _summarize(_merge(stats.values()), elapsed),
     }
-    res = jsonrpc(mcp_url, list_payload, session_id=sid)
-    print(res.text[:3000]) # 結果を表示
-else:
-    print("Initialize 失敗。プラグインが有効化されているか、URLが正しいか確認してください。")
\ No newline at end of file
+
+
+def _merge(parts: Any) -> AbilityStats:
+    merged = AbilityStats()
+    for part in parts:
+        merged.latencies.extend(part.latencies)
+        merged.errors.update(part.errors)
+    return merged
+
+
+def _summarize(stats: AbilityStats, elapsed: float) -> Dict[str, Any]:
+    latencies = sorted(stats.latencies)
+    calls = stats.calls
+
+    def ms(value: float) -> Optional[float]:
+        return None if math.isnan(value) else round(value * 1000, 1)
+
+    return {
+        "calls": calls,
+        "ok": len(latencies),
+        "error_rate": round(sum(stats.errors.values()) / calls, 4) if calls else 0.0,
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p95_ms": ms(percentile(latencies, 95)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "max_ms": ms(latencies[-1]) if latencies else None,
+        "errors": dict(stats.errors),
+    }
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    print(
+        f"\n{report['url']}  sessions={report['sessions']} target={report['target_rate']:g}/s "
+        f"elapsed={report['elapsed_s']:.1f}s dropped={report['dropped']}"
+    )
+    header = f"{'ability':<18}{'calls':>7}{'ok':>7}{'err%':>7}{'rps':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}"
+    print(header)
+    print("-" * len(header))
+    rows = [*report["abilities"].items(), ("TOTAL", report["total"])]
+    for name, row in rows:
+        cells = [f"{row[key]:.1f}" if row[key] is not None else "-" for key in ("p50_ms", "p95_ms", "p99_ms", "max_ms")]
+        print(
+            f"{name:<18}{row['calls']:>7}{row['ok']:>7}{row['error_rate'] * 100:>6.1f}%{row['throughput_rps']:>8.1f}"
+            + "".join(f"{cell:>9}" for cell in cells)
+        )
+    for name, row in rows:
+        if row["errors"]:
+            print(f"  {name} errors: " + ", ".join(f"{kind}={count}" for kind, count in row["errors"].items()))
+
+
+# ====== スタブサーバー ======
+STUB_TOOLS = {
+    "get-posts": 40.0,
+    "search-posts": 120.0,
+    "get-categories": 15.0,
+}
+# my-mcp-abilities.php の input_schema で必須になっている引数
+STUB_REQUIRED: Dict[str, Tuple[str, ...]] = {
+    "search-posts": ("s",),
+}
+
+
+async def serve_stub(
+    host: str, port: int, *, latency_scale: float = 1.0, error_rate: float = 0.0, seed: int = 0
+) -> asyncio.Server:
+    """Minimal streamable-HTTP MCP server with per-ability latency (lognormal) and errors."""
+    rng = random.Random(seed)
+    sessions: set[str] = set()
+
+    def respond(writer: asyncio.StreamWriter, status: int, body: bytes, headers: Dict[str, str]) -> None:
+        head = [f"HTTP/1.1 {status} {'OK' if status < 300 else 'Error'}", f"Content-Length: {len(body)}"]
+        head += [f"{k}: {v}" for k, v in headers.items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+
+    async def dispatch(method: str, params: Dict[str, Any], session_id: Optional[str]) -> Tuple[Any, Dict[str, str]]:
+        if method == "initialize":
+            new_id = uuid.uuid4().hex
+            sessions.add(new_id)
+            info = {"protocolVersion": PROTOCOL_VERSION, "capabilities": {"tools": {}}, "serverInfo": {"name": "wp-stub", "version": "0"}}
+            return info, {"Mcp-Session-Id": new_id}
+        if session_id not in sessions:
+            raise McpError("-32001", "unknown session")
+        if method == "tools/list":
+            tools = [
+                {
+                    "name": f"wpmcp-{name}",
+                    "description": f"stub {name}",
+                    "inputSchema": {"type": "object", "required": list(STUB_REQUIRED.get(name, ()))},
+                }
+                for name in STUB_TOOLS
+            ]
+            return {"tools": tools}, {}
+        if method == "tools/call":
+            ability = str(params.get("name", "")).removeprefix("wpmcp-")
+            if ability not in STUB_TOOLS:
+                raise McpError("-32602", f"unknown tool {params.get('name')}")
+            missing = [key for key in STUB_REQUIRED.get(ability, ()) if key not in (params.get("arguments") or {})]
+            if missing:
+                raise McpError("-32602", f"missing required arguments: {', '.join(missing)}")
+            await asyncio.sleep(STUB_TOOLS[ability] * latency_scale / 1000 * rng.lognormvariate(0, 0.5))
+            if rng.random() < error_rate:
+                return {"isError": True, "content": [{"type": "text", "text": "stub failure"}]}, {}
+            payload = [{"id": i, "title": f"{ability} {i}"} for i in range(10)]
+            return {"content": [{"type": "text", "text": json.dumps(payload)}]}, {}
+        raise McpError("-32601", f"method not found: {method}")
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:  # keep-alive
+                head = await reader.readuntil(b"\r\n\r\n")
+                request_line, *lines = head.decode("latin-1").rstrip("\r\n").split("\r\n")
+                verb = request_line.split(" ", 1)[0]
+                headers = {k.strip().lower(): v.strip() for k, _, v in (line.partition(":") for line in lines)}
+                body = await reader.readexactly(int(headers.get("content-length") or 0))
+                session_id = headers.get("mcp-session-id")
+                if verb == "DELETE":
+                    sessions.discard(session_id or "")
+                    respond(writer, 200, b"", {})
+                    continue
+                message = json.loads(body or b"{}")
+                if "id" not in message:  # 通知
+                    respond(writer, 202, b"", {})
+                    continue
+                try:
+                    result, extra = await dispatch(message.get("method", ""), message.get("params") or {}, session_id)
+                    reply: Dict[str, Any] = {"jsonrpc": "2.0", "id": message["id"], "result": result}
+                except McpError as exc:
+                    extra = {}
+                    reply = {"jsonrpc": "2.0", "id": message["id"], "error": {"code": int(exc.kind), "message": str(exc)}}
+                respond(writer, 200, json.dumps(reply).encode(), {"Content-Type": "application/json", **extra})
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+# ====== CLI ======
+def main() -> int:
+    parser = argparse.ArgumentParser(description="WordPress MCP endpoint check / load generator")
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("check", help="認証・initialize・tools/list の疎通確認（既定）")
+
+    load = sub.add_parser("load", help="複数セッションから tools/call を一定レートで送り、能力別のレイテンシを計測")
+    load.add_argument("--url", default=MCP_URL, help="MCP エンドポイント（既定: WP_MCP_HTTP_URL または WP_BASE_URL から推定）")
+    load.add_argument("--sessions", type=int, default=4, help="同時に開く MCP セッション数")
+    load.add_argument("--rate", type=float, default=10.0, help="1秒あたりの tools/call 数（目標）")
+    load.add_argument("--duration", type=float, default=30.0, help="計測時間（秒）")
+    load.add_argument("--mix", default=DEFAULT_MIX, help="能力と重み（例: get-posts=6,search-posts=3）")
+    load.add_argument("--arguments", default="", help='能力別の引数（JSON、例: {"search-posts": {"s": "転職"}}）')
+    load.add_argument("--timeout", type=float, default=30.0, help="1リクエストのタイムアウト秒")
+    load.add_argument("--max-in-flight", type=int, default=64, help="同時に待てるリクエスト数（超えた分は dropped）")
+    load.add_argument("--seed", type=int, default=0)
+    load.add_argument("--json", action="store_true", help="結果を JSON で出力")
+    load.add_argument("--stub", action="store_true", help="ローカルのスタブサーバーを起動してそれに対して実行")
+    load.add_argument("--stub-latency-scale", type=float, default=1.0, help="スタブの応答時間の倍率")
+    load.add_argument("--stub-error-rate", type=float, default=0.0, help="スタブがツールエラーを返す割合")
+
+    stub = sub.add_parser("stub", help="スタブ MCP サーバーだけを起動する")
+    stub.add_argument("--host", default="127.0.0.1")
+    stub.add_argument("--port", type=int, default=8765)
+    stub.add_argument("--latency-scale", type=float, default=1.0)
+    stub.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    auth = httpx.BasicAuth(USER, PWD) if USER and PWD else None
+
+    if args.command == "stub":
+        async def forever() -> None:
+            server = await serve_stub(args.host, args.port, latency_scale=args.latency_scale, error_rate=args.error_rate)
+            print(f"stub MCP server: http://{args.host}:{args.port}/mcp", file=sys.stderr)
+            async with server:
+                await server.serve_forever()
+
+        try:
+            asyncio.run(forever())
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    if args.command == "load":
+        try:
+            mix = parse_mix(args.mix)
+            arguments = {**DEFAULT_ARGUMENTS, **(json.loads(args.arguments) if args.arguments else {})}
+        except ValueError as exc:
+            print(exc, file=sys.stderr)
+            return 2
+        if args.rate <= 0 or args.sessions <= 0:
+            print("--rate and --sessions must be positive", file=sys.stderr)
+            return 2
+
+        async def run() -> Dict[str, Any]:
+            url, server = args.url, None
+            if args.stub:
+                server = await serve_stub(
+                    "127.0.0.1", 0, latency_scale=args.stub_latency_scale, error_rate=args.stub_error_rate, seed=args.seed
+                )
+                url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/mcp"
+            try:
+                return await run_load(
+                    url,
+                    None if args.stub else auth,
+                    sessions=args.sessions,
+                    rate=args.rate,
+                    duration=args.duration,
+                    mix=mix,
+                    arguments=arguments,
+                    timeout=args.timeout,
+                    max_in_flight=args.max_in_flight,
+                    seed=args.seed,
+                )
+            finally:
+                if server is not None:
+                    server.close()
+
+        report = asyncio.run(run())
+        if args.json:
+            print(json.dumps(report, ensure_ascii=False, indent=2))
+        else:
+            print_report(report)
+        return 1 if report["total"]["error_rate"] > 0 else 0
+
+    if not USER or not PWD:
+        print("WP_APP_USER / WP_APP_PASSWORD を設定してください")
+        return 1
+    return asyncio.run(check(MCP_URL, httpx.BasicAuth(USER, PWD)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())